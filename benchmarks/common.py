@@ -0,0 +1,69 @@
+import json
+import platform
+import subprocess
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = ROOT / "benchmarks" / "results"
+
+
+def percentile(values: list[float], pct: float) -> float:
+    # Nearest-rank percentile
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize_latencies(latencies: list[float], elapsed: float) -> dict:
+    return {
+        "requests": len(latencies),
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies, default=0.0) * 1000,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def write_results(name: str, config: dict, results: dict, output: str = None) -> Path:
+    commit = git_commit()
+    payload = {
+        "benchmark": name,
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "results": results,
+    }
+    if output is None:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        output = RESULTS_DIR / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{commit}.json"
+    path = Path(output)
+    path.write_text(json.dumps(payload, indent=2))
+    return path
+
+
+def compare_results(current: dict, baseline_path: str) -> None:
+    baseline = json.loads(Path(baseline_path).read_text())["results"]
+    print(f"\nCompared with {baseline_path}:")
+    for scenario, stats in current.items():
+        before = baseline.get(scenario)
+        if before is None:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps"):
+            if key in stats and before.get(key):
+                change = (stats[key] - before[key]) / before[key] * 100
+                print(f"  {scenario:<20} {key:<15} {before[key]:>10.2f} -> {stats[key]:>10.2f} ({change:+.1f}%)")
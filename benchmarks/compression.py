@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.common import write_results
+
+# (Accept, Accept-Encoding) pairs a client can negotiate for GET /users
+VARIANTS = {
+    "json": ("application/json", "identity"),
+    "json_gzip": ("application/json", "gzip"),
+    "json_zstd": ("application/json", "zstd"),
+    "msgpack": ("application/msgpack", "identity"),
+    "msgpack_gzip": ("application/msgpack", "gzip"),
+    "msgpack_zstd": ("application/msgpack", "zstd"),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Bytes on the wire and CPU per GET /users response for each "
+                                                 "negotiated encoding")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=20, help="sequential requests per variant")
+    parser.add_argument("--variants", default=",".join(VARIANTS))
+    parser.add_argument("--output", default=None, help="results JSON path")
+    return parser.parse_args()
+
+
+async def run(args) -> dict:
+    import httpx
+    from sqlalchemy import insert, select
+    from database import Base, dispose_engines, get_engine
+    from main import create_app
+    from models import User
+    from negotiation import ContentNegotiationMiddleware
+    from responses import encode_json
+
+    engine = get_engine()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(insert(User), [
+            {"username": f"user{i}", "email": f"user{i}@example.com", "first_name": "Bench", "last_name": f"User{i}"}
+            for i in range(args.rows)
+        ])
+
+    async with engine.connect() as conn:
+        rows = (await conn.execute(select(*User.__table__.columns).order_by(User.id))).all()
+    negotiation = ContentNegotiationMiddleware(None)
+
+    # Encoding and compression alone, without the query and the ASGI round trip
+    def encode(name: str) -> float:
+        accept, accept_encoding = VARIANTS[name]
+        start = time.process_time()
+        negotiation._encode(encode_json(rows), accept == "application/msgpack",
+                            None if accept_encoding == "identity" else accept_encoding)
+        return time.process_time() - start
+
+    app = create_app()
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for name in args.variants.split(","):
+            accept, accept_encoding = VARIANTS[name]
+            headers = {"Accept": accept, "Accept-Encoding": accept_encoding}
+            cpu = []
+            size = 0
+            for _ in range(args.requests):
+                start = time.process_time()
+                # Raw bytes as sent, without httpx decompressing them
+                async with client.stream("GET", "/users", headers=headers) as response:
+                    body = b"".join([chunk async for chunk in response.aiter_raw()])
+                cpu.append(time.process_time() - start)
+                size = len(body)
+                encoding = response.headers.get("content-encoding", "identity")
+                if encoding != accept_encoding or not response.headers["content-type"].startswith(accept):
+                    raise RuntimeError(f"{name}: got {response.headers['content-type']} {encoding}")
+            cpu.sort()
+            results[name] = {
+                "bytes": size,
+                "cpu_ms_p50": cpu[len(cpu) // 2] * 1000,
+                "cpu_ms_min": cpu[0] * 1000,
+                "encode_cpu_ms": min(encode(name) for _ in range(args.requests)) * 1000,
+            }
+            print(f"{name:<14} {size:>12,} bytes  {results[name]['cpu_ms_p50']:>8.2f} ms CPU per response (p50)  "
+                  f"{results[name]['encode_cpu_ms']:>8.2f} ms encoding and compression")
+    await dispose_engines()
+
+    baseline = results.get("json")
+    if baseline:
+        for stats in results.values():
+            stats["bytes_vs_json"] = stats["bytes"] / baseline["bytes"]
+            stats["cpu_vs_json"] = stats["cpu_ms_p50"] / baseline["cpu_ms_p50"]
+    return results
+
+
+def main():
+    args = parse_args()
+    os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///:memory:"
+    os.environ["DB_ECHO"] = "false"
+    results = asyncio.run(run(args))
+    path = write_results("compression", vars(args), results, args.output)
+    print(f"\nResults written to {path}")
+
+
+if __name__ == "__main__":
+    main()
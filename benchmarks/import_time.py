@@ -0,0 +1,76 @@
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+from benchmarks.common import ROOT, write_results
+
+# Imports main and builds the app the way a worker does before its lifespan
+# starts, then reports the wall time and whether an engine was created.
+CHILD = """
+import time
+start = time.perf_counter()
+import main
+main.create_app()
+elapsed = time.perf_counter() - start
+import database
+print(elapsed, database._engine is not None)
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Import and app construction cost of a worker, against a budget")
+    parser.add_argument("--budget-ms", type=float, default=1500.0,
+                        help="fail when importing main and building the app takes longer")
+    parser.add_argument("--repeat", type=int, default=5, help="runs to take the fastest of")
+    parser.add_argument("--top", type=int, default=15, help="slowest packages to report")
+    parser.add_argument("--output", default=None, help="results JSON path")
+    return parser.parse_args()
+
+
+def run_once() -> tuple[float, bool, dict[str, int]]:
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    elapsed, engine_created = result.stdout.split()
+
+    # Lines look like "import time:  self [us] | cumulative | name", nested
+    # imports indented under the name column. Self time is summed per package.
+    packages: dict[str, int] = defaultdict(int)
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        packages[name.strip().split(".")[0]] += int(self_us)
+    return float(elapsed), engine_created == "True", packages
+
+
+def main():
+    args = parse_args()
+    # The first run also compiles bytecode, so the fastest run is reported
+    runs = [run_once() for _ in range(args.repeat)]
+    elapsed, engine_created, packages = min(runs, key=lambda run: run[0])
+
+    print(f"main + create_app(): {elapsed * 1000:.1f} ms (budget {args.budget_ms:.0f} ms)")
+    for name, self_us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {name:<30} {self_us / 1000:>8.1f} ms")
+
+    results = {
+        "elapsed_ms": elapsed * 1000,
+        "budget_ms": args.budget_ms,
+        "engine_created_at_import": engine_created,
+        "packages_ms": {name: self_us / 1000 for name, self_us in packages.items()},
+    }
+    path = write_results("import_time", vars(args), results, args.output)
+    print(f"\nResults written to {path}")
+
+    if engine_created:
+        sys.exit("A database engine was created while importing main or building the app")
+    if elapsed * 1000 > args.budget_ms:
+        sys.exit(f"Import time {elapsed * 1000:.1f} ms is over the {args.budget_ms:.0f} ms budget")
+
+
+if __name__ == "__main__":
+    main()
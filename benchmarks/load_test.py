@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.common import compare_results, percentile, summarize_latencies, write_results
+
+SCENARIOS = ["get_user", "hot_user", "get_users_page", "get_users_page_fields", "batch_get", "patch_user", "get_users", "stream_users",
+             "users_updated_since", "overload"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the users API in-process")
+    parser.add_argument("--database-url", default=None,
+                        help="defaults to a temporary SQLite database (sqlite+aiosqlite)")
+    parser.add_argument("--reset-database", action="store_true",
+                        help="required to drop and reseed a non-SQLite database")
+    parser.add_argument("--users", type=int, default=10_000, help="number of users to seed")
+    parser.add_argument("--requests", type=int, default=2_000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--no-cache", action="store_true", help="disable the user cache")
+    parser.add_argument("--accept-encoding", default="identity",
+                        help="Accept-Encoding sent with every request, e.g. gzip or zstd")
+    parser.add_argument("--no-admission", action="store_true",
+                        help="disable admission control, so requests queue on pool checkout")
+    parser.add_argument("--trace-allocations", action="store_true",
+                        help="measure allocations with tracemalloc (slows every request)")
+    parser.add_argument("--output", default=None, help="results JSON path")
+    parser.add_argument("--compare", default=None, help="earlier results JSON to compare with")
+    return parser.parse_args()
+
+
+async def seed(engine, count: int) -> None:
+    from sqlalchemy import insert
+    from database import Base
+    from models import User
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        # Seeded a day ago, so incremental syncs only see changes made during the run
+        seeded = datetime.now(timezone.utc) - timedelta(days=1)
+        for start in range(0, count, 1000):
+            rows = [
+                {"username": f"user{i}", "email": f"user{i}@example.com", "first_name": "Bench", "last_name": f"User{i}",
+                 "date_created": seeded, "date_updated": seeded}
+                for i in range(start, min(start + 1000, count))
+            ]
+            await conn.execute(insert(User), rows)
+
+
+def build_request(scenario: str, users: int):
+    user_id = random.randint(1, users)
+    if scenario == "get_user":
+        return "GET", f"/users/{user_id}", None
+    if scenario == "hot_user":
+        # Every request reads the same user, so concurrent misses coalesce
+        return "GET", "/users/1", None
+    if scenario == "get_users_page":
+        return "GET", "/users/page?limit=100", None
+    if scenario == "get_users_page_fields":
+        return "GET", "/users/page?limit=100&fields=id,username", None
+    if scenario == "batch_get":
+        return "POST", "/users/batch-get", {"ids": random.sample(range(1, users + 1), min(50, users))}
+    if scenario == "patch_user":
+        return "PATCH", f"/users/{user_id}", {"first_name": f"Bench{random.randint(0, 1_000_000)}"}
+    if scenario == "users_updated_since":
+        # An incremental sync that finds only the most recent changes
+        since = datetime.now(timezone.utc) - timedelta(seconds=1)
+        return "GET", f"/users?updated_since={since.isoformat().replace('+00:00', 'Z')}", None
+    if scenario == "overload":
+        # A batch job scanning the table while other clients read single users;
+        # the cheap reads should stay fast while the scans are shed
+        if random.random() < 0.2:
+            return "GET", "/users", None
+        return "GET", f"/users/{user_id}", None
+    if scenario in ("get_users", "stream_users"):
+        return "GET", "/users" if scenario == "get_users" else "/users/stream", None
+    raise ValueError(f"Unknown scenario {scenario}")
+
+
+async def run_scenario(client, scenario: str, args) -> dict:
+    # Full table reads are far heavier than point reads; scale them down
+    total = args.requests if scenario not in ("get_users", "stream_users") else max(1, args.requests // 100)
+    latencies = []
+    cheap_latencies = []
+    errors = 0
+    shed = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one():
+        nonlocal errors, shed
+        method, url, body = build_request(scenario, args.users)
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.request(method, url, json=body)
+            await response.aread()
+            latencies.append(time.perf_counter() - start)
+        if url != "/users":
+            cheap_latencies.append(latencies[-1])
+        if response.status_code in (429, 503):
+            shed += 1
+        elif response.status_code >= 400:
+            errors += 1
+
+    if args.trace_allocations:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - start
+
+    stats = summarize_latencies(latencies, elapsed)
+    stats["errors"] = errors
+    stats["shed"] = shed
+    if scenario == "overload" and cheap_latencies:
+        stats["cheap_p99_ms"] = percentile(cheap_latencies, 99) * 1000
+    if args.trace_allocations:
+        current, peak = tracemalloc.get_traced_memory()
+        stats["peak_memory_kib"] = (peak - before) / 1024
+        stats["retained_memory_kib"] = (current - before) / 1024
+    return stats
+
+
+async def run(args) -> dict:
+    import httpx
+    import dependencies
+    from database import dispose_engines, get_engine
+    from instrumentation import metrics
+    from main import app
+    from routers import user_routes
+    from services.cache import LRUTTLCache, ReadThroughCache
+
+    user_service = user_routes.user_service
+    if args.no_admission:
+        dependencies.admission.limit = 0
+    if args.no_cache:
+        # Keeps request coalescing, which does not depend on the cache
+        user_service.cache = ReadThroughCache(LRUTTLCache(maxsize=0), single_flight=user_service.single_flight)
+
+    await seed(get_engine(), args.users)
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark",
+                                 headers={"Accept-Encoding": args.accept_encoding}) as client:
+        for scenario in args.scenarios.split(","):
+            before = user_service.single_flight.get_stats()
+            compiled = (metrics.compiled_cache_hits, metrics.compiled_cache_misses)
+            results[scenario] = await run_scenario(client, scenario, args)
+            stats = results[scenario]
+            after = user_service.single_flight.get_stats()
+            stats["fetches_executed"] = after["executed"] - before["executed"]
+            stats["fetches_coalesced"] = after["coalesced"] - before["coalesced"]
+            hits = metrics.compiled_cache_hits - compiled[0]
+            misses = metrics.compiled_cache_misses - compiled[1]
+            stats["compiled_cache_hit_rate"] = hits / (hits + misses) if hits + misses else 0.0
+            print(f"{scenario:<20} {stats['requests']:>6} req  {stats['throughput_rps']:>9.1f} req/s  "
+                  f"p50 {stats['p50_ms']:>8.2f} ms  p95 {stats['p95_ms']:>8.2f} ms  p99 {stats['p99_ms']:>8.2f} ms  "
+                  f"errors {stats['errors']}  shed {stats['shed']}")
+    await dispose_engines()
+    return results
+
+
+def main():
+    args = parse_args()
+    database_url = args.database_url
+    if database_url is None:
+        database_url = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    elif not database_url.startswith("sqlite") and not args.reset_database:
+        raise SystemExit("Refusing to drop tables in a non-SQLite database without --reset-database")
+    # Must be set before the app (and its engine) is imported
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["DB_ECHO"] = "false"
+
+    if args.trace_allocations:
+        tracemalloc.start()
+    results = asyncio.run(run(args))
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    config["database_url"] = database_url.split("@")[-1]
+    path = write_results("load_test", config, results, args.output)
+    print(f"\nResults written to {path}")
+    if args.compare:
+        compare_results(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
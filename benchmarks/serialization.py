@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.common import write_results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Per-row CPU cost of the user list serialization paths")
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None, help="results JSON path")
+    return parser.parse_args()
+
+
+async def run(args) -> dict:
+    from pydantic import TypeAdapter
+    from sqlalchemy import insert, select
+    from sqlalchemy.ext.asyncio import AsyncSession
+    from database import Base, dispose_engines, get_engine
+    from models import User
+    from responses import encode_json
+    from schemas import UserModel
+
+    engine = get_engine()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(insert(User), [
+            {"username": f"user{i}", "email": f"user{i}@example.com", "first_name": "Bench", "last_name": f"User{i}"}
+            for i in range(args.rows)
+        ])
+
+    users_adapter = TypeAdapter(list[UserModel])
+
+    # Previous path: ORM instances validated through response_model, then encoded
+    async def orm_pydantic(session):
+        users = (await session.execute(select(User).order_by(User.id))).scalars().all()
+        start = time.process_time()
+        body = users_adapter.dump_json(users_adapter.validate_python(users, from_attributes=True))
+        return users, body, time.process_time() - start
+
+    # Fast path: plain row tuples encoded directly with orjson
+    async def rows_orjson(session):
+        rows = (await session.execute(select(*User.__table__.columns).order_by(User.id))).all()
+        start = time.process_time()
+        body = encode_json(rows)
+        return rows, body, time.process_time() - start
+
+    results = {}
+    bodies = {}
+    async with engine.connect() as conn:
+        for name, path in (("orm_pydantic", orm_pydantic), ("rows_orjson", rows_orjson)):
+            total_cpu = []
+            encode_cpu = []
+            for _ in range(args.repeat):
+                async with AsyncSession(bind=conn) as session:
+                    start = time.process_time()
+                    _, body, encode_seconds = await path(session)
+                    total_cpu.append(time.process_time() - start)
+                    encode_cpu.append(encode_seconds)
+            bodies[name] = body
+            best_total = min(total_cpu)
+            best_encode = min(encode_cpu)
+            results[name] = {
+                "rows": args.rows,
+                "cpu_ms_total": best_total * 1000,
+                "cpu_us_per_row": best_total / args.rows * 1e6,
+                "cpu_us_per_row_serialization": best_encode / args.rows * 1e6,
+                "bytes": len(body),
+            }
+            print(f"{name:<14} {results[name]['cpu_us_per_row']:>7.2f} us/row total  "
+                  f"{results[name]['cpu_us_per_row_serialization']:>7.2f} us/row serialization")
+    await dispose_engines()
+
+    # Both paths must produce the same document
+    results["identical_output"] = bodies["orm_pydantic"] == bodies["rows_orjson"]
+    print(f"identical output: {results['identical_output']}")
+    return results
+
+
+def main():
+    args = parse_args()
+    os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///:memory:"
+    os.environ["DB_ECHO"] = "false"
+    results = asyncio.run(run(args))
+    path = write_results("serialization", vars(args), results, args.output)
+    print(f"\nResults written to {path}")
+
+
+if __name__ == "__main__":
+    main()
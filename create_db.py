@@ -1,23 +1,27 @@
+import argparse
 import asyncio
-from database import Base, engine
+from database import Base, dispose_engines, get_engine
 
 
-async def create_db():
-    async with engine.begin() as conn:
-        # Import your models here
-        from models import User
+async def create_db(drop: bool = False):
+    async with get_engine().begin() as conn:
+        # Importing the models registers their tables on Base.metadata
+        import models  # noqa: F401
 
-        # Drop all tables if they exist
-        print("Dropping all tables...")
-        await conn.run_sync(Base.metadata.drop_all)
-        print("Tables dropped.")
+        if drop:
+            # Drop all tables if they exist
+            print("Dropping all tables...")
+            await conn.run_sync(Base.metadata.drop_all)
+            print("Tables dropped.")
 
-        # Create all tables
-        print("Creating all tables...")
+        # Existing tables and their data are left as they are; only missing ones are created
+        print("Creating missing tables...")
         await conn.run_sync(Base.metadata.create_all)
         print("Tables created.")
 
-    await engine.dispose()
+    await dispose_engines()
 
 if __name__ == "__main__":
-    asyncio.run(create_db())
+    parser = argparse.ArgumentParser(description="Create the database tables")
+    parser.add_argument("--drop", action="store_true", help="drop and recreate every table, deleting all data")
+    asyncio.run(create_db(parser.parse_args().drop))
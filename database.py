@@ -1,16 +1,204 @@
-from sqlalchemy.ext.asyncio import create_async_engine
+import asyncio
+import time
+from typing import Optional
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.orm import DeclarativeBase
-from dotenv import load_dotenv
-import os
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from instrumentation import instrument_engine, record_pool_wait
+from settings import Settings, get_settings
 
-load_dotenv()
 
-DATABASE_URL = os.getenv("DATABASE_URL")
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
 
-engine = create_async_engine(
-    url=DATABASE_URL,
-    echo=True
-)
+    def observe_wait(self, seconds: float) -> None:
+        self.checkouts += 1
+        self.wait_seconds_total += seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def as_dict(self) -> dict:
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_max": self.wait_seconds_max,
+            "wait_seconds_avg": self.wait_seconds_total / self.checkouts if self.checkouts else 0.0,
+        }
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    # Times how long each checkout waits for a free (or new) connection
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        waited = time.perf_counter() - start
+        self.metrics.observe_wait(waited)
+        record_pool_wait(waited)
+        return record
+
+
+def create_engine(settings: Settings, url: Optional[str] = None) -> AsyncEngine:
+    url = make_url(url or settings.database_url)
+    options = {
+        "echo": settings.db_echo,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+        "pool_recycle": settings.db_pool_recycle,
+        "query_cache_size": settings.db_query_cache_size,
+    }
+    # In-memory SQLite uses a single static connection; there is no pool to size
+    if url.get_backend_name() != "sqlite" or url.database not in (None, "", ":memory:"):
+        options.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+        )
+    if url.get_driver_name() == "asyncpg":
+        options["connect_args"] = {"prepared_statement_cache_size": settings.db_statement_cache_size}
+    return create_async_engine(url, **options)
+
+
+def get_pool_status(engine: AsyncEngine) -> dict:
+    pool = engine.pool
+    status = getattr(pool, "metrics", PoolMetrics()).as_dict()
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        status.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            saturation=pool.checkedout() / capacity if capacity else 0.0,
+        )
+    return status
+
+
+def get_compiled_cache_status(engine: AsyncEngine) -> dict:
+    # None when the engine was created with query_cache_size=0
+    compiled_cache = engine.sync_engine._compiled_cache
+    if compiled_cache is None:
+        return {"entries": 0, "capacity": 0}
+    return {"entries": len(compiled_cache), "capacity": compiled_cache.capacity}
+
+
+class ReplicaSet:
+    # Round-robin over read replicas. A replica that fails to connect or
+    # drops its connection is skipped for retry_after seconds.
+    def __init__(self, engines: list[AsyncEngine], retry_after: float):
+        self.retry_after = retry_after
+        self.set_engines(engines)
+
+    def set_engines(self, engines: list[AsyncEngine]) -> None:
+        self.engines = engines
+        self._down_until = [0.0] * len(engines)
+        self._next = 0
+
+    def mark_down(self, index: int) -> None:
+        self._down_until[index] = time.monotonic() + self.retry_after
+
+    def report_error(self, replica: AsyncEngine, error: BaseException) -> None:
+        # Handlers re-raise database errors as HTTPException, so walk the chain
+        while error is not None:
+            if isinstance(error, OSError) or getattr(error, "connection_invalidated", False):
+                if replica in self.engines:
+                    self.mark_down(self.engines.index(replica))
+                return
+            error = error.__cause__ or error.__context__
+
+    def pick(self) -> Optional[AsyncEngine]:
+        now = time.monotonic()
+        for _ in range(len(self.engines)):
+            index = self._next % len(self.engines)
+            self._next += 1
+            if self._down_until[index] <= now:
+                return self.engines[index]
+        return None
+
+    async def check(self) -> None:
+        for index, replica in enumerate(self.engines):
+            try:
+                async with replica.connect() as conn:
+                    await conn.execute(text("SELECT 1"))
+                self._down_until[index] = 0.0
+            except Exception:
+                self.mark_down(index)
+
+    async def run_health_checks(self, interval: float) -> None:
+        while True:
+            await self.check()
+            await asyncio.sleep(interval)
+
+    def status(self) -> list[dict]:
+        now = time.monotonic()
+        return [{"url": replica.url.render_as_string(hide_password=True), "healthy": self._down_until[index] <= now}
+                for index, replica in enumerate(self.engines)]
+
+
+# retry_after is set from the settings when the engines are created
+replicas = ReplicaSet([], retry_after=0.0)
+_engine: Optional[AsyncEngine] = None
+_settings: Optional[Settings] = None
+
+
+def configure(config: Settings) -> None:
+    # Settings get_engine() falls back to; create_app passes the app's own
+    global _settings
+    _settings = config
+
+
+def get_engine(config: Optional[Settings] = None) -> AsyncEngine:
+    # Engines are created on first use in each worker process, normally from
+    # the app's lifespan with the app's settings, and never at import time.
+    global _engine
+    if _engine is None:
+        config = config or _settings or get_settings()
+        _engine = create_engine(config)
+        replicas.retry_after = config.db_replica_retry_after
+        replicas.set_engines([create_engine(config, url) for url in config.read_replica_urls])
+        for created in (_engine, *replicas.engines):
+            instrument_engine(created)
+    return _engine
+
+
+async def prewarm_pool(engine: AsyncEngine, connections: int) -> int:
+    # Opens connections concurrently and returns them to the pool, so the
+    # first requests don't pay for connection setup. Connections beyond
+    # pool_size would be discarded on return, so they are not opened.
+    pool = engine.pool
+    if not isinstance(pool, AsyncAdaptedQueuePool):
+        return 0
+    results = await asyncio.gather(*(engine.connect().start() for _ in range(min(connections, pool.size()))),
+                                   return_exceptions=True)
+    opened = [conn for conn in results if not isinstance(conn, BaseException)]
+    for conn in opened:
+        await conn.close()
+    # Unreachable databases are left to pre-ping, health checks and requests
+    return len(opened)
+
+
+async def dispose_engines() -> None:
+    global _engine
+    if _engine is None:
+        return
+    engines = [_engine, *replicas.engines]
+    _engine = None
+    replicas.set_engines([])
+    for disposed in engines:
+        await disposed.dispose()
 
 
 class Base(DeclarativeBase):
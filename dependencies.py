@@ -1,9 +1,143 @@
+import ipaddress
+import math
+import time
+from fastapi import HTTPException, Request, status
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
-from database import engine
+from database import get_engine, replicas
+from instrumentation import record_queue_wait
+from services.admission import AdmissionController, Overloaded, Priority, RateLimiter, RateLimitExceeded
+from settings import Settings
 
-async_session = async_sessionmaker(bind=engine, expire_on_commit=False)
+async_session = async_sessionmaker(expire_on_commit=False)
 
 
-async def get_session():
-    async with async_session() as session:
+def new_session() -> AsyncSession:
+    return async_session(bind=get_engine())
+
+
+class RecentWriters:
+    # Clients that wrote within the last `window` seconds read from the primary
+    def __init__(self, window: float):
+        self.window = window
+        self._expires: dict[str, float] = {}
+
+    def mark(self, client: str) -> None:
+        now = time.monotonic()
+        if len(self._expires) > 10_000:
+            self._expires = {key: expires for key, expires in self._expires.items() if expires > now}
+        self._expires[client] = now + self.window
+
+    def is_recent(self, client: str) -> bool:
+        expires = self._expires.get(client)
+        return expires is not None and expires > time.monotonic()
+
+
+class TrustedHosts:
+    # Addresses and networks in FORWARDED_ALLOW_IPS format; "*" trusts every host
+    def __init__(self, hosts: str):
+        entries = [host.strip() for host in hosts.split(",") if host.strip()]
+        self.everyone = "*" in entries
+        self.networks = []
+        self.names = set()
+        for entry in entries:
+            try:
+                self.networks.append(ipaddress.ip_network(entry, strict=False))
+            except ValueError:
+                self.names.add(entry)
+
+    def __contains__(self, host: str) -> bool:
+        if self.everyone or host in self.names:
+            return True
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return False
+        return any(address in network for network in self.networks)
+
+
+# Disabled until configure() applies the app's settings
+trusted_hosts = TrustedHosts("")
+recent_writers = RecentWriters(0.0)
+rate_limiter = RateLimiter(0.0, 0)
+admission = AdmissionController(0, 0.0)
+
+
+def configure(settings: Settings) -> None:
+    # Called by create_app; replaces the per-process state with the app's settings
+    global trusted_hosts, recent_writers, rate_limiter, admission
+    trusted_hosts = TrustedHosts(settings.server_forwarded_allow_ips)
+    recent_writers = RecentWriters(settings.db_read_your_writes_seconds)
+    rate_limiter = RateLimiter(settings.rate_limit_per_second, settings.rate_limit_burst)
+    admission = AdmissionController(settings.admission_limit, settings.admission_max_wait,
+                                    settings.admission_reserved)
+
+
+def _client_key(request: Request) -> str:
+    # request.client is already resolved from X-Forwarded-For by the server, so
+    # it is only a trusted host when a trusted proxy or sidecar sent the request
+    # itself. Only those may name the client with X-Client-Id; anyone else could
+    # pick a fresh id per request to dodge rate limits.
+    host = request.client.host if request.client else ""
+    if host in trusted_hosts:
+        return request.headers.get("x-client-id") or host
+    return host
+
+
+def _retry_after(seconds: float) -> dict:
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+
+def _admission(priority: Priority):
+    # Route dependencies run before the session is opened and exit after it is
+    # closed, so an admitted request holds its slot for as long as its session
+    async def admit(request: Request):
+        try:
+            rate_limiter.acquire(_client_key(request))
+            waited = await admission.acquire(priority)
+        except RateLimitExceeded as e:
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e),
+                                headers=_retry_after(e.retry_after))
+        except Overloaded as e:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e),
+                                headers=_retry_after(e.retry_after))
+        record_queue_wait(waited)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            admission.release(time.perf_counter() - start)
+
+    return admit
+
+
+# Point reads and single-row writes are admitted ahead of scans and bulk work
+admit_cheap = _admission(Priority.HIGH)
+admit_expensive = _admission(Priority.LOW)
+
+
+# AsyncSession only checks out a pooled connection when its first statement
+# runs, so requests answered by validation errors or the cache never take one.
+# Handlers depend on these with scope="function" to give the connection back
+# as soon as they return, before the response is serialized and sent.
+async def get_session(request: Request):
+    # Marked before the handler runs so the client's next read can't race the commit
+    if request.method not in ("GET", "HEAD"):
+        recent_writers.mark(_client_key(request))
+    async with new_session() as session:
         yield session
+
+
+async def get_read_session(request: Request):
+    recent = recent_writers.is_recent(_client_key(request))
+    replica = None if recent else replicas.pick()
+    # Without replicas (or with all of them down) reads go to the primary
+    async with async_session(bind=replica or get_engine()) as session:
+        # Tells UserService which cached state this read may use and store
+        session.info["read_your_writes"] = recent
+        session.info["replica"] = replica is not None
+        try:
+            yield session
+        except Exception as e:
+            if replica is not None:
+                replicas.report_error(replica, e)
+            raise
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _as_utc(value: datetime) -> datetime:
+    # SQLite hands back naive datetimes; they are stored in UTC
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+# A user's ETag is its id plus date_updated in microseconds, so it can be
+# compared in SQL without computing a hash of the row.
+def make_etag(user_id: int, date_updated: datetime) -> str:
+    return f'"{user_id}-{_micros(date_updated)}"'
+
+
+def _micros(value: datetime) -> int:
+    return (_as_utc(value) - EPOCH) // timedelta(microseconds=1)
+
+
+# The collection ETag is the user_events outbox high-water mark: every insert,
+# update and delete adds an event in the same transaction, and the newest id
+# is a primary key lookup instead of an aggregate over users.
+def make_collection_etag(version: Optional[int]) -> str:
+    return f'W/"users-{version or 0}"'
+
+
+def parse_etag(etag: str) -> Optional[tuple[int, datetime]]:
+    # Weak validators (W/"...") never match for If-Match
+    if len(etag) < 2 or not (etag.startswith('"') and etag.endswith('"')):
+        return None
+    try:
+        user_id, micros = etag[1:-1].split("-")
+        return int(user_id), EPOCH + timedelta(microseconds=int(micros))
+    except ValueError:
+        return None
+
+
+def split_etags(header: str) -> list[str]:
+    return [etag.strip() for etag in header.split(",") if etag.strip()]
+
+
+def format_http_date(value: datetime) -> str:
+    return format_datetime(_as_utc(value).astimezone(timezone.utc), usegmt=True)
+
+
+def is_not_modified(etag: str, last_modified: Optional[datetime], if_none_match: Optional[str],
+                    if_modified_since: Optional[str]) -> bool:
+    # If-None-Match uses weak comparison and takes precedence over If-Modified-Since
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        return etag.removeprefix("W/") in [tag.removeprefix("W/") for tag in split_etags(if_none_match)]
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        # HTTP dates have second precision
+        return _as_utc(last_modified).replace(microsecond=0) <= since
+    return False
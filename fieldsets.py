@@ -0,0 +1,40 @@
+from functools import lru_cache
+from operator import attrgetter
+from typing import Any, Callable, Optional
+from schemas import UserModel
+
+USER_FIELDS = tuple(UserModel.model_fields)
+
+
+class InvalidFieldsError(ValueError):
+    pass
+
+
+# `fields=id,username` selects a subset of UserModel's fields. Field sets are
+# returned in model order so equivalent requests share one projector and one
+# compiled statement.
+def parse_fields(fields: Optional[str]) -> Optional[tuple[str, ...]]:
+    if fields is None:
+        return None
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    if not requested:
+        raise InvalidFieldsError("No fields given")
+    unknown = requested.difference(USER_FIELDS)
+    if unknown:
+        raise InvalidFieldsError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(field for field in USER_FIELDS if field in requested)
+
+
+def with_fields(fields: tuple[str, ...], *required: str) -> tuple[str, ...]:
+    # Columns a handler needs for cursors or validators are loaded as well;
+    # the projector leaves them out of the response
+    return fields + tuple(field for field in required if field not in fields)
+
+
+@lru_cache(maxsize=128)
+def user_projector(fields: tuple[str, ...]) -> Callable[[Any], dict]:
+    # Works on rows, ORM instances and UserModel alike
+    getter = attrgetter(*fields)
+    if len(fields) == 1:
+        return lambda user: {fields[0]: getter(user)}
+    return lambda user: dict(zip(fields, getter(user)))
@@ -0,0 +1,227 @@
+import functools
+import time
+from contextvars import ContextVar
+from typing import Callable, Optional
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_statements = 0
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.queue_wait_seconds = 0.0
+        self.endpoint_end: Optional[float] = None
+        self.serialization_seconds = 0.0
+
+    def server_timing(self, total_seconds: float) -> str:
+        return ", ".join([
+            f"total;dur={total_seconds * 1000:.2f}",
+            f'db;desc="{self.sql_statements} queries";dur={self.db_seconds * 1000:.2f}',
+            f"pool;dur={self.pool_wait_seconds * 1000:.2f}",
+            f"queue;dur={self.queue_wait_seconds * 1000:.2f}",
+            f"serialize;dur={self.serialization_seconds * 1000:.2f}",
+        ])
+
+
+_current_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.request_latency: dict[tuple, Histogram] = {}
+        self.request_db_seconds: dict[tuple, float] = {}
+        self.request_serialization_seconds: dict[tuple, float] = {}
+        self.sql_statements_total = 0
+        self.sql_seconds_total = 0.0
+        self.compiled_cache_hits = 0
+        self.compiled_cache_misses = 0
+
+    def observe_request(self, method: str, route: str, status_code: int, total_seconds: float,
+                        timings: RequestTimings) -> None:
+        key = (method, route, str(status_code))
+        self.request_latency.setdefault(key, Histogram()).observe(total_seconds)
+        self.request_db_seconds[key] = self.request_db_seconds.get(key, 0.0) + timings.db_seconds
+        self.request_serialization_seconds[key] = (
+            self.request_serialization_seconds.get(key, 0.0) + timings.serialization_seconds)
+
+
+metrics = Metrics()
+
+
+def record_pool_wait(seconds: float) -> None:
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.pool_wait_seconds += seconds
+
+
+def record_queue_wait(seconds: float) -> None:
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.queue_wait_seconds += seconds
+
+
+def record_serialization(seconds: float) -> None:
+    # Responses encoded inside the endpoint; encoding after it returns is
+    # already timed by TimedRoute
+    timings = _current_timings.get()
+    if timings is not None and timings.endpoint_end is None:
+        timings.serialization_seconds += seconds
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    sync_engine = engine.sync_engine
+    if getattr(sync_engine, "_request_timings_installed", False):
+        return
+    sync_engine._request_timings_installed = True
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_start = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._query_start
+        metrics.sql_statements_total += 1
+        metrics.sql_seconds_total += elapsed
+        # Whether the statement's compiled form came from the engine's compiled cache
+        if context.cache_hit is CACHE_HIT:
+            metrics.compiled_cache_hits += 1
+        elif context.cache_hit is CACHE_MISS:
+            metrics.compiled_cache_misses += 1
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.sql_statements += 1
+            timings.db_seconds += elapsed
+
+
+def _timed_endpoint(endpoint: Callable) -> Callable:
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await endpoint(*args, **kwargs)
+        finally:
+            timings = _current_timings.get()
+            if timings is not None:
+                timings.endpoint_end = time.perf_counter()
+
+    return wrapper
+
+
+class TimedRoute(APIRoute):
+    # Marks when the endpoint returns so response validation and encoding
+    # can be attributed separately from the handler itself.
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, _timed_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            response = await handler(request)
+            timings = _current_timings.get()
+            if timings is not None and timings.endpoint_end is not None:
+                timings.serialization_seconds += time.perf_counter() - timings.endpoint_end
+            return response
+
+        return timed_handler
+
+
+class TimingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        token = _current_timings.set(timings)
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                total = time.perf_counter() - timings.start
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timings.server_timing(total).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_timings.reset(token)
+            route = scope.get("route")
+            metrics.observe_request(scope["method"], getattr(route, "path", "unmatched"), status_code,
+                                    time.perf_counter() - timings.start, timings)
+
+
+def _labels(method: str, route: str, status_code: str) -> str:
+    return f'method="{method}",route="{route}",status="{status_code}"'
+
+
+def render_prometheus(counters: dict[str, float], gauges: dict[str, float]) -> str:
+    lines = [
+        "# HELP http_request_duration_seconds Request latency",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for key, histogram in metrics.request_latency.items():
+        labels = _labels(*key)
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+        lines.append(f"http_request_duration_seconds_sum{{{labels}}} {histogram.sum}")
+        lines.append(f"http_request_duration_seconds_count{{{labels}}} {histogram.count}")
+
+    lines += [
+        "# HELP http_request_db_seconds_total Time spent executing SQL per route",
+        "# TYPE http_request_db_seconds_total counter",
+    ]
+    lines += [f"http_request_db_seconds_total{{{_labels(*key)}}} {value}"
+              for key, value in metrics.request_db_seconds.items()]
+    lines += [
+        "# HELP http_request_serialization_seconds_total Time spent validating and encoding responses per route",
+        "# TYPE http_request_serialization_seconds_total counter",
+    ]
+    lines += [f"http_request_serialization_seconds_total{{{_labels(*key)}}} {value}"
+              for key, value in metrics.request_serialization_seconds.items()]
+
+    lines += [
+        "# TYPE sql_statements_total counter",
+        f"sql_statements_total {metrics.sql_statements_total}",
+        "# TYPE sql_seconds_total counter",
+        f"sql_seconds_total {metrics.sql_seconds_total}",
+        "# TYPE sql_compiled_cache_hits_total counter",
+        f"sql_compiled_cache_hits_total {metrics.compiled_cache_hits}",
+        "# TYPE sql_compiled_cache_misses_total counter",
+        f"sql_compiled_cache_misses_total {metrics.compiled_cache_misses}",
+    ]
+    for name, value in counters.items():
+        lines += [f"# TYPE {name} counter", f"{name} {value}"]
+    for name, value in gauges.items():
+        lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
@@ -1,14 +1,74 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional
 from fastapi import FastAPI
-from routers import user_routes
+from settings import Settings, get_settings
 
-app = FastAPI(
-    title="Chalkboard Todo FastAPI Postgres Async App",
-    description="ToDo and Users Microservices using FastAPI, PostgreSQL, and SQLAlchemy Async",
-    docs_url="/",
-)
 
-app.include_router(user_routes.router)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    from database import dispose_engines, get_engine, prewarm_pool, replicas
+    from routers.user_routes import change_feed
+
+    settings = app.state.settings
+    # Runs once per worker process: each worker owns its engines and pools
+    engine = get_engine(settings)
+    if settings.db_pool_prewarm:
+        await asyncio.gather(*(prewarm_pool(warmed, settings.db_pool_prewarm)
+                               for warmed in (engine, *replicas.engines)))
+    tasks = [asyncio.create_task(change_feed.run())]
+    if replicas.engines:
+        tasks.append(asyncio.create_task(replicas.run_health_checks(settings.db_replica_health_check_interval)))
+    yield
+    change_feed.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # Close pooled connections instead of leaving them for the database to time out
+    await dispose_engines()
+
+
+def create_app(settings: Optional[Settings] = None) -> FastAPI:
+    # Routers (and the models, repositories and services behind them) are
+    # imported here rather than at module level, so importing main stays cheap
+    import database
+    import dependencies
+    from instrumentation import TimingMiddleware
+    from negotiation import ContentNegotiationMiddleware
+    from routers import user_routes, metrics_routes
+
+    app = FastAPI(
+        lifespan=lifespan,
+        title="Chalkboard Todo FastAPI Postgres Async App",
+        description="ToDo and Users Microservices using FastAPI, PostgreSQL, and SQLAlchemy Async",
+        docs_url="/",
+    )
+    settings = app.state.settings = settings or get_settings()
+    # Engines, admission control, the user cache and the change feed are per
+    # process; they take the settings of the app created last
+    database.configure(settings)
+    dependencies.configure(settings)
+    user_routes.configure(settings)
+
+    # Added first so it runs inside TimingMiddleware and compression counts toward Server-Timing
+    app.add_middleware(ContentNegotiationMiddleware, minimum_size=settings.compression_min_size,
+                       thread_minimum_size=settings.compression_thread_min_size,
+                       gzip_level=settings.compression_gzip_level, zstd_level=settings.compression_zstd_level)
+    app.add_middleware(TimingMiddleware)
+
+    app.include_router(user_routes.router)
+    app.include_router(metrics_routes.router)
+    return app
+
+
+def __getattr__(name: str):
+    # `uvicorn main:app` and `from main import app` build the default app on first use
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8001)
+    uvicorn.run(create_app(), host="127.0.0.1", port=8001)
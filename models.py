@@ -1,8 +1,28 @@
-from sqlalchemy import Column, String, DateTime, Integer, UniqueConstraint
-from datetime import datetime, timezone
+from sqlalchemy import Column, String, DateTime, Integer, BigInteger, JSON, DDL, Index, event, func
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 from database import Base
 
 
+class utcnow(FunctionElement):
+    # The database clock, so every worker stamps rows the same way
+    type = DateTime(timezone=True)
+    inherit_cache = True
+
+
+@compiles(utcnow)
+def _utcnow(element, compiler, **kw):
+    return "now()"
+
+
+@compiles(utcnow, "sqlite")
+def _sqlite_utcnow(element, compiler, **kw):
+    # CURRENT_TIMESTAMP only has whole seconds, which would give two updates
+    # in the same second one ETag. Padded to SQLAlchemy's own storage format
+    # so stored values compare correctly as strings.
+    return "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -12,11 +32,45 @@ class User(Base):
     first_name = Column(String, nullable=False)
     last_name = Column(String, nullable=False)
 
-    # Dynamic default and onupdate in UTC timezone
-    date_created = Column(DateTime(timezone=True),
-                          default=datetime.now(timezone.utc))
-    date_updated = Column(DateTime(timezone=True), default=datetime.now(
-        timezone.utc), onupdate=datetime.now(timezone.utc))
+    # Set by the database; UPDATE statements that don't set date_updated get utcnow() as well
+    date_created = Column(DateTime(timezone=True), server_default=utcnow(), index=True)
+    date_updated = Column(DateTime(timezone=True), server_default=utcnow(), onupdate=utcnow(), index=True)
+
+    # Fetch the server defaults with INSERT ... RETURNING instead of expiring them
+    __mapper_args__ = {"eager_defaults": True}
 
     def __repr__(self):
         return f"<User {self.username} at {self.date_created}>"
+
+
+class UserEvent(Base):
+    # Transactional outbox: written in the same transaction as the change to users
+    __tablename__ = "user_events"
+    # Without AUTOINCREMENT SQLite reuses ids freed by pruning, which would rewind cursors
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    user_id = Column(Integer, nullable=False)
+    type = Column(String, nullable=False)
+    # Snapshot of the user after the change, None for deletes
+    payload = Column(JSON, nullable=True)
+    date_created = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), index=True)
+
+
+# Trigram indexes need the pg_trgm extension on Postgres
+event.listen(User.__table__, "before_create",
+             DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"))
+
+# Case-insensitive exact and prefix lookups (lower(col) = :v, lower(col) LIKE 'v%')
+Index("ix_users_username_lower", func.lower(User.username).label("username_lower"),
+      postgresql_ops={"username_lower": "text_pattern_ops"})
+Index("ix_users_email_lower", func.lower(User.email).label("email_lower"),
+      postgresql_ops={"email_lower": "text_pattern_ops"})
+
+# Substring and suffix matches (email domain, name search) use trigram GIN indexes
+Index("ix_users_email_trgm", func.lower(User.email).label("email_lower"),
+      postgresql_using="gin", postgresql_ops={"email_lower": "gin_trgm_ops"}).ddl_if(dialect="postgresql")
+Index("ix_users_first_name_trgm", func.lower(User.first_name).label("first_name_lower"),
+      postgresql_using="gin", postgresql_ops={"first_name_lower": "gin_trgm_ops"}).ddl_if(dialect="postgresql")
+Index("ix_users_last_name_trgm", func.lower(User.last_name).label("last_name_lower"),
+      postgresql_using="gin", postgresql_ops={"last_name_lower": "gin_trgm_ops"}).ddl_if(dialect="postgresql")
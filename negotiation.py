@@ -0,0 +1,204 @@
+import asyncio
+import gzip
+import re
+from typing import Callable, Optional
+import orjson
+from starlette.datastructures import Headers, MutableHeaders
+from etags import split_etags
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+COMPRESSIBLE_TYPES = ("application/json", MSGPACK_MEDIA_TYPE, "application/x-ndjson", "text/")
+# A strong ETag belongs to one representation, so re-encoded bodies get a
+# suffix naming theirs: "1-123" becomes "1-123-msgpack-zstd"
+_REPRESENTATION_SUFFIX = re.compile(r'-((?:msgpack-)?(?:zstd|gzip)|msgpack)"$')
+_CONDITIONAL_HEADERS = (b"if-none-match", b"if-match")
+
+
+def _parse_qualities(header: str) -> dict[str, float]:
+    qualities = {}
+    for item in header.split(","):
+        value, *params = [part.strip() for part in item.split(";")]
+        if not value:
+            continue
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        qualities[value.lower()] = quality
+    return qualities
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    qualities = _parse_qualities(accept_encoding)
+    wildcard = qualities.get("*", 0.0)
+    supported = ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+    # zstd wins ties: it compresses about as well as gzip for a fraction of the CPU
+    best = max(supported, key=lambda encoding: qualities.get(encoding, wildcard))
+    return best if qualities.get(best, wildcard) > 0 else None
+
+
+def wants_msgpack(accept: str) -> bool:
+    # Wildcards don't select MessagePack; only clients that name it get it
+    if msgpack is None:
+        return False
+    qualities = _parse_qualities(accept)
+    quality = max(qualities.get(MSGPACK_MEDIA_TYPE, 0.0), qualities.get("application/x-msgpack", 0.0))
+    json_quality = qualities.get("application/json", qualities.get("application/*", qualities.get("*/*", 0.0)))
+    return quality > 0 and quality >= json_quality
+
+
+def _tag_representation(etag: str, representation: str) -> str:
+    if not representation or not etag.endswith('"'):
+        return etag
+    return f'{etag[:-1]}-{representation}"'
+
+
+def _strip_representations(scope, representations: set[str]) -> dict[str, str]:
+    # Routes compare conditional headers with their own ETags, so the suffixes
+    # are removed on the way in (in place: outer middleware reads the route
+    # back from the scope). Returns each stripped tag mapped to the one the
+    # client sent, for echoing back on a 304. Tags of representations this
+    # request wouldn't get are left alone, so they never match.
+    client_tags = {}
+    headers = []
+    for name, value in scope["headers"]:
+        if name in _CONDITIONAL_HEADERS:
+            tags = []
+            for tag in split_etags(value.decode("latin-1")):
+                match = _REPRESENTATION_SUFFIX.search(tag)
+                stripped = tag[:match.start()] + '"' if match and match.group(1) in representations else tag
+                client_tags.setdefault(stripped.removeprefix("W/"), tag)
+                tags.append(stripped)
+            value = ", ".join(tags).encode("latin-1")
+        headers.append((name, value))
+    scope["headers"] = headers
+    return client_tags
+
+
+def _add_vary(headers: MutableHeaders) -> None:
+    # Caches must key negotiable responses on both headers, even when this
+    # one went out as plain JSON
+    headers.add_vary_header("Accept")
+    headers.add_vary_header("Accept-Encoding")
+
+
+class ContentNegotiationMiddleware:
+    # Transcodes buffered JSON responses to MessagePack when the client prefers
+    # it and compresses them with the best encoding it accepts. Streamed responses
+    # (NDJSON, server-sent events) pass through untouched.
+    def __init__(self, app, minimum_size: int = 1024, thread_minimum_size: int = 64 * 1024,
+                 gzip_level: int = 6, zstd_level: int = 3):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.thread_minimum_size = thread_minimum_size
+        self.gzip_level = gzip_level
+        self.zstd_level = zstd_level
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        encoding = negotiate_encoding(request_headers.get("accept-encoding", ""))
+        use_msgpack = wants_msgpack(request_headers.get("accept", ""))
+        representations = {"msgpack"} if use_msgpack else set()
+        if encoding is not None:
+            representations |= {encoding, f"msgpack-{encoding}"} if use_msgpack else {encoding}
+        client_tags = _strip_representations(scope, representations)
+        start_message = None
+
+        async def send_negotiated(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                if message["status"] == 304:
+                    message = self._not_modified(message, client_tags)
+                # Streamed responses carry no Content-Length; their headers go out at once
+                elif "content-length" in Headers(raw=message["headers"]):
+                    start_message = message
+                    return
+            elif message["type"] == "http.response.body" and start_message is not None:
+                start, start_message = start_message, None
+                if message.get("more_body", False):
+                    await send(start)
+                else:
+                    headers = MutableHeaders(raw=list(start["headers"]))
+                    body = await self._negotiate(message.get("body", b""), start["status"], headers, encoding,
+                                                 use_msgpack)
+                    await send({**start, "headers": headers.raw})
+                    message = {**message, "body": body}
+            await send(message)
+
+        await self.app(scope, receive, send_negotiated)
+
+    def _not_modified(self, message, client_tags: dict[str, str]):
+        # Echo the representation's ETag the client already holds
+        headers = MutableHeaders(raw=list(message["headers"]))
+        _add_vary(headers)
+        etag = headers.get("etag")
+        if etag is not None:
+            headers["etag"] = client_tags.get(etag.removeprefix("W/"), etag)
+        return {**message, "headers": headers.raw}
+
+    async def _negotiate(self, body: bytes, status_code: int, headers: MutableHeaders, encoding: Optional[str],
+                         use_msgpack: bool) -> bytes:
+        content_type = headers.get("content-type", "")
+        if not content_type.startswith(COMPRESSIBLE_TYPES):
+            return body
+        _add_vary(headers)
+        if "content-encoding" in headers or not body:
+            return body
+        # Errors stay JSON, whatever the client prefers for data
+        transcode = use_msgpack and content_type.startswith("application/json") and 200 <= status_code < 300
+        compress = encoding is not None and len(body) >= self.minimum_size
+        if not transcode and not compress:
+            return body
+
+        if not compress:
+            encoding = None
+        # Large bodies are re-encoded in a worker thread so the loop keeps serving requests
+        if len(body) >= self.thread_minimum_size:
+            encoded, content_encoding = await asyncio.to_thread(self._encode, body, transcode, encoding)
+        else:
+            encoded, content_encoding = self._encode(body, transcode, encoding)
+        representation = []
+        if transcode:
+            headers["content-type"] = MSGPACK_MEDIA_TYPE
+            representation.append("msgpack")
+        if content_encoding is not None:
+            headers["content-encoding"] = content_encoding
+            representation.append(content_encoding)
+        if "etag" in headers:
+            headers["etag"] = _tag_representation(headers["etag"], "-".join(representation))
+        headers["content-length"] = str(len(encoded))
+        return encoded
+
+    def _encode(self, body: bytes, transcode: bool, encoding: Optional[str]) -> tuple[bytes, Optional[str]]:
+        if transcode:
+            # orjson parsing plus msgpack's C packer beats encoding rows to MessagePack directly
+            body = msgpack.packb(orjson.loads(body))
+        if encoding is None:
+            return body, None
+        compressed = self._compressor(encoding)(body)
+        if len(compressed) >= len(body):
+            return body, None
+        return compressed, encoding
+
+    def _compressor(self, encoding: str) -> Callable[[bytes], bytes]:
+        if encoding == "zstd":
+            # Compressor objects aren't safe to share between threads
+            return lambda body: zstandard.ZstdCompressor(level=self.zstd_level).compress(body)
+        return lambda body: gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
@@ -0,0 +1,43 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+# Cursors are opaque to clients: a url-safe base64 encoded JSON list holding
+# the keyset values of the last row on the previous page.
+def encode_cursor(*values) -> str:
+    raw = json.dumps(list(values), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> list:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursorError("Invalid cursor")
+    if not isinstance(values, list) or not values:
+        raise InvalidCursorError("Invalid cursor")
+    return values
+
+
+def decode_id_cursor(cursor: str) -> int:
+    values = decode_cursor(cursor)
+    if len(values) != 1 or type(values[0]) is not int:
+        raise InvalidCursorError("Invalid cursor")
+    return values[0]
+
+
+def decode_timestamp_cursor(cursor: str) -> tuple[datetime, int]:
+    values = decode_cursor(cursor)
+    if len(values) != 2 or type(values[0]) is not str or type(values[1]) is not int:
+        raise InvalidCursorError("Invalid cursor")
+    try:
+        return datetime.fromisoformat(values[0]), values[1]
+    except ValueError:
+        raise InvalidCursorError("Invalid cursor")
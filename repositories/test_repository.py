@@ -1,8 +1,13 @@
 import unittest
-from unittest.mock import patch, AsyncMock
+from unittest.mock import patch, AsyncMock, MagicMock
 from repositories.user_repository import UserRepository
+from models import UserEvent
 from schemas import UserCreateModel, UserUpdateModel
+from datetime import datetime, timezone
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.schema import CreateTable
+from fastapi import HTTPException
 
 
 class TestUserRepository(unittest.IsolatedAsyncioTestCase):
@@ -151,6 +156,235 @@ class TestUserRepository(unittest.IsolatedAsyncioTestCase):
 
         self.assertIsNone(result)
 
+    async def test_search_uses_lower_predicates(self):
+        session = AsyncMock(spec=AsyncSession)
+        session.execute.return_value = MagicMock(scalars=MagicMock(return_value=MagicMock(all=MagicMock(return_value=[]))))
+
+        user_repository = UserRepository()
+        await user_repository.search(session, 11, after_id=5, username_prefix='Jo_', email_domain='Example.com')
+
+        statement = session.execute.call_args.args[0].params(session.execute.call_args.args[1])
+        compiled = statement.compile(compile_kwargs={'literal_binds': True})
+        sql = str(compiled)
+        self.assertIn("lower(users.username) LIKE 'jo\\_%'", sql)
+        self.assertIn("lower(users.email) LIKE '%@example.com'", sql)
+        self.assertIn('users.id > 5', sql)
+
+    async def test_page_fields_select_only_those_columns(self):
+        session = AsyncMock(spec=AsyncSession)
+        session.execute.return_value = MagicMock(all=MagicMock(return_value=[]))
+
+        user_repository = UserRepository()
+        await user_repository.get_page(session, 11, after_id=5, fields=('id', 'username'))
+
+        statement = session.execute.call_args.args[0]
+        sql = str(statement.compile())
+        self.assertTrue(sql.startswith('SELECT users.id, users.username \nFROM users'))
+        self.assertEqual(session.execute.call_args.args[1], {'limit': 11, 'after_id': 5})
+        session.execute.return_value.all.assert_called_once()
+
+    async def test_get_collection_version_reads_outbox_high_water_mark(self):
+        session = AsyncMock(spec=AsyncSession)
+        session.execute.return_value = MagicMock(scalar_one=MagicMock(return_value=42))
+
+        user_repository = UserRepository()
+        self.assertEqual(await user_repository.get_collection_version(session), 42)
+
+        sql = str(session.execute.call_args.args[0].compile())
+        self.assertEqual(sql, 'SELECT max(user_events.id) AS max_1 \nFROM user_events')
+
+    async def test_get_updated_since(self):
+        session = AsyncMock(spec=AsyncSession)
+        session.execute.return_value = MagicMock(all=MagicMock(return_value=[]))
+        since = datetime(2024, 7, 15, 12, tzinfo=timezone.utc)
+
+        user_repository = UserRepository()
+        await user_repository.get_updated_since(session, since, 101, fields=('id', 'date_updated'))
+
+        statement = session.execute.call_args.args[0]
+        sql = str(statement.compile())
+        self.assertIn('WHERE users.date_updated >= :since ORDER BY users.date_updated, users.id', sql)
+        self.assertEqual(session.execute.call_args.args[1], {'since': since, 'limit': 101})
+
+    async def test_get_updated_since_after_cursor(self):
+        session = AsyncMock(spec=AsyncSession)
+        session.execute.return_value = MagicMock(all=MagicMock(return_value=[]))
+        since = datetime(2024, 7, 15, 12, tzinfo=timezone.utc)
+
+        user_repository = UserRepository()
+        await user_repository.get_updated_since(session, since, 101, after_id=7)
+
+        statement = session.execute.call_args.args[0]
+        sql = str(statement.compile())
+        self.assertIn('WHERE users.date_updated >= :since AND (users.date_updated > :since OR users.id > :after_id)',
+                      sql)
+        self.assertEqual(session.execute.call_args.args[1], {'since': since, 'limit': 101, 'after_id': 7})
+
+    async def test_update_stamps_date_updated_in_database(self):
+        session = AsyncMock(spec=AsyncSession)
+        session.execute.return_value = MagicMock(
+            scalars=MagicMock(return_value=MagicMock(one_or_none=MagicMock(return_value=MagicMock(id=1)))))
+
+        user_repository = UserRepository()
+        await user_repository.update(session, 1, {'first_name': 'Updated'})
+
+        statement = session.execute.call_args.args[0]
+        self.assertIn('date_updated=now()', str(statement.compile(dialect=postgresql.dialect())))
+        self.assertIn("date_updated=strftime('%Y-%m-%d %H:%M:%f000', 'now')",
+                      str(statement.compile(dialect=sqlite.dialect())))
+
+    async def test_get_by_id_reuses_statement(self):
+        session = AsyncMock(spec=AsyncSession)
+        session.execute.return_value = MagicMock(scalars=MagicMock(return_value=MagicMock(one=MagicMock())))
+
+        user_repository = UserRepository()
+        await user_repository.get_by_id(session, 1)
+        await user_repository.get_by_id(session, 2)
+
+        first, second = session.execute.call_args_list
+        # Same construct each time, so its cache key is generated only once
+        self.assertIs(first.args[0], second.args[0])
+        self.assertEqual([first.args[1], second.args[1]], [{'user_id': 1}, {'user_id': 2}])
+
+    async def test_update_single_statement(self):
+        updated_user = MagicMock(id=1, username='updateduser')
+        session = AsyncMock(spec=AsyncSession)
+        session.execute.return_value = MagicMock(
+            scalars=MagicMock(return_value=MagicMock(one_or_none=MagicMock(return_value=updated_user))))
+
+        user_repository = UserRepository()
+        actual_user = await user_repository.update(session, 1, {'username': 'updateduser'})
+
+        self.assertIs(actual_user, updated_user)
+        session.execute.assert_awaited_once()
+        self.assertIn('RETURNING', str(session.execute.call_args.args[0]).upper())
+        session.commit.assert_awaited_once()
+
+    async def test_update_single_statement_not_found(self):
+        session = AsyncMock(spec=AsyncSession)
+        session.execute.return_value = MagicMock(
+            scalars=MagicMock(return_value=MagicMock(one_or_none=MagicMock(return_value=None))))
+
+        user_repository = UserRepository()
+        with self.assertRaises(HTTPException) as context:
+            await user_repository.update(session, 1, {'username': 'updateduser'})
+
+        self.assertEqual(context.exception.status_code, 404)
+        session.commit.assert_not_awaited()
+
+    async def test_delete_single_statement(self):
+        session = AsyncMock(spec=AsyncSession)
+        session.execute.return_value = MagicMock(scalar_one_or_none=MagicMock(return_value=1))
+
+        user_repository = UserRepository()
+        result = await user_repository.delete(session, 1)
+
+        self.assertIsNone(result)
+        session.execute.assert_awaited_once()
+        session.commit.assert_awaited_once()
+
+    async def test_delete_records_event_in_same_transaction(self):
+        session = AsyncMock(spec=AsyncSession)
+        session.execute.return_value = MagicMock(scalar_one_or_none=MagicMock(return_value=1))
+        calls = MagicMock()
+        session.add.side_effect = lambda event: calls.add(event)
+        session.commit.side_effect = lambda: calls.commit()
+
+        user_repository = UserRepository()
+        await user_repository.delete(session, 1)
+
+        self.assertEqual([call[0] for call in calls.mock_calls], ['add', 'commit'])
+        event = session.add.call_args.args[0]
+        self.assertEqual((event.user_id, event.type, event.payload), (1, 'deleted', None))
+
+    async def test_event_ids_are_not_reused_on_sqlite(self):
+        ddl = str(CreateTable(UserEvent.__table__).compile(dialect=sqlite.dialect()))
+
+        self.assertIn('AUTOINCREMENT', ddl)
+
+    async def test_delete_single_statement_not_found(self):
+        session = AsyncMock(spec=AsyncSession)
+        session.execute.return_value = MagicMock(scalar_one_or_none=MagicMock(return_value=None))
+
+        user_repository = UserRepository()
+        with self.assertRaises(HTTPException) as context:
+            await user_repository.delete(session, 1)
+
+        self.assertEqual(context.exception.status_code, 404)
+        session.commit.assert_not_awaited()
+
+    async def test_bulk_upsert_reports_conflicts(self):
+        existing = [
+            MagicMock(id=1, username='taken', email='taken@example.com'),
+            MagicMock(id=2, username='other', email='other@example.com'),
+        ]
+        written = [MagicMock(id=3, username='new')]
+        session = AsyncMock(spec=AsyncSession)
+        session.get_bind = MagicMock(return_value=MagicMock(dialect=MagicMock()))
+        session.get_bind.return_value.dialect.name = 'sqlite'
+        session.execute.side_effect = [MagicMock(all=MagicMock(return_value=existing)),
+                                       MagicMock(all=MagicMock(return_value=written))]
+        rows = [
+            {'username': 'new', 'email': 'new@example.com', 'first_name': 'N', 'last_name': 'U'},
+            {'username': 'taken', 'email': 'taken2@example.com', 'first_name': 'T', 'last_name': 'U'},
+            {'username': 'fresh', 'email': 'other@example.com', 'first_name': 'F', 'last_name': 'U'},
+            {'username': 'new', 'email': 'new2@example.com', 'first_name': 'N', 'last_name': 'U'},
+        ]
+
+        user_repository = UserRepository()
+        results = await user_repository.bulk_upsert(session, rows)
+
+        self.assertEqual([(result['status'], result['reason']) for result in results], [
+            ('inserted', None),
+            ('skipped', 'Username already exists'),
+            ('conflict', 'Email already exists'),
+            ('conflict', 'Duplicate username in request'),
+        ])
+        self.assertEqual(results[0]['id'], 3)
+        self.assertEqual(session.execute.call_count, 2)
+        events = session.add_all.call_args.args[0]
+        self.assertEqual([(event.user_id, event.type) for event in events], [(3, 'created')])
+        session.commit.assert_awaited_once()
+
+    async def test_get_many_binds_ids_as_array_on_postgres(self):
+        for dialect, dialect_module, expected in [
+            ('postgresql', postgresql, 'WHERE users.id = ANY (%(user_ids)s::INTEGER[])'),
+            ('sqlite', sqlite, 'WHERE users.id IN (__[POSTCOMPILE_user_ids])'),
+        ]:
+            session = AsyncMock(spec=AsyncSession)
+            session.get_bind = MagicMock(return_value=MagicMock(dialect=MagicMock()))
+            session.get_bind.return_value.dialect.name = dialect
+            session.execute.return_value = MagicMock(scalars=MagicMock(return_value=MagicMock(all=MagicMock())))
+
+            user_repository = UserRepository()
+            await user_repository.get_many(session, [3, 1])
+
+            statement = session.execute.call_args.args[0]
+            self.assertIn(expected, str(statement.compile(dialect=dialect_module.dialect())))
+            self.assertEqual(session.execute.call_args.args[1], {'user_ids': [3, 1]})
+
+    async def test_bulk_update_single_statement_per_chunk(self):
+        session = AsyncMock(spec=AsyncSession)
+        session.get_bind = MagicMock(return_value=MagicMock(dialect=MagicMock()))
+        session.get_bind.return_value.dialect.name = 'postgresql'
+        session.execute.return_value = MagicMock(all=MagicMock(return_value=[MagicMock(id=7), MagicMock(id=9)]))
+
+        user_repository = UserRepository()
+        ids = await user_repository.bulk_update(session, {'email_domain': 'new.com'}, 500, after_id=5,
+                                                filters={'email_domain': 'old.com'})
+
+        self.assertEqual(ids, [7, 9])
+        session.execute.assert_awaited_once()
+        sql = str(session.execute.call_args.args[0].compile(
+            dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+        self.assertIn('WHERE users.id IN (SELECT users.id', sql)
+        self.assertIn("split_part(users.email, '@', 1)", sql)
+        self.assertIn('users.id > 5', sql)
+        self.assertIn('RETURNING', sql)
+        events = session.add_all.call_args.args[0]
+        self.assertEqual([(event.user_id, event.type) for event in events], [(7, 'updated'), (9, 'updated')])
+        session.commit.assert_awaited_once()
+
 
 if __name__ == '__main__':
     unittest.main()
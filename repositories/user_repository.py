@@ -1,54 +1,428 @@
+from functools import lru_cache
+from typing import AsyncIterator, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
-from models import User
-from sqlalchemy import select
+from models import User, UserEvent, utcnow
+from sqlalchemy import Date, Integer, Row, Select, String, any_, bindparam, cast, select, text, update, delete, func, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
-from datetime import datetime, timezone
+from datetime import datetime
 from fastapi import HTTPException, status
 
 
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _search_conditions(username: Optional[str] = None, username_prefix: Optional[str] = None,
+                       email: Optional[str] = None, email_domain: Optional[str] = None,
+                       name: Optional[str] = None) -> list:
+    # Every predicate matches one of the lower() indexes defined in models
+    conditions = []
+    if username is not None:
+        conditions.append(func.lower(User.username) == username.lower())
+    if username_prefix is not None:
+        conditions.append(
+            func.lower(User.username).like(_escape_like(username_prefix.lower()) + "%", escape="\\"))
+    if email is not None:
+        conditions.append(func.lower(User.email) == email.lower())
+    if email_domain is not None:
+        conditions.append(
+            func.lower(User.email).like("%@" + _escape_like(email_domain.lower()), escape="\\"))
+    if name is not None:
+        pattern = "%" + _escape_like(name.lower()) + "%"
+        conditions.append(or_(
+            func.lower(User.first_name).like(pattern, escape="\\"),
+            func.lower(User.last_name).like(pattern, escape="\\"),
+        ))
+    return conditions
+
+
+def _user_columns(fields: Optional[tuple[str, ...]] = None) -> list:
+    columns = User.__table__.columns
+    if fields is None:
+        return list(columns)
+    return [columns[field] for field in fields]
+
+
+# Hot-path statements are built once with bound parameters. SQLAlchemy
+# memoizes a construct's cache key, so reusing one skips both building the
+# statement and generating its key on every call; the compiled form is then
+# found in the engine's compiled cache (and, on asyncpg, the server-side
+# prepared statement in the connection's statement cache).
+_USER_BY_ID = select(User).where(User.id == bindparam("user_id"))
+_USER_VERSION = select(User.date_updated).where(User.id == bindparam("user_id"))
+_USERS_BY_IDS = select(User).where(User.id.in_(bindparam("user_ids", expanding=True)))
+# An expanding IN renders one placeholder per id, so every batch size is a
+# different statement to Postgres. Binding the ids as one array keeps a single
+# prepared statement.
+_USERS_BY_ID_ARRAY = select(User).where(User.id == any_(bindparam("user_ids", type_=postgresql.ARRAY(Integer))))
+_COLLECTION_VERSION = select(func.max(UserEvent.id))
+_COUNT = select(func.count()).select_from(User)
+_DELETE_USER = delete(User).where(User.id == bindparam("user_id")).returning(User.id)
+_EVENTS = (
+    select(UserEvent.id, UserEvent.user_id, UserEvent.type, UserEvent.payload, UserEvent.date_created)
+    .where(UserEvent.id > bindparam("after_id"))
+    .order_by(UserEvent.id)
+    .limit(bindparam("limit", type_=Integer))
+)
+_EVENTS_UP_TO = _EVENTS.where(UserEvent.id <= bindparam("up_to"))
+
+
+# Field sets come in canonical order, so each one maps to a single statement
+@lru_cache(maxsize=256)
+def _all_statement(fields: Optional[tuple[str, ...]]) -> Select:
+    # Plain row tuples; hydrating ORM instances costs more than the query
+    return select(*_user_columns(fields)).order_by(User.id)
+
+
+@lru_cache(maxsize=256)
+def _updated_statement(fields: Optional[tuple[str, ...]], after: bool) -> Select:
+    # Range scan on the date_updated index, oldest change first
+    statement = (
+        select(*_user_columns(fields))
+        .where(User.date_updated >= bindparam("since"))
+        .order_by(User.date_updated, User.id)
+        .limit(bindparam("limit", type_=Integer))
+    )
+    if after:
+        # since is the cursor's timestamp, so this is (date_updated, id) > (since, after_id)
+        statement = statement.where(or_(User.date_updated > bindparam("since"), User.id > bindparam("after_id")))
+    return statement
+
+
+@lru_cache(maxsize=256)
+def _page_statement(fields: Optional[tuple[str, ...]], after: bool) -> Select:
+    # A field set loads only those columns, as rows instead of ORM instances
+    statement = select(User) if fields is None else select(*_user_columns(fields))
+    statement = statement.order_by(User.id).limit(bindparam("limit", type_=Integer))
+    if after:
+        statement = statement.where(User.id > bindparam("after_id"))
+    return statement
+
+
+def _page_params(limit: int, after_id: Optional[int]) -> dict:
+    params = {"limit": limit}
+    if after_id is not None:
+        params["after_id"] = after_id
+    return params
+
+
+def _snapshot(user) -> dict:
+    snapshot = {}
+    for column in User.__table__.columns:
+        value = getattr(user, column.name)
+        snapshot[column.name] = value.isoformat() if isinstance(value, datetime) else value
+    return snapshot
+
+
+def _event(event_type: str, user_id: int, user=None) -> UserEvent:
+    return UserEvent(user_id=user_id, type=event_type, payload=_snapshot(user) if user is not None else None)
+
+
 class UserRepository:
     async def add(self, session: AsyncSession, user: User) -> User:
         session.add(user)
+        await session.flush()
+        session.add(_event("created", user.id, user))
         await session.commit()
         return user
 
+    async def bulk_upsert(self, session: AsyncSession, rows: list[dict], update_existing: bool = False) -> list[dict]:
+        # One multi-row INSERT ... ON CONFLICT (username) and one commit per call.
+        # Returns a result per input row, in input order.
+        usernames = [row["username"] for row in rows]
+        emails = [row["email"] for row in rows]
+        statement = select(User.id, User.username, User.email).filter(
+            or_(User.username.in_(usernames), User.email.in_(emails)))
+        existing = (await session.execute(statement)).all()
+        id_by_username = {user.username: user.id for user in existing}
+        username_by_email = {user.email: user.username for user in existing}
+
+        results = []
+        to_write = []
+        seen_usernames = set()
+        seen_emails = set()
+        for row in rows:
+            result = {"username": row["username"], "id": None, "reason": None}
+            results.append(result)
+            owner = username_by_email.get(row["email"])
+            if row["username"] in seen_usernames:
+                result.update(status="conflict", reason="Duplicate username in request")
+            elif row["email"] in seen_emails:
+                result.update(status="conflict", reason="Duplicate email in request")
+            elif owner is not None and owner != row["username"]:
+                result.update(status="conflict", reason="Email already exists")
+            elif row["username"] in id_by_username and not update_existing:
+                result.update(status="skipped", id=id_by_username[row["username"]],
+                              reason="Username already exists")
+            else:
+                result["status"] = "updated" if row["username"] in id_by_username else "inserted"
+                to_write.append(row)
+            seen_usernames.add(row["username"])
+            seen_emails.add(row["email"])
+
+        if not to_write:
+            return results
+
+        dialect = session.get_bind().dialect.name
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        statement = insert(User).values(to_write)
+        if update_existing:
+            statement = statement.on_conflict_do_update(
+                index_elements=[User.username],
+                set_={
+                    "email": statement.excluded.email,
+                    "first_name": statement.excluded.first_name,
+                    "last_name": statement.excluded.last_name,
+                    # ON CONFLICT DO UPDATE doesn't apply the column's onupdate
+                    "date_updated": utcnow(),
+                })
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=[User.username])
+        statement = statement.returning(*User.__table__.columns)
+
+        try:
+            written = (await session.execute(statement)).all()
+            statuses = {result["username"]: result["status"] for result in results
+                        if result["status"] in ("inserted", "updated")}
+            session.add_all([
+                _event("created" if statuses[user.username] == "inserted" else "updated", user.id, user)
+                for user in written
+            ])
+            await session.commit()
+        except IntegrityError:
+            # A concurrent writer claimed one of the emails; report the whole chunk
+            await session.rollback()
+            for result in results:
+                if result["status"] in ("inserted", "updated"):
+                    result.update(status="conflict", reason="Unique constraint violation")
+            return results
+
+        written_ids = {user.username: user.id for user in written}
+        for result in results:
+            if result["status"] not in ("inserted", "updated"):
+                continue
+            if result["username"] in written_ids:
+                result["id"] = written_ids[result["username"]]
+            else:
+                # Inserted by a concurrent writer after the existence check
+                result.update(status="skipped", reason="Username already exists")
+        return results
+
     async def get_by_id(self, session: AsyncSession, user_id: int) -> User:
-        statement = select(User).filter(User.id == user_id)
-        result = await session.execute(statement)
+        result = await session.execute(_USER_BY_ID, {"user_id": user_id})
         try:
             return result.scalars().one()
         except NoResultFound:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    async def get_all(self, session: AsyncSession) -> list[User]:
-        statement = select(User).order_by(User.id)
+    async def get_version(self, session: AsyncSession, user_id: int) -> Optional[datetime]:
+        result = await session.execute(_USER_VERSION, {"user_id": user_id})
+        return result.scalar_one_or_none()
+
+    async def get_collection_version(self, session: AsyncSession) -> Optional[int]:
+        result = await session.execute(_COLLECTION_VERSION)
+        return result.scalar_one()
+
+    async def count(self, session: AsyncSession) -> int:
+        result = await session.execute(_COUNT)
+        return result.scalar_one()
+
+    async def estimate_count(self, session: AsyncSession) -> Optional[int]:
+        # Row estimate maintained by VACUUM/ANALYZE on Postgres; None elsewhere
+        # or when the table has never been analyzed
+        if session.get_bind().dialect.name != "postgresql":
+            return None
+        result = await session.execute(
+            text("SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+            {"table": User.__tablename__})
+        estimate = result.scalar_one_or_none()
+        if estimate is None or estimate < 0:
+            return None
+        return int(estimate)
+
+    async def count_created_per_day(self, session: AsyncSession, since: datetime) -> list[Row]:
+        if session.get_bind().dialect.name == "postgresql":
+            day = cast(func.timezone("UTC", User.date_created), Date)
+        else:
+            day = func.date(User.date_created)
+        statement = (
+            select(day.label("date"), func.count().label("count"))
+            .filter(User.date_created >= since)
+            .group_by(day)
+            .order_by(day)
+        )
         result = await session.execute(statement)
+        return result.all()
+
+    async def count_updated_since(self, session: AsyncSession, since: datetime) -> int:
+        result = await session.execute(select(func.count()).select_from(User).filter(User.date_updated >= since))
+        return result.scalar_one()
+
+    async def get_all(self, session: AsyncSession, fields: Optional[tuple[str, ...]] = None) -> list[Row]:
+        result = await session.execute(_all_statement(fields))
+        return result.all()
+
+    async def get_updated_since(self, session: AsyncSession, since: datetime, limit: int, after_id: Optional[int] = None,
+                                fields: Optional[tuple[str, ...]] = None) -> list[Row]:
+        result = await session.execute(_updated_statement(fields, after_id is not None),
+                                       {"since": since, **_page_params(limit, after_id)})
+        return result.all()
+
+    async def get_many(self, session: AsyncSession, user_ids: list[int]) -> list[User]:
+        if not user_ids:
+            return []
+        statement = _USERS_BY_ID_ARRAY if session.get_bind().dialect.name == "postgresql" else _USERS_BY_IDS
+        result = await session.execute(statement, {"user_ids": user_ids})
         return result.scalars().all()
 
+    async def get_page(self, session: AsyncSession, limit: int, after_id: Optional[int] = None,
+                       fields: Optional[tuple[str, ...]] = None) -> list:
+        # Keyset pagination on the primary key keeps page cost constant
+        result = await session.execute(_page_statement(fields, after_id is not None), _page_params(limit, after_id))
+        return result.scalars().all() if fields is None else result.all()
+
+    async def search(self, session: AsyncSession, limit: int, after_id: Optional[int] = None,
+                     username: Optional[str] = None, username_prefix: Optional[str] = None,
+                     email: Optional[str] = None, email_domain: Optional[str] = None,
+                     name: Optional[str] = None, fields: Optional[tuple[str, ...]] = None) -> list:
+        statement = _page_statement(fields, after_id is not None).filter(*_search_conditions(
+            username, username_prefix, email, email_domain, name))
+        result = await session.execute(statement, _page_params(limit, after_id))
+        return result.scalars().all() if fields is None else result.all()
+
+    async def stream_all(self, session: AsyncSession, batch_size: int = 1000) -> AsyncIterator[Row]:
+        statement = select(*User.__table__.columns).order_by(User.id).execution_options(yield_per=batch_size)
+        result = await session.stream(statement)
+        async for row in result:
+            yield row
+
     async def update(self, session: AsyncSession, user_id: int, data: dict) -> User:
-        statement = select(User).filter(User.id == user_id)
+        # Single UPDATE ... RETURNING round trip instead of SELECT then UPDATE;
+        # date_updated is set by the column's onupdate
+        statement = (
+            update(User)
+            .where(User.id == user_id)
+            .values(**data)
+            .returning(User)
+            .execution_options(populate_existing=True)
+        )
         result = await session.execute(statement)
-        try:
-            user = result.scalars().one()
-        except NoResultFound:
+        user = result.scalars().one_or_none()
+        if user is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        session.add(_event("updated", user.id, user))
+        await session.commit()
+        return user
+
+    def _bulk_values(self, session: AsyncSession, changes: dict) -> dict:
+        values = {key: changes[key] for key in ("first_name", "last_name") if key in changes}
+        if "email_domain" in changes:
+            if session.get_bind().dialect.name == "postgresql":
+                local_part = func.split_part(User.email, "@", 1, type_=String)
+            else:
+                local_part = func.substr(User.email, 1, func.instr(User.email, "@") - 1, type_=String)
+            values["email"] = local_part + "@" + changes["email_domain"]
+        return values
+
+    def _bulk_selection(self, limit: Optional[int], after_id: Optional[int], ids: Optional[list[int]],
+                        filters: Optional[dict], values: Optional[dict] = None) -> Select:
+        # Ids of the next chunk of matching rows, in primary key order. With
+        # values, rows that already hold them are left out.
+        statement = select(User.id).order_by(User.id).limit(limit)
+        if ids is not None:
+            statement = statement.filter(User.id.in_(ids))
+        if filters:
+            statement = statement.filter(*_search_conditions(**filters))
+        if after_id is not None:
+            statement = statement.filter(User.id > after_id)
+        if values:
+            statement = statement.filter(
+                or_(*(getattr(User, key).is_distinct_from(value) for key, value in values.items())))
+        return statement
+
+    async def count_matching(self, session: AsyncSession, ids: Optional[list[int]] = None,
+                             filters: Optional[dict] = None, changes: Optional[dict] = None) -> int:
+        values = self._bulk_values(session, changes) if changes else None
+        selection = self._bulk_selection(None, None, ids, filters, values).order_by(None).subquery()
+        result = await session.execute(select(func.count()).select_from(selection))
+        return result.scalar_one()
 
-        for key, value in data.items():
-            setattr(user, key, value)
-        user.date_updated = datetime.now(timezone.utc)
+    async def bulk_update(self, session: AsyncSession, changes: dict, limit: int, after_id: Optional[int] = None,
+                          ids: Optional[list[int]] = None, filters: Optional[dict] = None) -> list[int]:
+        # One UPDATE ... WHERE id IN (next chunk) RETURNING and one commit per chunk
+        values = self._bulk_values(session, changes)
+        statement = (
+            update(User)
+            .where(User.id.in_(self._bulk_selection(limit, after_id, ids, filters, values)))
+            .values(**values)
+            .returning(*User.__table__.columns)
+        )
+        users = (await session.execute(statement)).all()
+        session.add_all([_event("updated", user.id, user) for user in users])
         await session.commit()
+        return [user.id for user in users]
+
+    async def bulk_delete(self, session: AsyncSession, limit: int, after_id: Optional[int] = None,
+                          ids: Optional[list[int]] = None, filters: Optional[dict] = None) -> list[int]:
+        statement = (
+            delete(User)
+            .where(User.id.in_(self._bulk_selection(limit, after_id, ids, filters)))
+            .returning(User.id)
+        )
+        user_ids = (await session.execute(statement)).scalars().all()
+        session.add_all([_event("deleted", user_id) for user_id in user_ids])
+        await session.commit()
+        return list(user_ids)
+
+    async def patch(self, session: AsyncSession, user_id: int, data: dict,
+                    expected_updated: Optional[list[datetime]] = None) -> Optional[User]:
+        # Only writes when a column actually changes and, if given, date_updated
+        # still matches one of the expected versions. Returns None otherwise.
+        conditions = [
+            User.id == user_id,
+            or_(*(getattr(User, key).is_distinct_from(value) for key, value in data.items())),
+        ]
+        if expected_updated is not None:
+            conditions.append(User.date_updated.in_(expected_updated))
+        statement = (
+            update(User)
+            .where(*conditions)
+            .values(**data)
+            .returning(User)
+            .execution_options(populate_existing=True)
+        )
+        result = await session.execute(statement)
+        user = result.scalars().one_or_none()
+        if user is not None:
+            session.add(_event("updated", user.id, user))
+            await session.commit()
         return user
 
     async def delete(self, session: AsyncSession, user_id: int) -> None:
-        statement = select(User).filter(User.id == user_id)
-        result = await session.execute(statement)
-        try:
-            user = result.scalars().one()
-        except NoResultFound:
+        result = await session.execute(_DELETE_USER, {"user_id": user_id})
+        if result.scalar_one_or_none() is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        session.add(_event("deleted", user_id))
+        await session.commit()
+
+    async def get_events(self, session: AsyncSession, after_id: int, limit: int,
+                         up_to: Optional[int] = None) -> list[Row]:
+        if up_to is None:
+            result = await session.execute(_EVENTS, {"after_id": after_id, "limit": limit})
+        else:
+            result = await session.execute(_EVENTS_UP_TO, {"after_id": after_id, "limit": limit, "up_to": up_to})
+        return result.all()
+
+    async def get_event_id_range(self, session: AsyncSession) -> tuple[Optional[int], Optional[int]]:
+        result = await session.execute(select(func.min(UserEvent.id), func.max(UserEvent.id)))
+        return tuple(result.one())
 
-        await session.delete(user)
+    async def prune_events(self, session: AsyncSession, before: datetime) -> int:
+        result = await session.execute(delete(UserEvent).where(UserEvent.date_created < before))
         await session.commit()
+        return result.rowcount
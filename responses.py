@@ -0,0 +1,38 @@
+import time
+import orjson
+from fastapi.responses import Response
+from pydantic import BaseModel
+from sqlalchemy import Row
+from instrumentation import record_serialization
+
+
+def _default(value):
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, Row):
+        return dict(zip(value._fields, value))
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def encode_json(content) -> bytes:
+    # Lists of rows share their field names; building the dicts here is
+    # several times cheaper than converting each row in the default hook
+    if isinstance(content, list) and content and isinstance(content[0], Row):
+        fields = content[0]._fields
+        content = [dict(zip(fields, row)) for row in content]
+    # OPT_UTC_Z keeps datetimes byte-identical to pydantic's output
+    return orjson.dumps(content, default=_default, option=orjson.OPT_UTC_Z)
+
+
+class FastJSONResponse(Response):
+    # Encodes plain rows directly, skipping response_model validation
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        # Handlers often build this response themselves, before TimedRoute
+        # sees the endpoint return
+        start = time.perf_counter()
+        try:
+            return encode_json(content)
+        finally:
+            record_serialization(time.perf_counter() - start)
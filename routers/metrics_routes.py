@@ -0,0 +1,72 @@
+from fastapi import APIRouter, status
+from fastapi.responses import PlainTextResponse
+from database import get_compiled_cache_status, get_engine, get_pool_status, replicas
+import dependencies
+from instrumentation import metrics, render_prometheus
+from routers import user_routes
+
+router = APIRouter()
+
+
+@router.get("/metrics/cache", status_code=status.HTTP_200_OK)
+async def get_cache_metrics():
+    return user_routes.user_service.cache.get_stats()
+
+
+@router.get("/metrics/pool", status_code=status.HTTP_200_OK)
+async def get_pool_metrics():
+    pool = get_pool_status(get_engine())
+    pool["replicas"] = [{**replica, **get_pool_status(replica_engine)}
+                        for replica, replica_engine in zip(replicas.status(), replicas.engines)]
+    return pool
+
+
+@router.get("/metrics/admission", status_code=status.HTTP_200_OK)
+async def get_admission_metrics():
+    return {**dependencies.admission.get_stats(), "rate_limited": dependencies.rate_limiter.get_stats()["limited"]}
+
+
+@router.get("/metrics/statements", status_code=status.HTTP_200_OK)
+async def get_statement_metrics():
+    hits, misses = metrics.compiled_cache_hits, metrics.compiled_cache_misses
+    compiled_cache = get_compiled_cache_status(get_engine())
+    compiled_cache["replicas"] = [get_compiled_cache_status(replica_engine) for replica_engine in replicas.engines]
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        "compiled_cache": compiled_cache,
+    }
+
+
+@router.get("/metrics", status_code=status.HTTP_200_OK, response_class=PlainTextResponse)
+async def get_metrics():
+    cache = user_routes.user_service.cache.get_stats()
+    pool = get_pool_status(get_engine())
+    feed = user_routes.change_feed.get_stats()
+    fetches = user_routes.user_service.single_flight.get_stats()
+    admitted = dependencies.admission.get_stats()
+    counters = {
+        "user_cache_hits_total": cache["hits"],
+        "user_cache_misses_total": cache["misses"],
+        "user_cache_evictions_total": cache["evictions"],
+        "user_fetches_executed_total": fetches["executed"],
+        "user_fetches_coalesced_total": fetches["coalesced"],
+        "user_fetch_wait_timeouts_total": fetches["timeouts"],
+        "admission_admitted_total": admitted["admitted"],
+        "admission_shed_total": admitted["shed"],
+        "admission_timeouts_total": admitted["timeouts"],
+        "rate_limited_total": dependencies.rate_limiter.get_stats()["limited"],
+        "db_pool_checkouts_total": pool["checkouts"],
+        "db_pool_timeouts_total": pool["timeouts"],
+        "db_pool_wait_seconds_total": pool["wait_seconds_total"],
+        "change_feed_published_total": feed["published"],
+        "change_feed_dropped_subscribers_total": feed["dropped_subscribers"],
+    }
+    gauges = {f"db_pool_{key}": pool[key] for key in ("size", "checked_out", "overflow", "saturation") if key in pool}
+    gauges["admission_active"] = admitted["active"]
+    gauges["admission_waiting"] = sum(admitted["waiting"].values())
+    gauges["change_feed_subscribers"] = feed["subscribers"]
+    gauges["sql_compiled_cache_entries"] = get_compiled_cache_status(get_engine())["entries"]
+    gauges["db_replicas_healthy"] = sum(replica["healthy"] for replica in replicas.status())
+    return PlainTextResponse(render_prometheus(counters, gauges), media_type="text/plain; version=0.0.4")
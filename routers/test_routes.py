@@ -1,9 +1,24 @@
+import json
+import time
 import unittest
+import msgpack
 from unittest.mock import patch, MagicMock
 from fastapi.testclient import TestClient
 from datetime import datetime, timezone
-from main import app
-from schemas import UserCreateModel, UserModel, UserUpdateModel
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from main import app, create_app
+from settings import Settings, get_settings
+from database import get_engine
+from instrumentation import metrics
+import dependencies
+from pagination import encode_cursor
+from routers import user_routes
+from schemas import UserCreateModel, UserModel, UserUpdateModel, UserPatchModel
+from etags import make_etag, make_collection_etag
+from fastapi import HTTPException
+from services.admission import Overloaded, RateLimitExceeded
+from services.change_feed import Subscription
+from services.coalescing import CoalescedWaitTimeout
 from services.user_service import UserService
 
 
@@ -58,14 +73,145 @@ class TestUserRoutes(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(response.json()["username"], "testuser")
         mock_get_user.assert_called_once_with(1, unittest.mock.ANY)
 
+    @patch.object(UserService, 'get_user')
+    @patch.object(UserService, 'get_user_version', return_value=datetime(2024, 7, 14, 12, tzinfo=timezone.utc))
+    async def test_get_user_not_modified(self, mock_get_user_version, mock_get_user):
+        etag = make_etag(1, datetime(2024, 7, 14, 12, tzinfo=timezone.utc))
+        response = self.client.get("/users/1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["etag"], etag)
+        self.assertEqual(response.headers["last-modified"], "Sun, 14 Jul 2024 12:00:00 GMT")
+        mock_get_user.assert_not_called()
+
+    @patch.object(UserService, 'get_user')
+    @patch.object(UserService, 'get_user_version', return_value=datetime(2024, 7, 14, 12, tzinfo=timezone.utc))
+    async def test_get_user_not_modified_since(self, mock_get_user_version, mock_get_user):
+        response = self.client.get("/users/1", headers={"If-Modified-Since": "Sun, 14 Jul 2024 12:00:00 GMT"})
+        self.assertEqual(response.status_code, 304)
+        mock_get_user.assert_not_called()
+
+    @patch.object(UserService, 'get_user', return_value=UserModel(
+        id=1,
+        username="testuser",
+        email="testuser@example.com",
+        first_name="Test",
+        last_name="User",
+        date_created=datetime(2024, 7, 14, 12, tzinfo=timezone.utc),
+        date_updated=datetime(2024, 7, 15, 12, tzinfo=timezone.utc)
+    ))
+    @patch.object(UserService, 'get_user_version', return_value=datetime(2024, 7, 15, 12, tzinfo=timezone.utc))
+    async def test_get_user_modified(self, mock_get_user_version, mock_get_user):
+        stale_etag = make_etag(1, datetime(2024, 7, 14, 12, tzinfo=timezone.utc))
+        response = self.client.get("/users/1", headers={"If-None-Match": stale_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["etag"], make_etag(1, datetime(2024, 7, 15, 12, tzinfo=timezone.utc)))
+
+    @patch.object(UserService, 'get_users')
+    @patch.object(UserService, 'get_users_version', return_value=5)
+    async def test_get_users_not_modified(self, mock_get_users_version, mock_get_users):
+        etag = make_collection_etag(5)
+        response = self.client.get("/users", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        mock_get_users.assert_not_called()
+
+    @patch.object(UserService, 'get_user', return_value=UserModel(
+        id=1,
+        username="testuser",
+        email="testuser@example.com",
+        first_name="Test",
+        last_name="User",
+        date_created=datetime(2024, 7, 14, 12, tzinfo=timezone.utc),
+        date_updated=datetime(2024, 7, 15, 12, tzinfo=timezone.utc)
+    ))
+    async def test_get_user_fields(self, mock_get_user):
+        response = self.client.get("/users/1", params={"fields": "id,date_updated"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"id": 1, "date_updated": "2024-07-15T12:00:00Z"})
+        self.assertEqual(response.headers["etag"], make_etag(1, datetime(2024, 7, 15, 12, tzinfo=timezone.utc)))
+
+    @patch.object(UserService, 'get_users_version')
+    @patch.object(UserService, 'get_users_updated_since',
+                  return_value=([], (datetime(2024, 7, 15, 13, tzinfo=timezone.utc), 7)))
+    async def test_get_users_updated_since(self, mock_get_users_updated_since, mock_get_users_version):
+        response = self.client.get("/users", params={"updated_since": "2024-07-15T14:00:00+02:00", "limit": 50},
+                                   headers={"If-None-Match": 'W/"users-1-1-0"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"items": [], "next_cursor": encode_cursor("2024-07-15T13:00:00+00:00", 7)})
+        self.assertNotIn("etag", response.headers)
+        mock_get_users_updated_since.assert_called_once_with(datetime(2024, 7, 15, 12, tzinfo=timezone.utc), 50, None,
+                                                             unittest.mock.ANY, None)
+        mock_get_users_version.assert_not_called()
+
+    @patch.object(UserService, 'get_users_updated_since', return_value=([], None))
+    async def test_get_users_updated_since_resumes_from_cursor(self, mock_get_users_updated_since):
+        response = self.client.get("/users", params={"updated_since": "2024-07-15T12:00:00Z",
+                                                     "after": encode_cursor("2024-07-15T13:00:00+00:00", 7)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"items": [], "next_cursor": None})
+        mock_get_users_updated_since.assert_called_once_with(datetime(2024, 7, 15, 13, tzinfo=timezone.utc), 1000, 7,
+                                                             unittest.mock.ANY, None)
+
+    @patch.object(UserService, 'get_users_updated_since')
+    async def test_get_users_updated_since_invalid_cursor(self, mock_get_users_updated_since):
+        response = self.client.get("/users", params={"updated_since": "2024-07-15T12:00:00Z",
+                                                     "after": encode_cursor(7)})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["detail"], "Invalid cursor")
+        mock_get_users_updated_since.assert_not_called()
+
+    @patch.object(UserService, 'get_users')
+    async def test_get_users_limit_needs_updated_since(self, mock_get_users):
+        response = self.client.get("/users", params={"limit": 10})
+        self.assertEqual(response.status_code, 400)
+        mock_get_users.assert_not_called()
+
+    @patch.object(UserService, 'get_users_page', return_value=([], None))
+    async def test_get_users_page_msgpack_small_response_uncompressed(self, mock_get_users_page):
+        response = self.client.get("/users/page", headers={"Accept": "application/msgpack;q=1, application/json;q=0.5",
+                                                           "Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], "application/msgpack")
+        self.assertNotIn("content-encoding", response.headers)
+        self.assertEqual(msgpack.unpackb(response.content), {"items": [], "next_cursor": None})
+
     @patch.object(UserService, 'get_user', return_value=None)
     async def test_get_user_not_found(self, mock_get_user):
         response = self.client.get("/users/999")
-        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.status_code, 404)
         error_detail = response.json()["detail"]
-        self.assertEqual(error_detail, "404: User not found")
+        self.assertEqual(error_detail, "User not found")
         mock_get_user.assert_called_once_with(999, unittest.mock.ANY)
 
+    @patch.object(UserService, 'get_user', side_effect=HTTPException(status_code=404, detail="User not found"))
+    async def test_get_user_not_found_in_repository(self, mock_get_user):
+        response = self.client.get("/users/999")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["detail"], "User not found")
+
+    @patch.object(UserService, 'update_user', side_effect=HTTPException(status_code=404, detail="User not found"))
+    async def test_update_user_missing_returns_404(self, mock_update_user):
+        response = self.client.put("/users/999", json={
+            "username": "updateduser",
+            "email": "updateduser@example.com",
+            "first_name": "Updated",
+            "last_name": "User"
+        })
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["detail"], "User not found")
+
+    @patch.object(UserService, 'delete_user', side_effect=HTTPException(status_code=404, detail="User not found"))
+    async def test_delete_user_missing_returns_404(self, mock_delete_user):
+        response = self.client.delete("/users/999")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["detail"], "User not found")
+
+    @patch.object(UserService, 'get_user', side_effect=CoalescedWaitTimeout("Timed out waiting for the in-flight load of 1"))
+    async def test_get_user_coalesced_wait_timeout(self, mock_get_user):
+        response = self.client.get("/users/1")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["retry-after"], "1")
+
+    @patch.object(UserService, 'get_users_version', return_value=1)
     @patch.object(UserService, 'get_users', return_value=[
         UserModel(
             id=1,
@@ -77,13 +223,354 @@ class TestUserRoutes(unittest.IsolatedAsyncioTestCase):
             date_updated=datetime.now(timezone.utc)
         )
     ])
-    async def test_get_users(self, mock_get_users):
+    async def test_get_users(self, mock_get_users, mock_get_users_version):
         response = self.client.get("/users")
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.json()), 1)
         self.assertEqual(response.json()[0]["username"], "testuser")
+        self.assertEqual(response.headers["etag"], make_collection_etag(1))
         mock_get_users.assert_called_once()
 
+    @patch.object(UserService, 'get_users_page', return_value=([
+        UserModel(
+            id=1,
+            username="testuser",
+            email="testuser@example.com",
+            first_name="Test",
+            last_name="User",
+            date_created=datetime.now(timezone.utc),
+            date_updated=datetime.now(timezone.utc)
+        )
+    ], 1))
+    async def test_get_users_page(self, mock_get_users_page):
+        response = self.client.get("/users/page?limit=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["items"][0]["username"], "testuser")
+        self.assertEqual(response.json()["next_cursor"], encode_cursor(1))
+        mock_get_users_page.assert_called_once_with(1, None, unittest.mock.ANY, None)
+
+    @patch.object(UserService, 'get_users_version', return_value=1)
+    @patch.object(UserService, 'get_users', return_value=[
+        UserModel(
+            id=1,
+            username="testuser",
+            email="testuser@example.com",
+            first_name="Test",
+            last_name="User",
+            date_created=datetime(2024, 7, 14, 12, tzinfo=timezone.utc),
+            date_updated=datetime(2024, 7, 15, 12, tzinfo=timezone.utc)
+        )
+    ])
+    async def test_get_users_fields(self, mock_get_users, mock_get_users_version):
+        response = self.client.get("/users", params={"fields": "username,id"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [{"id": 1, "username": "testuser"}])
+        self.assertEqual(response.headers["etag"], make_collection_etag(1))
+        mock_get_users.assert_called_once_with(unittest.mock.ANY, ("id", "username"))
+
+    @patch.object(UserService, 'get_users_version', return_value=1)
+    @patch.object(UserService, 'get_users', return_value=[
+        UserModel(
+            id=i,
+            username=f"testuser{i}",
+            email=f"testuser{i}@example.com",
+            first_name="Test",
+            last_name="User",
+            date_created=datetime(2024, 7, 14, 12, tzinfo=timezone.utc),
+            date_updated=datetime(2024, 7, 15, 12, tzinfo=timezone.utc)
+        ) for i in range(1, 51)
+    ])
+    async def test_get_users_gzip(self, mock_get_users, mock_get_users_version):
+        response = self.client.get("/users", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response.headers["vary"])
+        self.assertLess(int(response.headers["content-length"]), len(response.content))
+        self.assertEqual(len(response.json()), 50)
+
+    @patch.object(UserService, 'get_users_version', return_value=1)
+    @patch.object(UserService, 'get_users', return_value=[
+        UserModel(
+            id=i,
+            username=f"testuser{i}",
+            email=f"testuser{i}@example.com",
+            first_name="Test",
+            last_name="User",
+            date_created=datetime(2024, 7, 14, 12, tzinfo=timezone.utc),
+            date_updated=datetime(2024, 7, 15, 12, tzinfo=timezone.utc)
+        ) for i in range(1, 51)
+    ])
+    async def test_get_users_prefers_zstd(self, mock_get_users, mock_get_users_version):
+        response = self.client.get("/users", headers={"Accept-Encoding": "gzip;q=0.8, zstd"})
+        self.assertEqual(response.headers["content-encoding"], "zstd")
+        self.assertEqual(response.json()[0]["username"], "testuser1")
+
+    @patch.object(UserService, 'get_users_version', return_value=1)
+    @patch.object(UserService, 'get_users', return_value=[
+        UserModel(
+            id=i,
+            username=f"testuser{i}",
+            email=f"testuser{i}@example.com",
+            first_name="Test",
+            last_name="User",
+            date_created=datetime(2024, 7, 14, 12, tzinfo=timezone.utc),
+            date_updated=datetime(2024, 7, 15, 12, tzinfo=timezone.utc)
+        ) for i in range(1, 51)
+    ])
+    async def test_get_users_msgpack(self, mock_get_users, mock_get_users_version):
+        json_response = self.client.get("/users", headers={"Accept-Encoding": "identity"})
+        response = self.client.get("/users", headers={"Accept": "application/msgpack", "Accept-Encoding": "identity"})
+        self.assertEqual(response.headers["content-type"], "application/msgpack")
+        self.assertNotIn("content-encoding", response.headers)
+        self.assertEqual(msgpack.unpackb(response.content), json_response.json())
+        self.assertLess(len(response.content), len(json_response.content))
+        # Each representation has its own validator, and caches key on both headers
+        self.assertEqual(response.headers["etag"], json_response.headers["etag"][:-1] + '-msgpack"')
+        for negotiated in (response, json_response):
+            self.assertEqual(negotiated.headers["vary"], "Accept, Accept-Encoding")
+
+    @patch.object(UserService, 'get_user_version', return_value=datetime(2024, 7, 15, 12, tzinfo=timezone.utc))
+    async def test_get_user_not_modified_for_its_representation(self, mock_get_user_version):
+        etag = make_etag(1, datetime(2024, 7, 15, 12, tzinfo=timezone.utc))
+        msgpack_etag = etag[:-1] + '-msgpack"'
+        headers = {"Accept": "application/msgpack", "If-None-Match": msgpack_etag}
+        response = self.client.get("/users/1", headers=headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["etag"], msgpack_etag)
+        self.assertEqual(response.headers["vary"], "Accept, Accept-Encoding")
+
+    @patch.object(UserService, 'get_user_version', return_value=datetime(2024, 7, 15, 12, tzinfo=timezone.utc))
+    @patch.object(UserService, 'get_user', return_value=UserModel(
+        id=1,
+        username="testuser",
+        email="testuser@example.com",
+        first_name="Test",
+        last_name="User",
+        date_created=datetime(2024, 7, 14, 12, tzinfo=timezone.utc),
+        date_updated=datetime(2024, 7, 15, 12, tzinfo=timezone.utc)
+    ))
+    async def test_json_client_does_not_revalidate_msgpack_etag(self, mock_get_user, mock_get_user_version):
+        etag = make_etag(1, datetime(2024, 7, 15, 12, tzinfo=timezone.utc))
+        response = self.client.get("/users/1", headers={"If-None-Match": etag[:-1] + '-msgpack"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["etag"], etag)
+
+    @patch.object(UserService, 'get_user', side_effect=Exception("boom"))
+    async def test_errors_are_not_transcoded(self, mock_get_user):
+        response = self.client.get("/users/1", headers={"Accept": "application/msgpack"})
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.headers["content-type"], "application/json")
+        self.assertEqual(response.json()["detail"], "boom")
+
+    @patch.object(UserService, 'get_users')
+    async def test_get_users_unknown_field(self, mock_get_users):
+        response = self.client.get("/users", params={"fields": "id,password"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["detail"], "Unknown fields: password")
+        mock_get_users.assert_not_called()
+
+    @patch.object(UserService, 'get_users_page', return_value=([
+        UserModel(
+            id=1,
+            username="testuser",
+            email="testuser@example.com",
+            first_name="Test",
+            last_name="User",
+            date_created=datetime(2024, 7, 14, 12, tzinfo=timezone.utc),
+            date_updated=datetime(2024, 7, 15, 12, tzinfo=timezone.utc)
+        )
+    ], 1))
+    async def test_get_users_page_fields(self, mock_get_users_page):
+        response = self.client.get("/users/page", params={"limit": 1, "fields": "email"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"items": [{"email": "testuser@example.com"}],
+                                           "next_cursor": encode_cursor(1)})
+        mock_get_users_page.assert_called_once_with(1, None, unittest.mock.ANY, ("email",))
+
+    @patch.object(UserService, 'get_users_page', return_value=([], None))
+    async def test_get_users_page_after_cursor(self, mock_get_users_page):
+        response = self.client.get("/users/page", params={"after": encode_cursor(5)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"items": [], "next_cursor": None})
+        mock_get_users_page.assert_called_once_with(100, 5, unittest.mock.ANY, None)
+
+    @patch.object(UserService, 'get_users_version', return_value=1)
+    @patch.object(UserService, 'get_users')
+    async def test_get_users_releases_session_before_encoding(self, mock_get_users, mock_get_users_version):
+        events = []
+        close = AsyncSession.close
+        response_class = user_routes.FastJSONResponse
+
+        async def record_close(session):
+            events.append("close")
+            await close(session)
+
+        def record_encode(content, headers=None):
+            events.append("encode")
+            return response_class(content, headers=headers)
+
+        mock_get_users.return_value = []
+        with patch.object(AsyncSession, 'close', record_close), \
+                patch('routers.user_routes.FastJSONResponse', side_effect=record_encode):
+            response = self.client.get("/users")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(events[:2], ["close", "encode"])
+
+    @patch.object(UserService, 'bulk_update_users', return_value={
+        'dry_run': False, 'affected': 2, 'ids': [1, 2], 'error': None})
+    async def test_bulk_update_users(self, mock_bulk_update_users):
+        response = self.client.post("/users/bulk-update", json={
+            "filter": {"email_domain": "old.com"},
+            "changes": {"email_domain": "new.com"}
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["ids"], [1, 2])
+        mock_bulk_update_users.assert_called_once_with(
+            {"email_domain": "new.com"}, None, {"email_domain": "old.com"}, False, unittest.mock.ANY)
+
+    @patch.object(UserService, 'bulk_delete_users', return_value={
+        'dry_run': False, 'affected': 1, 'ids': [1], 'error': 'Email already exists'})
+    async def test_bulk_delete_users_partial_conflict(self, mock_bulk_delete_users):
+        response = self.client.post("/users/bulk-delete", json={"ids": [1, 2]})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["affected"], 1)
+
+    @patch.object(UserService, 'bulk_delete_users')
+    async def test_bulk_delete_users_requires_selection(self, mock_bulk_delete_users):
+        for body in ({}, {"ids": [1], "filter": {"username": "a"}}, {"filter": {}}):
+            response = self.client.post("/users/bulk-delete", json=body)
+            self.assertEqual(response.status_code, 400)
+        mock_bulk_delete_users.assert_not_called()
+
+    @patch.object(UserService, 'bulk_delete_users')
+    async def test_bulk_delete_users_rejects_blank_filter(self, mock_bulk_delete_users):
+        for body in ({"filter": {"username_prefix": ""}}, {"filter": {"username": "a", "email_domain": " "}}):
+            response = self.client.post("/users/bulk-delete", json=body)
+            self.assertEqual(response.status_code, 400)
+        mock_bulk_delete_users.assert_not_called()
+
+    @patch.object(UserService, 'bulk_update_users')
+    async def test_bulk_update_users_rejects_invalid_changes(self, mock_bulk_update_users):
+        for changes in ({"email_domain": ""}, {"email_domain": "evil.com@x"}, {"email_domain": "bad domain.com"},
+                        {"email_domain": "-bad.com"}, {"first_name": ""}, {"last_name": "  "}):
+            response = self.client.post("/users/bulk-update", json={"filter": {"email_domain": "old.com"},
+                                                                     "changes": changes})
+            self.assertEqual(response.status_code, 400, changes)
+        mock_bulk_update_users.assert_not_called()
+
+    @patch.object(UserService, 'get_stats', return_value={
+        'total': 3, 'total_is_estimate': False, 'days': 7,
+        'created_per_day': [{'date': '2024-07-14', 'count': 3}], 'hours': 24, 'updated_recently': 1})
+    async def test_get_user_stats(self, mock_get_stats):
+        response = self.client.get("/users/stats", params={"days": 7})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["created_per_day"], [{"date": "2024-07-14", "count": 3}])
+        mock_get_stats.assert_called_once_with(7, 24, False, unittest.mock.ANY)
+
+    @patch.object(UserService, 'get_users_page')
+    async def test_get_users_page_invalid_cursor(self, mock_get_users_page):
+        response = self.client.get("/users/page?after=not-a-cursor")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["detail"], "Invalid cursor")
+        mock_get_users_page.assert_not_called()
+
+    @patch.object(UserService, 'search_users', return_value=([], None))
+    async def test_search_users(self, mock_search_users):
+        response = self.client.get("/users/search", params={
+            "username_prefix": "test", "email_domain": "example.com", "limit": 10, "after": encode_cursor(3)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"items": [], "next_cursor": None})
+        mock_search_users.assert_called_once_with(
+            {"username_prefix": "test", "email_domain": "example.com"}, 10, 3, unittest.mock.ANY, None)
+
+    @patch.object(UserService, 'search_users')
+    async def test_search_users_name_too_short(self, mock_search_users):
+        response = self.client.get("/users/search?name=ab")
+        self.assertEqual(response.status_code, 422)
+        mock_search_users.assert_not_called()
+
+    async def test_stream_users(self):
+        async def fake_stream(session):
+            for user_id in (1, 2):
+                yield UserModel(
+                    id=user_id,
+                    username=f"testuser{user_id}",
+                    email=f"testuser{user_id}@example.com",
+                    first_name="Test",
+                    last_name="User",
+                    date_created=datetime.now(timezone.utc),
+                    date_updated=datetime.now(timezone.utc)
+                )
+
+        with patch.object(UserService, 'stream_users', side_effect=fake_stream):
+            response = self.client.get("/users/stream")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("application/x-ndjson"))
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual([line["username"] for line in lines], ["testuser1", "testuser2"])
+
+    @patch.object(UserService, 'get_users_by_ids', return_value=([
+        UserModel(
+            id=2,
+            username="testuser",
+            email="testuser@example.com",
+            first_name="Test",
+            last_name="User",
+            date_created=datetime.now(timezone.utc),
+            date_updated=datetime.now(timezone.utc)
+        )
+    ], [7]))
+    async def test_get_users_batch(self, mock_get_users_by_ids):
+        response = self.client.post("/users/batch-get", json={"ids": [2, 7]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["users"][0]["id"], 2)
+        self.assertEqual(response.json()["missing"], [7])
+        mock_get_users_by_ids.assert_called_once_with([2, 7], unittest.mock.ANY)
+
+    @patch.object(UserService, 'get_users_by_ids')
+    async def test_get_users_batch_too_large(self, mock_get_users_by_ids):
+        with patch.object(user_routes.user_service, 'max_batch_size', 2):
+            response = self.client.post("/users/batch-get", json={"ids": [1, 2, 3]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["detail"], "At most 2 ids per request")
+        mock_get_users_by_ids.assert_not_called()
+
+    @patch.object(UserService, 'import_users', return_value=[
+        {"index": 0, "username": "testuser", "id": 1, "status": "inserted", "reason": None},
+        {"index": 1, "username": None, "id": None, "status": "invalid", "reason": "email: Field required"},
+    ])
+    async def test_import_users_json_array(self, mock_import_users):
+        response = self.client.post("/users/import", json=[
+            {"username": "testuser", "email": "testuser@example.com", "first_name": "Test", "last_name": "User"},
+            {"username": "broken"},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["inserted"], 1)
+        self.assertEqual(response.json()["invalid"], 1)
+        self.assertEqual(response.json()["results"][1]["reason"], "email: Field required")
+        mock_import_users.assert_called_once_with(unittest.mock.ANY, False, unittest.mock.ANY)
+
+    async def test_import_users_ndjson(self):
+        received = []
+
+        async def fake_import(items, update_existing, session):
+            async for item in items:
+                received.append(item)
+            return []
+
+        body = '{"username": "a"}\nnot json\n\n{"username": "b"}'
+        with patch.object(UserService, 'import_users', side_effect=fake_import):
+            response = self.client.post("/users/import?on_conflict=update", content=body,
+                                        headers={"content-type": "application/x-ndjson"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(received, [{"username": "a"}, "not json", {"username": "b"}])
+
+    @patch.object(UserService, 'import_users')
+    async def test_import_users_rejects_non_array(self, mock_import_users):
+        response = self.client.post("/users/import", json={"username": "testuser"})
+        self.assertEqual(response.status_code, 400)
+        mock_import_users.assert_not_called()
+
     @patch.object(UserService, 'update_user', return_value=UserModel(
         id=1,
         username="updateduser",
@@ -126,12 +613,225 @@ class TestUserRoutes(unittest.IsolatedAsyncioTestCase):
             last_name="User"
         ), unittest.mock.ANY)
 
+    @patch.object(UserService, 'patch_user', return_value=UserModel(
+        id=1,
+        username="testuser",
+        email="patched@example.com",
+        first_name="Test",
+        last_name="User",
+        date_created=datetime(2024, 7, 14, tzinfo=timezone.utc),
+        date_updated=datetime(2024, 7, 14, tzinfo=timezone.utc)
+    ))
+    async def test_patch_user(self, mock_patch_user):
+        response = self.client.patch("/users/1", json={"email": "patched@example.com"},
+                                     headers={"If-Match": '"1-100"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["email"], "patched@example.com")
+        self.assertEqual(response.headers["etag"],
+                         make_etag(1, datetime(2024, 7, 14, tzinfo=timezone.utc)))
+        mock_patch_user.assert_called_once_with(1, UserPatchModel(email="patched@example.com"),
+                                                '"1-100"', unittest.mock.ANY)
+
+    @patch.object(UserService, 'patch_user', side_effect=HTTPException(status_code=412, detail="User was modified"))
+    async def test_patch_user_precondition_failed(self, mock_patch_user):
+        response = self.client.patch("/users/1", json={"email": "patched@example.com"},
+                                     headers={"If-Match": '"1-100"'})
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(response.json()["detail"], "User was modified")
+
     @patch.object(UserService, 'delete_user', return_value=None)
     async def test_delete_user(self, mock_delete_user):
         response = self.client.delete("/users/1")
         self.assertEqual(response.status_code, 204)
         mock_delete_user.assert_called_once_with(1, unittest.mock.ANY)
 
+    @patch.object(UserService, 'get_user')
+    async def test_get_user_reads_from_replica(self, mock_get_user):
+        mock_get_user.return_value = UserModel(
+            id=1, username="testuser", email="testuser@example.com", first_name="Test", last_name="User",
+            date_created=datetime.now(timezone.utc), date_updated=datetime.now(timezone.utc))
+        replica = create_async_engine("sqlite+aiosqlite://")
+        reader = TestClient(app, client=("10.0.0.1", 50000))
+        with patch.object(dependencies.replicas, 'pick', return_value=replica):
+            response = reader.get("/users/1")
+        self.assertEqual(response.status_code, 200)
+        self.assertIs(mock_get_user.call_args[0][1].bind, replica)
+
+    @patch.object(UserService, 'delete_user', return_value=None)
+    @patch.object(UserService, 'get_user')
+    async def test_get_user_reads_from_primary_after_write(self, mock_get_user, mock_delete_user):
+        mock_get_user.return_value = UserModel(
+            id=1, username="testuser", email="testuser@example.com", first_name="Test", last_name="User",
+            date_created=datetime.now(timezone.utc), date_updated=datetime.now(timezone.utc))
+        replica = create_async_engine("sqlite+aiosqlite://")
+        with patch.object(dependencies.replicas, 'pick', return_value=replica) as mock_pick:
+            writer = TestClient(app, client=("10.0.0.2", 50000))
+            writer.delete("/users/1")
+            response = writer.get("/users/1")
+        self.assertEqual(response.status_code, 200)
+        self.assertIs(mock_get_user.call_args[0][1].bind, get_engine())
+        mock_pick.assert_not_called()
+
+    @patch.object(UserService, 'get_user')
+    async def test_get_user_falls_back_to_primary(self, mock_get_user):
+        mock_get_user.return_value = UserModel(
+            id=1, username="testuser", email="testuser@example.com", first_name="Test", last_name="User",
+            date_created=datetime.now(timezone.utc), date_updated=datetime.now(timezone.utc))
+        with patch.object(dependencies.replicas, 'pick', return_value=None):
+            response = TestClient(app, client=("10.0.0.3", 50000)).get("/users/1")
+        self.assertEqual(response.status_code, 200)
+        self.assertIs(mock_get_user.call_args[0][1].bind, get_engine())
+
+    async def test_stream_changes(self):
+        events = [
+            MagicMock(id=1, user_id=1, type='created', payload={'id': 1, 'username': 'testuser'},
+                      date_created=datetime(2024, 7, 14, 12, tzinfo=timezone.utc)),
+            MagicMock(id=2, user_id=1, type='deleted', payload=None,
+                      date_created=datetime(2024, 7, 14, 13, tzinfo=timezone.utc)),
+        ]
+        subscription = Subscription(1, 10)
+        # The relay published event 1 before the client subscribed; event 1 is
+        # replayed from the table and the duplicate from the queue is skipped
+        subscription.put(events[0])
+        subscription.put(events[1])
+        subscription.queue.put_nowait(None)
+
+        async def read(after_id, up_to):
+            yield events[0]
+
+        with patch.object(user_routes.change_feed, 'subscribe', return_value=subscription), \
+                patch.object(user_routes.change_feed, 'is_retained', return_value=True), \
+                patch.object(user_routes.change_feed, 'read', side_effect=read) as mock_read:
+            response = self.client.get("/users/changes", params={"since": encode_cursor(0)})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+        messages = [message for message in response.text.split("\n\n") if message]
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0].split("\n")[:2], [f"id: {encode_cursor(1)}", "event: created"])
+        self.assertEqual(messages[1].split("\n")[:2], [f"id: {encode_cursor(2)}", "event: deleted"])
+        self.assertEqual(json.loads(messages[1].split("data: ")[1]),
+                         {"user_id": 1, "user": None, "date_created": "2024-07-14T13:00:00Z"})
+        mock_read.assert_called_once_with(0, 1)
+
+    def test_stream_changes_invalid_cursor(self):
+        response = self.client.get("/users/changes", params={"since": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_cache_metrics(self):
+        response = self.client.get("/metrics/cache")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()), {"hits", "misses", "evictions"})
+
+    def test_get_pool_metrics(self):
+        response = self.client.get("/metrics/pool")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("checkouts", response.json())
+        self.assertIn("wait_seconds_max", response.json())
+        self.assertEqual(response.json()["replicas"], [])
+
+    @patch.object(metrics, 'compiled_cache_misses', 1)
+    @patch.object(metrics, 'compiled_cache_hits', 3)
+    def test_get_statement_metrics(self):
+        response = self.client.get("/metrics/statements")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["hit_rate"], 0.75)
+        self.assertEqual(response.json()["compiled_cache"]["capacity"], 500)
+        self.assertEqual(response.json()["compiled_cache"]["replicas"], [])
+
+    @patch.object(UserService, 'get_user')
+    def test_rate_limited(self, mock_get_user):
+        with patch.object(dependencies.rate_limiter, 'acquire', side_effect=RateLimitExceeded(0.2)) as mock_acquire:
+            response = self.client.get("/users/1", headers={"X-Client-ID": "batch-job"})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["retry-after"], "1")
+        # The header is ignored from untrusted peers, so the bucket is the peer's
+        mock_acquire.assert_called_once_with("testclient")
+        mock_get_user.assert_not_called()
+
+    @patch.object(UserService, 'get_user')
+    def test_rate_limit_uses_client_id_from_trusted_host(self, mock_get_user):
+        with patch.object(dependencies, 'trusted_hosts', dependencies.TrustedHosts("10.0.0.0/8, testclient")), \
+                patch.object(dependencies.rate_limiter, 'acquire', side_effect=RateLimitExceeded(0.2)) as mock_acquire:
+            response = self.client.get("/users/1", headers={"X-Client-ID": "batch-job"})
+        self.assertEqual(response.status_code, 429)
+        mock_acquire.assert_called_once_with("batch-job")
+
+    def test_trusted_hosts(self):
+        trusted_hosts = dependencies.TrustedHosts("127.0.0.1, 10.0.0.0/8, ::1, proxy")
+        self.assertIn("10.1.2.3", trusted_hosts)
+        self.assertIn("::1", trusted_hosts)
+        self.assertIn("proxy", trusted_hosts)
+        self.assertNotIn("192.168.0.1", trusted_hosts)
+        self.assertNotIn("testclient", trusted_hosts)
+        self.assertIn("192.168.0.1", dependencies.TrustedHosts("*"))
+
+    @patch.object(UserService, 'get_users')
+    def test_overloaded_request_is_shed(self, mock_get_users):
+        with patch.object(dependencies.admission, 'acquire', side_effect=Overloaded(2.5)):
+            response = self.client.get("/users")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["retry-after"], "3")
+        mock_get_users.assert_not_called()
+
+    @patch.object(UserService, 'delete_user', return_value=None)
+    def test_admission_slot_is_released(self, mock_delete_user):
+        response = self.client.delete("/users/1")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(dependencies.admission.active, 0)
+        response = self.client.get("/metrics/admission")
+        self.assertEqual(response.json()["limit"], 20)
+        self.assertGreaterEqual(response.json()["admitted"], 1)
+
+    def test_create_app_configures_singletons(self):
+        # Later tests run against the default app's configuration
+        self.addCleanup(create_app, get_settings())
+        custom = create_app(Settings(database_url="sqlite+aiosqlite:///:memory:", admission_max_concurrency=3,
+                                     user_cache_maxsize=0, rate_limit_per_second=5, db_read_your_writes_seconds=2,
+                                     user_batch_max_size=50))
+        self.assertEqual(custom.state.settings.admission_max_concurrency, 3)
+        self.assertEqual(dependencies.admission.limit, 3)
+        self.assertEqual(dependencies.rate_limiter.rate, 5)
+        self.assertEqual(dependencies.recent_writers.window, 2)
+        self.assertEqual(user_routes.user_service.cache.backend.maxsize, 0)
+        self.assertEqual(user_routes.user_service.max_batch_size, 50)
+        self.assertEqual(user_routes.user_service.on_change, user_routes.change_feed.notify)
+
+    @patch.object(UserService, 'delete_user', return_value=None)
+    def test_server_timing_header(self, mock_delete_user):
+        response = self.client.delete("/users/1")
+        timing = response.headers["server-timing"]
+        for metric in ("total;dur=", "db;", "pool;dur=", "queue;dur=", "serialize;dur="):
+            self.assertIn(metric, timing)
+
+    @patch.object(UserService, 'get_users_version', return_value=1)
+    @patch.object(UserService, 'get_users', return_value=[])
+    def test_server_timing_counts_encoding_inside_handler(self, mock_get_users, mock_get_users_version):
+        def slow_encode(content):
+            time.sleep(0.05)
+            return b"[]"
+
+        # GET /users builds its FastJSONResponse before the endpoint returns
+        with patch('responses.encode_json', side_effect=slow_encode):
+            response = self.client.get("/users")
+        self.assertEqual(response.status_code, 200)
+        serialize = [metric for metric in response.headers["server-timing"].split(", ")
+                     if metric.startswith("serialize;")][0]
+        self.assertGreaterEqual(float(serialize.split("dur=")[1]), 50)
+
+    @patch.object(UserService, 'delete_user', return_value=None)
+    def test_get_prometheus_metrics(self, mock_delete_user):
+        self.client.delete("/users/1")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain"))
+        self.assertIn('http_request_duration_seconds_count{method="DELETE",route="/users/{user_id}",status="204"}',
+                      response.text)
+        self.assertIn("sql_statements_total", response.text)
+        self.assertIn("user_cache_hits_total", response.text)
+        self.assertIn("sql_compiled_cache_hits_total", response.text)
+        self.assertIn("admission_shed_total", response.text)
+
     # @patch.object(UserService, 'delete_user', side_effect=Exception("User not found"))
     # async def test_delete_user_not_found(self, mock_delete_user):
     #     response = self.client.delete("/users/999")
@@ -1,18 +1,61 @@
-from fastapi import APIRouter, HTTPException, status, Depends
-from fastapi.responses import Response
+import asyncio
+import json
+import re
+from datetime import datetime, timedelta, timezone
+from collections import Counter
+from typing import Literal, Optional
+from fastapi import APIRouter, HTTPException, status, Depends, Header, Query, Request
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from dependencies import get_session
-from schemas import UserModel, UserCreateModel, UserUpdateModel
+from dependencies import admit_cheap, admit_expensive, get_read_session, get_session, new_session
+from instrumentation import TimedRoute
+from etags import make_etag, make_collection_etag, format_http_date, is_not_modified
+from fieldsets import InvalidFieldsError, parse_fields, user_projector
+from responses import FastJSONResponse, encode_json
+from pagination import InvalidCursorError, decode_id_cursor, decode_timestamp_cursor, encode_cursor
+from schemas import (UserModel, UserCreateModel, UserUpdateModel, UserPageModel, UserBatchGetModel, UserBatchModel,
+                     UserImportSummaryModel, UserPatchModel, UserBulkDeleteModel, UserBulkUpdateModel,
+                     UserBulkResultModel, UserStatsModel)
+from services.change_feed import ChangeFeed
+from services.coalescing import CoalescedWaitTimeout
 from services.user_service import UserService
+from settings import Settings
 
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
 
-user_service = UserService()
+# Replaced by configure() with the app's settings
+change_feed = ChangeFeed(new_session)
+user_service = UserService(on_change=change_feed.notify)
+change_feed.on_event = user_service.apply_event
 
 
-@router.post("/users", status_code=status.HTTP_201_CREATED, response_model=UserModel)
-async def create_user(user_data: UserCreateModel, session: AsyncSession = Depends(get_session)):
+def configure(settings: Settings) -> None:
+    # Called by create_app, before the lifespan starts the change feed relay
+    global change_feed, user_service
+    change_feed = ChangeFeed(new_session, poll_interval=settings.change_feed_poll_interval,
+                             retention=timedelta(hours=settings.change_feed_retention_hours))
+    user_service = UserService(max_batch_size=settings.user_batch_max_size, on_change=change_feed.notify,
+                               coalesce_timeout=settings.user_coalesce_timeout,
+                               cache_maxsize=settings.user_cache_maxsize, cache_ttl=settings.user_cache_ttl,
+                               replica_cache_ttl=settings.db_read_your_writes_seconds)
+    change_feed.on_event = user_service.apply_event
+
+
+CHANGES_HEARTBEAT_SECONDS = 15.0
+
+CHEAP = [Depends(admit_cheap, scope="function")]
+EXPENSIVE = [Depends(admit_expensive, scope="function")]
+
+
+async def _release(session: AsyncSession) -> None:
+    # Reads leave a transaction open; end it so the pooled connection goes back
+    # to the pool before the response is encoded
+    await session.close()
+
+
+@router.post("/users", status_code=status.HTTP_201_CREATED, response_model=UserModel, dependencies=CHEAP)
+async def create_user(user_data: UserCreateModel, session: AsyncSession = Depends(get_session, scope="function")):
     try:
         user = await user_service.create_user(user_data, session)
         return user
@@ -29,30 +72,370 @@ async def create_user(user_data: UserCreateModel, session: AsyncSession = Depend
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
 
-@router.get("/users/{user_id}", status_code=status.HTTP_200_OK, response_model=UserModel)
-async def get_user(user_id: int, session: AsyncSession = Depends(get_session)):
+def _decode_after(after: Optional[str]) -> Optional[int]:
+    if after is None:
+        return None
+    try:
+        return decode_id_cursor(after)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+def _decode_updated_after(after: str) -> tuple[datetime, int]:
+    try:
+        since, after_id = decode_timestamp_cursor(after)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return _as_utc(since), after_id
+
+
+def _parse_fields(fields: Optional[str]) -> Optional[tuple[str, ...]]:
+    try:
+        return parse_fields(fields)
+    except InvalidFieldsError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+def _page_response(users: list, last_id: Optional[int], fields: Optional[tuple[str, ...]]):
+    next_cursor = encode_cursor(last_id) if last_id is not None else None
+    if fields is None:
+        return UserPageModel(items=users, next_cursor=next_cursor)
+    project = user_projector(fields)
+    return FastJSONResponse({"items": [project(user) for user in users], "next_cursor": next_cursor})
+
+
+def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    # Timestamps without an offset are taken as UTC
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _validator_headers(etag: str, date_updated) -> dict:
+    return {"ETag": etag, "Last-Modified": format_http_date(date_updated)}
+
+
+async def _iter_json_array(items: list):
+    for item in items:
+        yield item
+
+
+async def _iter_ndjson(request: Request):
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield _parse_ndjson_line(line)
+    if buffer.strip():
+        yield _parse_ndjson_line(buffer)
+
+
+def _parse_ndjson_line(line: bytes):
+    # Malformed lines are passed through and reported as invalid rows
+    try:
+        return json.loads(line)
+    except ValueError:
+        return line.decode(errors="replace")
+
+
+@router.post("/users/import", status_code=status.HTTP_200_OK, response_model=UserImportSummaryModel,
+             dependencies=EXPENSIVE,
+             openapi_extra={"requestBody": {"required": True, "content": {
+                 "application/json": {"schema": {
+                     "type": "array", "items": {"$ref": "#/components/schemas/UserCreateModel"}}},
+                 "application/x-ndjson": {"schema": {"$ref": "#/components/schemas/UserCreateModel"}},
+             }}})
+async def import_users(request: Request, on_conflict: Literal["nothing", "update"] = "nothing",
+                       session: AsyncSession = Depends(get_session, scope="function")):
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        items = _iter_ndjson(request)
+    else:
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        if not isinstance(body, list):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail="Request body must be a JSON array or NDJSON")
+        items = _iter_json_array(body)
+    try:
+        results = await user_service.import_users(items, on_conflict == "update", session)
+        counts = Counter(result["status"] for result in results)
+        return UserImportSummaryModel(results=results, **counts)
+    except Exception as e:
+        await session.rollback()  # Rollback in case of an error
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+@router.post("/users/batch-get", status_code=status.HTTP_200_OK, response_model=UserBatchModel, dependencies=CHEAP)
+async def get_users_batch(batch: UserBatchGetModel,
+                          session: AsyncSession = Depends(get_read_session, scope="function")):
+    if len(batch.ids) > user_service.max_batch_size:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"At most {user_service.max_batch_size} ids per request")
+    try:
+        users, missing = await user_service.get_users_by_ids(batch.ids, session)
+        await _release(session)
+        return UserBatchModel(users=users, missing=missing)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+def _bulk_selection(bulk: UserBulkDeleteModel) -> tuple[Optional[list[int]], Optional[dict]]:
+    if (bulk.ids is None) == (bulk.filter is None):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Provide either ids or filter")
+    if bulk.ids is not None:
+        return bulk.ids, None
+    filters = bulk.filter.model_dump(exclude_none=True)
+    # An empty filter, or a blank condition (a "" prefix matches every
+    # username), would match every user
+    if not filters:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Filter needs at least one condition")
+    blank = sorted(key for key, value in filters.items() if not value.strip())
+    if blank:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Filter conditions can't be blank: {', '.join(blank)}")
+    if "name" in filters and len(filters["name"]) < 3:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Name filter needs at least 3 characters")
+    return None, filters
+
+
+# Dot separated labels of letters, digits and inner hyphens, as in a hostname
+_DOMAIN = re.compile(r"(?=.{1,253}$)[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?(?:\.[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?)*",
+                     re.IGNORECASE)
+
+
+def _bulk_changes(bulk: UserBulkUpdateModel) -> dict:
+    changes = bulk.changes.model_dump(exclude_none=True)
+    if not changes:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No changes given")
+    # The same value is written to every matched user
+    blank = sorted(key for key, value in changes.items() if not value.strip())
+    if blank:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Changes can't be blank: {', '.join(blank)}")
+    if "email_domain" in changes and not _DOMAIN.fullmatch(changes["email_domain"]):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="email_domain must be a valid hostname")
+    return changes
+
+
+def _bulk_response(result: dict):
+    if result["error"] is not None:
+        return FastJSONResponse(UserBulkResultModel(**result), status_code=status.HTTP_409_CONFLICT)
+    return result
+
+
+@router.post("/users/bulk-update", status_code=status.HTTP_200_OK, response_model=UserBulkResultModel,
+             dependencies=EXPENSIVE)
+async def bulk_update_users(bulk: UserBulkUpdateModel,
+                            session: AsyncSession = Depends(get_session, scope="function")):
+    ids, filters = _bulk_selection(bulk)
+    changes = _bulk_changes(bulk)
+    try:
+        result = await user_service.bulk_update_users(changes, ids, filters, bulk.dry_run, session)
+    except Exception as e:
+        await session.rollback()  # Rollback in case of an error
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    return _bulk_response(result)
+
+
+@router.post("/users/bulk-delete", status_code=status.HTTP_200_OK, response_model=UserBulkResultModel,
+             dependencies=EXPENSIVE)
+async def bulk_delete_users(bulk: UserBulkDeleteModel,
+                            session: AsyncSession = Depends(get_session, scope="function")):
+    ids, filters = _bulk_selection(bulk)
+    try:
+        result = await user_service.bulk_delete_users(ids, filters, bulk.dry_run, session)
+    except Exception as e:
+        await session.rollback()  # Rollback in case of an error
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    return _bulk_response(result)
+
+
+@router.get("/users/page", status_code=status.HTTP_200_OK, response_model=UserPageModel, dependencies=CHEAP)
+async def get_users_page(limit: int = Query(default=100, ge=1, le=1000), after: Optional[str] = None,
+                         fields: Optional[str] = None,
+                         session: AsyncSession = Depends(get_read_session, scope="function")):
+    after_id = _decode_after(after)
+    field_set = _parse_fields(fields)
     try:
+        users, last_id = await user_service.get_users_page(limit, after_id, session, field_set)
+        await _release(session)
+        return _page_response(users, last_id, field_set)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+@router.get("/users/search", status_code=status.HTTP_200_OK, response_model=UserPageModel, dependencies=EXPENSIVE)
+async def search_users(username: Optional[str] = None, username_prefix: Optional[str] = None,
+                       email: Optional[str] = None, email_domain: Optional[str] = None,
+                       name: Optional[str] = Query(default=None, min_length=3),
+                       limit: int = Query(default=100, ge=1, le=1000), after: Optional[str] = None,
+                       fields: Optional[str] = None,
+                       session: AsyncSession = Depends(get_read_session, scope="function")):
+    after_id = _decode_after(after)
+    field_set = _parse_fields(fields)
+    filters = {
+        "username": username,
+        "username_prefix": username_prefix,
+        "email": email,
+        "email_domain": email_domain,
+        "name": name,
+    }
+    try:
+        users, last_id = await user_service.search_users(
+            {key: value for key, value in filters.items() if value is not None}, limit, after_id, session, field_set)
+        await _release(session)
+        return _page_response(users, last_id, field_set)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+@router.get("/users/stats", status_code=status.HTTP_200_OK, response_model=UserStatsModel, dependencies=EXPENSIVE)
+async def get_user_stats(days: int = Query(default=30, ge=1, le=366), hours: int = Query(default=24, ge=1, le=720),
+                         exact: bool = False, session: AsyncSession = Depends(get_read_session, scope="function")):
+    try:
+        stats = await user_service.get_stats(days, hours, exact, session)
+        await _release(session)
+        return stats
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+# Request scoped like its session: the slot is held until the stream ends
+@router.get("/users/stream", status_code=status.HTTP_200_OK, response_class=StreamingResponse,
+            dependencies=[Depends(admit_expensive)])
+async def stream_users(session: AsyncSession = Depends(get_read_session)):
+    # Request scoped: the session has to outlive the handler while the body streams
+    # Rows are encoded as they arrive from the driver, one JSON document per line
+    async def ndjson():
+        async for user in user_service.stream_users(session):
+            yield encode_json(user) + b"\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+def _sse_event(event) -> bytes:
+    data = encode_json({"user_id": event.user_id, "user": event.payload, "date_created": event.date_created})
+    return b"id: %s\nevent: %s\ndata: %s\n\n" % (encode_cursor(event.id).encode(), event.type.encode(), data)
+
+
+@router.get("/users/changes", status_code=status.HTTP_200_OK, response_class=StreamingResponse)
+async def stream_changes(since: Optional[str] = None, last_event_id: Optional[str] = Header(default=None)):
+    # Without a cursor the stream starts at the current end of the feed.
+    # Reconnecting EventSource clients resume from Last-Event-ID.
+    after_id = _decode_after(last_event_id or since)
+    subscription = change_feed.subscribe()
+
+    async def events():
+        last_id = after_id
+        try:
+            if last_id is not None:
+                if not await change_feed.is_retained(last_id):
+                    # Some changes were pruned; the consumer has to resync from GET /users
+                    yield b"event: reset\ndata: {}\n\n"
+                async for event in change_feed.read(last_id, subscription.start_id):
+                    last_id = event.id
+                    yield _sse_event(event)
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), CHANGES_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                if event is None:
+                    return
+                if last_id is None or event.id > last_id:
+                    last_id = event.id
+                    yield _sse_event(event)
+        finally:
+            change_feed.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@router.get("/users/{user_id}", status_code=status.HTTP_200_OK, response_model=UserModel, dependencies=CHEAP)
+async def get_user(user_id: int, fields: Optional[str] = None, if_none_match: Optional[str] = Header(default=None),
+                   if_modified_since: Optional[str] = Header(default=None),
+                   session: AsyncSession = Depends(get_read_session, scope="function")):
+    field_set = _parse_fields(fields)
+    try:
+        if if_none_match is not None or if_modified_since is not None:
+            date_updated = await user_service.get_user_version(user_id, session)
+            if date_updated is not None:
+                headers = _validator_headers(make_etag(user_id, date_updated), date_updated)
+                if is_not_modified(headers["ETag"], date_updated, if_none_match, if_modified_since):
+                    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
         user = await user_service.get_user(user_id, session)
+        await _release(session)
         if user is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-        return user
+        headers = _validator_headers(make_etag(user.id, user.date_updated), user.date_updated)
+        # Single users are served whole from the cache; a field set only trims the body
+        if field_set is not None:
+            return FastJSONResponse(user_projector(field_set)(user), headers=headers)
+        return FastJSONResponse(user, headers=headers)
+    except CoalescedWaitTimeout as e:
+        # The shared query is still running; shed this request rather than queue another
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e),
+                            headers={"Retry-After": "1"})
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
 
-
-@router.get("/users", status_code=status.HTTP_200_OK, response_model=list[UserModel])
-async def get_users(session: AsyncSession = Depends(get_session)):
+@router.get("/users", status_code=status.HTTP_200_OK, response_model=list[UserModel], dependencies=EXPENSIVE)
+async def get_users(fields: Optional[str] = None, updated_since: Optional[datetime] = None,
+                    limit: Optional[int] = Query(default=None, ge=1, le=1000), after: Optional[str] = None,
+                    if_none_match: Optional[str] = Header(default=None),
+                    session: AsyncSession = Depends(get_read_session, scope="function")):
+    field_set = _parse_fields(fields)
+    if updated_since is not None:
+        return await _get_users_updated_since(_as_utc(updated_since), limit or 1000, after, field_set, session)
+    if limit is not None or after is not None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="limit and after need updated_since")
     try:
-        users = await user_service.get_users(session)
-        return users
+        # Read before the rows, so a write in between can only leave the ETag
+        # older than the body (costing a 200 on the next poll), never newer
+        headers = {"ETag": make_collection_etag(await user_service.get_users_version(session))}
+        if if_none_match is not None and is_not_modified(headers["ETag"], None, if_none_match, None):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        users = await user_service.get_users(session, field_set)
+        await _release(session)
+        if field_set is not None:
+            project = user_projector(field_set)
+            return FastJSONResponse([project(user) for user in users], headers=headers)
+        return FastJSONResponse(users, headers=headers)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
 
+async def _get_users_updated_since(since: datetime, limit: int, after: Optional[str],
+                                   fields: Optional[tuple[str, ...]], session: AsyncSession):
+    # Incremental sync: users changed at or after since, oldest first, paged on (date_updated, id)
+    after_id = None
+    if after is not None:
+        since, after_id = _decode_updated_after(after)
+    try:
+        users, last = await user_service.get_users_updated_since(since, limit, after_id, session, fields)
+        await _release(session)
+        next_cursor = encode_cursor(_as_utc(last[0]).isoformat(), last[1]) if last is not None else None
+        if fields is not None:
+            project = user_projector(fields)
+            users = [project(user) for user in users]
+        return FastJSONResponse({"items": users, "next_cursor": next_cursor})
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
 
-@router.put("/users/{user_id}", status_code=status.HTTP_200_OK, response_model=UserModel)
-async def update_user(user_id: int, user_data: UserUpdateModel, session: AsyncSession = Depends(get_session)):
+@router.put("/users/{user_id}", status_code=status.HTTP_200_OK, response_model=UserModel, dependencies=CHEAP)
+async def update_user(user_id: int, user_data: UserUpdateModel,
+                      session: AsyncSession = Depends(get_session, scope="function")):
     try:
         user = await user_service.update_user(user_id, user_data, session)
         return user
@@ -63,18 +446,47 @@ async def update_user(user_id: int, user_data: UserUpdateModel, session: AsyncSe
         if 'email' in str(e.orig):
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already exists")
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unique constraint violation")
+    except HTTPException:
+        await session.rollback()
+        raise
+    except Exception as e:
+        await session.rollback()  # Rollback in case of an error
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+@router.patch("/users/{user_id}", status_code=status.HTTP_200_OK, response_model=UserModel, dependencies=CHEAP)
+async def patch_user(user_id: int, user_data: UserPatchModel, response: Response,
+                     if_match: Optional[str] = Header(default=None),
+                     session: AsyncSession = Depends(get_session, scope="function")):
+    try:
+        user = await user_service.patch_user(user_id, user_data, if_match, session)
+        response.headers.update(_validator_headers(make_etag(user.id, user.date_updated), user.date_updated))
+        return user
+    except IntegrityError as e:
+        await session.rollback()  # Rollback in case of an error
+        if 'username' in str(e.orig):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already exists")
+        if 'email' in str(e.orig):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already exists")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unique constraint violation")
+    except HTTPException:
+        await session.rollback()
+        raise
     except Exception as e:
         await session.rollback()  # Rollback in case of an error
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
 
-@router.delete("/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_user(user_id: int, session: AsyncSession = Depends(get_session)):
+@router.delete("/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT, dependencies=CHEAP)
+async def delete_user(user_id: int, session: AsyncSession = Depends(get_session, scope="function")):
     try:
         await user_service.delete_user(user_id, session)
         return Response(status_code=status.HTTP_204_NO_CONTENT)
+    except HTTPException:
+        await session.rollback()
+        raise
     except Exception as e:
         await session.rollback()  # Rollback in case of an error
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-
@@ -1,6 +1,6 @@
 from pydantic import BaseModel, ConfigDict
-from datetime import datetime
-from typing import Optional
+from datetime import date, datetime
+from typing import Literal, Optional
 
 
 class UserModel(BaseModel):
@@ -17,6 +17,28 @@ class UserModel(BaseModel):
     )
 
 
+class UserPageModel(BaseModel):
+    items: list[UserModel]
+    next_cursor: Optional[str] = None
+
+
+class UserBatchGetModel(BaseModel):
+    ids: list[int]
+
+    model_config = ConfigDict(
+        json_schema_extra={
+            "example": {
+                "ids": [1, 2, 3]
+            }
+        }
+    )
+
+
+class UserBatchModel(BaseModel):
+    users: list[UserModel]
+    missing: list[int]
+
+
 class UserCreateModel(BaseModel):
     username: str
     email: str
@@ -36,6 +58,23 @@ class UserCreateModel(BaseModel):
     )
 
 
+class UserImportResultModel(BaseModel):
+    index: int
+    username: Optional[str] = None
+    id: Optional[int] = None
+    status: Literal["inserted", "updated", "skipped", "conflict", "invalid"]
+    reason: Optional[str] = None
+
+
+class UserImportSummaryModel(BaseModel):
+    inserted: int = 0
+    updated: int = 0
+    skipped: int = 0
+    conflict: int = 0
+    invalid: int = 0
+    results: list[UserImportResultModel]
+
+
 class UserUpdateModel(BaseModel):
     username: Optional[str]
     email: Optional[str]
@@ -53,3 +92,85 @@ class UserUpdateModel(BaseModel):
             }
         }
     )
+
+
+class UserPatchModel(BaseModel):
+    username: Optional[str] = None
+    email: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+
+    model_config = ConfigDict(
+        from_attributes=True,
+        json_schema_extra={
+            "example": {
+                "email": "johnnydoe@gmail.com"
+            }
+        }
+    )
+
+
+class UserFilterModel(BaseModel):
+    username: Optional[str] = None
+    username_prefix: Optional[str] = None
+    email: Optional[str] = None
+    email_domain: Optional[str] = None
+    name: Optional[str] = None
+
+
+class UserBulkDeleteModel(BaseModel):
+    ids: Optional[list[int]] = None
+    filter: Optional[UserFilterModel] = None
+    dry_run: bool = False
+
+    model_config = ConfigDict(
+        json_schema_extra={
+            "example": {
+                "filter": {"email_domain": "oldcorp.com"},
+                "dry_run": True
+            }
+        }
+    )
+
+
+class UserBulkChangesModel(BaseModel):
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    # Replaces everything after the @ of each email
+    email_domain: Optional[str] = None
+
+
+class UserBulkUpdateModel(UserBulkDeleteModel):
+    changes: UserBulkChangesModel
+
+    model_config = ConfigDict(
+        json_schema_extra={
+            "example": {
+                "filter": {"email_domain": "oldcorp.com"},
+                "changes": {"email_domain": "newcorp.com"},
+                "dry_run": False
+            }
+        }
+    )
+
+
+class UserBulkResultModel(BaseModel):
+    dry_run: bool
+    affected: int
+    ids: list[int]
+    error: Optional[str] = None
+
+
+class UserDailyCountModel(BaseModel):
+    date: date
+    count: int
+
+
+class UserStatsModel(BaseModel):
+    total: int
+    # True when total comes from the database planner's estimate
+    total_is_estimate: bool
+    days: int
+    created_per_day: list[UserDailyCountModel]
+    hours: int
+    updated_recently: int
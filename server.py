@@ -0,0 +1,61 @@
+import math
+import os
+from typing import Optional
+import uvicorn
+from settings import Settings, get_settings
+
+
+def cgroup_cpu_limit() -> Optional[int]:
+    # CPU quota of the container (docker --cpus, Kubernetes limits), which
+    # affinity doesn't reflect. cgroup v2 first, then v1; None when unlimited.
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = f.read().strip()
+        except OSError:
+            return None
+    if quota == "max" or int(quota) <= 0 or int(period) <= 0:
+        return None
+    return max(1, math.ceil(int(quota) / int(period)))
+
+
+def worker_count(settings: Settings) -> int:
+    if settings.server_workers > 0:
+        return settings.server_workers
+    # Respect CPU affinity and container cpusets where the platform exposes them
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    return min(cpus, limit) if limit is not None else cpus
+
+
+def main() -> None:
+    settings = get_settings()
+    # Each worker builds its own app through the factory and its own engine
+    # in the lifespan, so connections are never shared across processes
+    uvicorn.run(
+        "main:create_app",
+        factory=True,
+        host=settings.server_host,
+        port=settings.server_port,
+        workers=worker_count(settings),
+        loop=settings.server_loop,
+        http=settings.server_http,
+        timeout_keep_alive=settings.server_keep_alive,
+        backlog=settings.server_backlog,
+        timeout_graceful_shutdown=settings.server_graceful_timeout,
+        proxy_headers=True,
+        forwarded_allow_ips=settings.server_forwarded_allow_ips,
+        access_log=settings.server_access_log,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import asyncio
+import heapq
+import itertools
+import time
+from enum import IntEnum
+from typing import Optional
+
+
+class Priority(IntEnum):
+    # Lower values are admitted first
+    HIGH = 0
+    LOW = 1
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__("Rate limit exceeded")
+        self.retry_after = retry_after
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__("Server is overloaded")
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    # One token bucket per client: `rate` requests per second on average, in
+    # bursts of up to `burst`. A rate of 0 disables limiting.
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.limited = 0
+        self._buckets: dict[str, tuple[float, float]] = {}
+
+    def acquire(self, client: str) -> None:
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[client] = (tokens, now)
+            self.limited += 1
+            raise RateLimitExceeded((1 - tokens) / self.rate)
+        if len(self._buckets) > 10_000:
+            # Buckets that have refilled are the same as new ones
+            self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                             if bucket[0] + (now - bucket[1]) * self.rate < self.burst}
+        self._buckets[client] = (tokens - 1, now)
+
+    def get_stats(self) -> dict:
+        return {"limited": self.limited, "clients": len(self._buckets)}
+
+
+class AdmissionController:
+    # Caps concurrent DB-backed requests so excess load queues here, in
+    # priority order, instead of on pool checkout. Low priority requests can't
+    # take the last `reserved` slots, so cheap requests keep headroom while
+    # expensive ones pile up. Requests whose expected wait exceeds `max_wait`
+    # are rejected at once; queued ones give up after `max_wait`.
+    def __init__(self, limit: int, max_wait: float, reserved: int = 0):
+        self.limit = limit
+        self.max_wait = max_wait
+        self.reserved = max(0, min(reserved, limit - 1))
+        self.active = 0
+        self.admitted = 0
+        self.shed = 0
+        self.timeouts = 0
+        # Moving average of how long a request holds its slot
+        self.hold_seconds = 0.0
+        self._queue: list[tuple[int, int, asyncio.Future]] = []
+        self._waiting = {priority: 0 for priority in Priority}
+        self._order = itertools.count()
+
+    def _capacity(self, priority: Priority) -> int:
+        return self.limit if priority is Priority.HIGH else self.limit - self.reserved
+
+    def _waiting_ahead(self, priority: Priority) -> int:
+        return sum(count for waiting, count in self._waiting.items() if waiting <= priority)
+
+    def expected_wait(self, priority: Priority) -> float:
+        return (self._waiting_ahead(priority) + 1) * self.hold_seconds / self._capacity(priority)
+
+    async def acquire(self, priority: Priority) -> float:
+        # Returns the seconds spent queueing
+        if self.limit <= 0:
+            return 0.0
+        if not self._waiting_ahead(priority) and self.active < self._capacity(priority):
+            self.active += 1
+            self.admitted += 1
+            return 0.0
+        expected = self.expected_wait(priority)
+        if expected > self.max_wait:
+            self.shed += 1
+            raise Overloaded(expected)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._order), future))
+        self._waiting[priority] += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Admitted just as the wait ended; pass the slot on
+                self.release()
+            else:
+                self._waiting[priority] -= 1
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.timeouts += 1
+            raise Overloaded(self.max_wait)
+        return time.perf_counter() - start
+
+    def release(self, held_seconds: Optional[float] = None) -> None:
+        if self.limit <= 0:
+            return
+        if held_seconds is not None:
+            self.hold_seconds = held_seconds if not self.hold_seconds else self.hold_seconds * 0.9 + held_seconds * 0.1
+        self.active -= 1
+        while self._queue:
+            priority, _, future = self._queue[0]
+            if future.done():
+                # Timed out or cancelled while queued
+                heapq.heappop(self._queue)
+                continue
+            if self.active >= self._capacity(priority):
+                break
+            heapq.heappop(self._queue)
+            self._waiting[priority] -= 1
+            self.active += 1
+            self.admitted += 1
+            future.set_result(None)
+
+    def get_stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "reserved": self.reserved,
+            "active": self.active,
+            "waiting": {priority.name.lower(): count for priority, count in self._waiting.items()},
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "timeouts": self.timeouts,
+            "hold_ms": self.hold_seconds * 1000,
+        }
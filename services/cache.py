@@ -0,0 +1,209 @@
+import fnmatch
+import json
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, Optional
+from services.coalescing import SingleFlight
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def as_dict(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class LRUTTLCache:
+    # In-process backend: bounded by maxsize (least recently used entries are
+    # evicted first) and by ttl seconds per entry.
+    def __init__(self, maxsize: int = 10_000, ttl: float = 30.0, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    async def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= self.clock():
+            del self._entries[key]
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (self.clock() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    async def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class InMemoryRedis:
+    # Local stand-in for a Redis server implementing the subset of the
+    # redis.asyncio client API used by RedisCache.
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self._data: dict[str, tuple[Optional[float], bytes]] = {}
+
+    async def get(self, name: str) -> Optional[bytes]:
+        entry = self._data.get(name)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= self.clock():
+            del self._data[name]
+            return None
+        return value
+
+    async def set(self, name: str, value, ex: Optional[float] = None, px: Optional[int] = None) -> bool:
+        if isinstance(value, str):
+            value = value.encode()
+        expires_at = None
+        if ex is not None:
+            expires_at = self.clock() + ex
+        elif px is not None:
+            expires_at = self.clock() + px / 1000
+        self._data[name] = (expires_at, value)
+        return True
+
+    async def delete(self, *names: str) -> int:
+        return sum(self._data.pop(name, None) is not None for name in names)
+
+    async def scan_iter(self, match: Optional[str] = None, count: Optional[int] = None) -> AsyncIterator[str]:
+        for name in list(self._data):
+            if match is None or fnmatch.fnmatchcase(name, match):
+                yield name
+
+
+class RedisCache:
+    # Backend for any redis.asyncio compatible client. Values are stored
+    # serialized so the cache can be shared between workers.
+    def __init__(self, client, ttl: float = 30.0, prefix: str = "cache:",
+                 dumps: Callable[[Any], str] = json.dumps, loads: Callable[[bytes], Any] = json.loads):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.dumps = dumps
+        self.loads = loads
+        # Redis evicts on its own; the server's evicted_keys stat covers it
+        self.evictions = 0
+
+    async def get(self, key: Hashable) -> Optional[Any]:
+        raw = await self.client.get(f"{self.prefix}{key}")
+        if raw is None:
+            return None
+        return self.loads(raw)
+
+    async def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        await self.client.set(f"{self.prefix}{key}", self.dumps(value), px=int(ttl * 1000))
+
+    async def delete(self, key: Hashable) -> None:
+        await self.client.delete(f"{self.prefix}{key}")
+
+    async def clear(self) -> None:
+        # Only this cache's keys; the database may be shared with other data
+        names = []
+        async for name in self.client.scan_iter(match=f"{self.prefix}*", count=500):
+            names.append(name)
+            if len(names) == 500:
+                await self.client.delete(*names)
+                names = []
+        if names:
+            await self.client.delete(*names)
+
+
+class ReadThroughCache:
+    def __init__(self, backend, single_flight: Optional[SingleFlight] = None):
+        self.backend = backend
+        self.stats = CacheStats()
+        self.single_flight = single_flight if single_flight is not None else SingleFlight()
+        self._loading: dict[Hashable, object] = {}
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]],
+                          ttl: Optional[float] = None) -> Any:
+        # ttl overrides the backend's TTL for this load, e.g. to keep snapshots
+        # from a lagging replica briefly
+        value = await self.backend.get(key)
+        if value is not None:
+            self.stats.hits += 1
+            return value
+        self.stats.misses += 1
+        return await self.single_flight.do(key, lambda: self._load(key, loader, ttl))
+
+    async def peek(self, key: Hashable) -> Optional[Any]:
+        return await self.backend.get(key)
+
+    async def get_many_or_load(self, keys: list[Hashable], loader: Callable[[list[Hashable]], Awaitable[dict]],
+                               ttl: Optional[float] = None) -> dict:
+        found = {}
+        missing = []
+        for key in keys:
+            value = await self.backend.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        self.stats.hits += len(found)
+        self.stats.misses += len(missing)
+        if not missing:
+            return found
+
+        tokens = {key: object() for key in missing}
+        self._loading.update(tokens)
+        try:
+            loaded = await loader(missing)
+        finally:
+            for key, token in tokens.items():
+                if self._loading.get(key) is token:
+                    del self._loading[key]
+                else:
+                    tokens[key] = None
+        for key, value in loaded.items():
+            if tokens.get(key) is not None and value is not None:
+                await self.backend.set(key, value, ttl)
+        found.update(loaded)
+        return found
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], ttl: Optional[float] = None) -> Any:
+        token = self._loading[key] = object()
+        try:
+            value = await loader()
+        except BaseException:
+            if self._loading.get(key) is token:
+                del self._loading[key]
+            raise
+        # A load that was invalidated while in flight must not be cached
+        if self._loading.get(key) is token:
+            del self._loading[key]
+            if value is not None:
+                await self.backend.set(key, value, ttl)
+        return value
+
+    async def invalidate(self, key: Hashable) -> None:
+        self._loading.pop(key, None)
+        self.single_flight.forget(key)
+        await self.backend.delete(key)
+
+    def get_stats(self) -> dict:
+        stats = self.stats.as_dict()
+        stats["evictions"] = self.backend.evictions
+        return stats
@@ -0,0 +1,151 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Awaitable, Callable, Optional
+from sqlalchemy import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+from repositories.user_repository import UserRepository
+
+
+class Subscription:
+    def __init__(self, start_id: Optional[int], maxsize: int):
+        # Events up to start_id were published before subscribing and are
+        # read back from the outbox table instead
+        self.start_id = start_id
+        self.queue: asyncio.Queue[Optional[Row]] = asyncio.Queue(maxsize)
+
+    def put(self, event: Row) -> bool:
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def close(self) -> None:
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def get(self) -> Optional[Row]:
+        return await self.queue.get()
+
+
+class ChangeFeed:
+    # Relays outbox rows to in-process subscribers. Each worker tails the
+    # table on its own, so no row is ever marked as published.
+    def __init__(self, session_factory: Callable[[], AsyncSession], poll_interval: float = 1.0, batch_size: int = 500,
+                 gap_timeout: float = 2.0, queue_size: int = 1000, retention: timedelta = timedelta(days=7),
+                 on_event: Optional[Callable[[Row], Awaitable[None]]] = None):
+        self.session_factory = session_factory
+        # Awaited for every relayed event, including those written by other workers
+        self.on_event = on_event
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.gap_timeout = gap_timeout
+        self.queue_size = queue_size
+        self.retention = retention
+        self.user_repository = UserRepository()
+        self.last_id: Optional[int] = None
+        self.published = 0
+        self.dropped_subscribers = 0
+        self._subscribers: set[Subscription] = set()
+        self._wakeup = asyncio.Event()
+        self._gap_since: Optional[float] = None
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self.last_id, self.queue_size)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscribers.discard(subscription)
+
+    def close(self) -> None:
+        # Ends every open stream so shutdown doesn't wait on idle subscribers
+        for subscription in list(self._subscribers):
+            self.unsubscribe(subscription)
+            subscription.close()
+
+    def _publish(self, event: Row) -> None:
+        for subscription in list(self._subscribers):
+            if not subscription.put(event):
+                # Too slow to keep up: end its stream so it resumes from the table
+                self.unsubscribe(subscription)
+                subscription.close()
+                self.dropped_subscribers += 1
+        self.published += 1
+
+    async def relay_once(self) -> int:
+        async with self.session_factory() as session:
+            if self.last_id is None:
+                self.last_id = (await self.user_repository.get_event_id_range(session))[1] or 0
+            events = await self.user_repository.get_events(session, self.last_id, self.batch_size)
+        published = 0
+        for event in events:
+            if event.id != self.last_id + 1:
+                # A transaction holding a lower id may not have committed yet;
+                # only skip the gap once it has been open for gap_timeout
+                now = time.monotonic()
+                if self._gap_since is None:
+                    self._gap_since = now
+                if now - self._gap_since < self.gap_timeout:
+                    break
+            self._gap_since = None
+            self.last_id = event.id
+            self._publish(event)
+            if self.on_event is not None:
+                await self.on_event(event)
+            published += 1
+        return published
+
+    async def prune(self) -> int:
+        async with self.session_factory() as session:
+            return await self.user_repository.prune_events(session, datetime.now(timezone.utc) - self.retention)
+
+    async def run(self) -> None:
+        next_prune = 0.0
+        while True:
+            published = 0
+            try:
+                published = await self.relay_once()
+                if time.monotonic() >= next_prune:
+                    await self.prune()
+                    next_prune = time.monotonic() + 3600
+            except Exception:
+                # The database may be briefly unavailable; retry on the next poll
+                pass
+            if published < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def read(self, after_id: int, up_to: Optional[int]) -> AsyncIterator[Row]:
+        # Short-lived sessions per batch so a catching-up subscriber never pins a connection
+        while True:
+            async with self.session_factory() as session:
+                events = await self.user_repository.get_events(session, after_id, self.batch_size, up_to)
+            for event in events:
+                yield event
+            if len(events) < self.batch_size:
+                return
+            after_id = events[-1].id
+
+    async def is_retained(self, after_id: int) -> bool:
+        # False when events after after_id have already been pruned. An empty
+        # table may have been pruned too, so there is nothing to resume from.
+        async with self.session_factory() as session:
+            first_id, _ = await self.user_repository.get_event_id_range(session)
+        return first_id is not None and after_id >= first_id - 1
+
+    def get_stats(self) -> dict:
+        return {
+            "last_id": self.last_id,
+            "published": self.published,
+            "subscribers": len(self._subscribers),
+            "dropped_subscribers": self.dropped_subscribers,
+        }
@@ -0,0 +1,59 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+
+class CoalescedWaitTimeout(TimeoutError):
+    pass
+
+
+class SingleFlight:
+    # Concurrent calls for the same key share one in-flight load. Waiters give
+    # up after timeout seconds instead of queueing behind a stuck load.
+    def __init__(self, timeout: Optional[float] = None):
+        self.timeout = timeout
+        self.executed = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    def forget(self, key: Hashable) -> None:
+        self._calls.pop(key, None)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise CoalescedWaitTimeout(f"Timed out waiting for the in-flight load of {key!r}")
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The caller running the load was cancelled (e.g. its client
+                # disconnected), not this one: take over the load
+                return await self.do(key, fn)
+
+        self.executed += 1
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark as retrieved so a failure without waiters is not logged
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def get_stats(self) -> dict:
+        return {"executed": self.executed, "coalesced": self.coalesced, "timeouts": self.timeouts}
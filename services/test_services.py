@@ -1,16 +1,25 @@
 import unittest
-from unittest.mock import patch, AsyncMock
+from unittest.mock import patch, AsyncMock, MagicMock
 from services.user_service import UserService
-from schemas import UserCreateModel, UserModel, UserUpdateModel
+from services.cache import InMemoryRedis, LRUTTLCache, ReadThroughCache, RedisCache
+from services.change_feed import ChangeFeed
+from services.admission import AdmissionController, Overloaded, Priority, RateLimiter, RateLimitExceeded
+from services.coalescing import CoalescedWaitTimeout, SingleFlight
+from schemas import UserCreateModel, UserModel, UserUpdateModel, UserPatchModel
+from etags import make_etag
+from fastapi import HTTPException
+from datetime import datetime, timezone
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 import asyncio
 
+
 class TestUserServices(unittest.IsolatedAsyncioTestCase):
 
     @patch('services.user_service.UserService.get_user')
     async def test_create_user(self, mock_get_user):
         mock_repository = AsyncMock()
-        
+
         # Create a valid UserModel instance that matches the schema
         mock_user_instance = UserModel(
             id=1,
@@ -21,7 +30,7 @@ class TestUserServices(unittest.IsolatedAsyncioTestCase):
             date_created='2024-07-14T12:00:00Z',  # Example date
             date_updated='2024-07-14T12:00:00Z',  # Example date
         )
-        
+
         # Configure the create method of the mock repository to return the mock instance
         mock_repository.create.return_value = mock_user_instance
 
@@ -48,11 +57,11 @@ class TestUserServices(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(result.id, 1)  # Adjust as per your actual schema and mock data
         self.assertIsNotNone(result.date_created)
         self.assertIsNotNone(result.date_updated)
-    
+
     @patch('services.user_service.UserService.get_user')
     async def test_get_user(self, mock_get_user):
         mock_repository = AsyncMock()
-        
+
         # Mock the repository to return a user when queried by ID
         mock_get_user.return_value = UserModel(
             id=1,
@@ -63,7 +72,7 @@ class TestUserServices(unittest.IsolatedAsyncioTestCase):
             date_created='2024-07-14T12:00:00Z',  # Example date
             date_updated='2024-07-14T12:00:00Z',  # Example date
         )
-        
+
         user_service = UserService()
         user_service.user_repository = mock_repository
 
@@ -79,10 +88,10 @@ class TestUserServices(unittest.IsolatedAsyncioTestCase):
     @patch('services.user_service.UserService.get_user')
     async def test_get_user_nonexistent_user(self, mock_get_user):
         mock_repository = AsyncMock()
-        
+
         # Mock the repository to return None when queried by ID, indicating user does not exist
         mock_get_user.return_value = None
-        
+
         user_service = UserService()
         user_service.user_repository = mock_repository
 
@@ -92,10 +101,447 @@ class TestUserServices(unittest.IsolatedAsyncioTestCase):
         # Assert that result is None
         self.assertIsNone(result)
 
+    async def test_get_users_page(self):
+        mock_repository = AsyncMock()
+        mock_repository.get_page.return_value = [MagicMock(id=i) for i in (1, 2, 3)]
+
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        users, last_id = await user_service.get_users_page(2, None, session)
+
+        # One extra row is requested to detect the next page
+        mock_repository.get_page.assert_called_once_with(session, 3, None, None)
+        self.assertEqual([user.id for user in users], [1, 2])
+        self.assertEqual(last_id, 2)
+
+    async def test_get_users_page_last_page(self):
+        mock_repository = AsyncMock()
+        mock_repository.get_page.return_value = [MagicMock(id=4)]
+
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        users, last_id = await user_service.get_users_page(2, 3, session)
+
+        mock_repository.get_page.assert_called_once_with(session, 3, 3, None)
+        self.assertEqual(len(users), 1)
+        self.assertIsNone(last_id)
+
+    async def test_get_users_page_fields_loads_cursor_column(self):
+        mock_repository = AsyncMock()
+        mock_repository.get_page.return_value = []
+
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        await user_service.get_users_page(2, None, session, ('username',))
+        await user_service.get_users(session, ('username',))
+
+        mock_repository.get_page.assert_called_once_with(session, 3, None, ('username', 'id'))
+        mock_repository.get_all.assert_called_once_with(session, ('username',))
+
+    async def test_get_users_updated_since_cursor_is_last_row(self):
+        since = datetime(2024, 7, 15, 12, tzinfo=timezone.utc)
+        rows = [MagicMock(id=user_id, date_updated=since) for user_id in (4, 2, 9)]
+        mock_repository = AsyncMock()
+        mock_repository.get_updated_since.return_value = rows
+
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        users, last = await user_service.get_users_updated_since(since, 2, None, session, ('username',))
+
+        self.assertEqual(users, rows[:2])
+        self.assertEqual(last, (since, 2))
+        mock_repository.get_updated_since.assert_called_once_with(session, since, 3, None,
+                                                                  ('username', 'id', 'date_updated'))
+
+    async def test_get_user_uses_cache(self):
+        mock_repository = AsyncMock()
+        mock_repository.get_by_id.return_value = UserModel(
+            id=1,
+            username='testuser',
+            email='testuser@example.com',
+            first_name='Test',
+            last_name='User',
+            date_created='2024-07-14T12:00:00Z',
+            date_updated='2024-07-14T12:00:00Z',
+        )
+
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        first = await user_service.get_user(1, session)
+        second = await user_service.get_user(1, session)
+
+        self.assertEqual(first, second)
+        mock_repository.get_by_id.assert_called_once_with(session, 1)
+        self.assertEqual(user_service.cache.get_stats(), {'hits': 1, 'misses': 1, 'evictions': 0})
+
+    async def test_replica_reads_are_cached_briefly_and_writers_bypass_cache(self):
+        old, new = (UserModel(id=1, username='testuser', email='testuser@example.com', first_name=name,
+                              last_name='User', date_created='2024-07-14T12:00:00Z', date_updated=updated)
+                    for name, updated in (('Old', '2024-07-14T12:00:00Z'), ('New', '2024-07-15T12:00:00Z')))
+        mock_repository = AsyncMock()
+        mock_repository.get_by_id.side_effect = [old, new, new]
+        mock_repository.get_many.return_value = [new]
+        mock_repository.get_version.return_value = new.date_updated
+
+        user_service = UserService(cache_ttl=30, replica_cache_ttl=2)
+        user_service.user_repository = mock_repository
+        now = [0.0]
+        user_service.cache.backend.clock = lambda: now[0]
+        replica, primary = AsyncSession(), AsyncSession()
+        replica.info["replica"] = True
+        primary.info["read_your_writes"] = True
+
+        # A lagging replica's snapshot is cached, but only for replica_cache_ttl
+        self.assertEqual((await user_service.get_user(1, replica)).first_name, 'Old')
+        self.assertEqual((await user_service.get_user(1, replica)).first_name, 'Old')
+        self.assertEqual(user_service.cache.get_stats(), {'hits': 1, 'misses': 1, 'evictions': 0})
+
+        # The writer reads the primary, not the cached snapshot
+        self.assertEqual((await user_service.get_user(1, primary)).first_name, 'New')
+        self.assertEqual(await user_service.get_user_version(1, primary), new.date_updated)
+        users, _ = await user_service.get_users_by_ids([1], primary)
+        self.assertEqual(users[0].first_name, 'New')
+        mock_repository.get_many.assert_called_once_with(primary, [1])
+
+        now[0] = 2.5
+        self.assertEqual((await user_service.get_user(1, replica)).first_name, 'New')
+        self.assertEqual(mock_repository.get_by_id.call_count, 3)
+
+    async def test_concurrent_replica_reads_share_one_load(self):
+        release = asyncio.Event()
+        user = UserModel(id=1, username='testuser', email='testuser@example.com', first_name='Test',
+                         last_name='User', date_created='2024-07-14T12:00:00Z', date_updated='2024-07-14T12:00:00Z')
+
+        async def get_by_id(session, user_id):
+            await release.wait()
+            return user
+
+        mock_repository = AsyncMock()
+        mock_repository.get_by_id.side_effect = get_by_id
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        replica = AsyncSession()
+        replica.info["replica"] = True
+
+        reads = [asyncio.create_task(user_service.get_user(1, replica)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        self.assertEqual(await asyncio.gather(*reads), [user] * 5)
+        mock_repository.get_by_id.assert_called_once()
+        self.assertEqual(user_service.single_flight.get_stats()['coalesced'], 4)
+
+    async def test_get_user_version_from_cache(self):
+        mock_repository = AsyncMock()
+        mock_repository.get_by_id.return_value = UserModel(
+            id=1,
+            username='testuser',
+            email='testuser@example.com',
+            first_name='Test',
+            last_name='User',
+            date_created='2024-07-14T12:00:00Z',
+            date_updated='2024-07-14T12:00:00Z',
+        )
+        mock_repository.get_version.return_value = datetime(2024, 7, 15, tzinfo=timezone.utc)
+
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        self.assertEqual(await user_service.get_user_version(1, session),
+                         datetime(2024, 7, 15, tzinfo=timezone.utc))
+        await user_service.get_user(1, session)
+        self.assertEqual(await user_service.get_user_version(1, session),
+                         datetime(2024, 7, 14, 12, tzinfo=timezone.utc))
+        mock_repository.get_version.assert_called_once_with(session, 1)
+
+    async def test_concurrent_get_user_coalesces_without_cache(self):
+        mock_repository = AsyncMock()
+
+        async def get_by_id(session, user_id):
+            await asyncio.sleep(0.01)
+            return UserModel(
+                id=user_id,
+                username='testuser',
+                email='testuser@example.com',
+                first_name='Test',
+                last_name='User',
+                date_created='2024-07-14T12:00:00Z',
+                date_updated='2024-07-14T12:00:00Z',
+            )
+
+        async def get_version(session, user_id):
+            await asyncio.sleep(0.01)
+            return datetime(2024, 7, 15, tzinfo=timezone.utc)
+
+        mock_repository.get_by_id.side_effect = get_by_id
+        mock_repository.get_version.side_effect = get_version
+
+        user_service = UserService(cache_maxsize=0)
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        users = await asyncio.gather(*(user_service.get_user(1, session) for _ in range(5)))
+        versions = await asyncio.gather(*(user_service.get_user_version(1, session) for _ in range(5)))
+
+        self.assertTrue(all(user.id == 1 for user in users))
+        self.assertEqual(set(versions), {datetime(2024, 7, 15, tzinfo=timezone.utc)})
+        self.assertEqual(mock_repository.get_by_id.await_count, 1)
+        self.assertEqual(mock_repository.get_version.await_count, 1)
+        self.assertEqual(user_service.single_flight.get_stats(), {'executed': 2, 'coalesced': 8, 'timeouts': 0})
+        # Nothing is cached, so the next read goes back to the database
+        await user_service.get_user(1, session)
+        self.assertEqual(mock_repository.get_by_id.await_count, 2)
+
+    async def test_update_user_invalidates_cache(self):
+        mock_repository = AsyncMock()
+        mock_repository.get_by_id.return_value = UserModel(
+            id=1,
+            username='testuser',
+            email='testuser@example.com',
+            first_name='Test',
+            last_name='User',
+            date_created='2024-07-14T12:00:00Z',
+            date_updated='2024-07-14T12:00:00Z',
+        )
+
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        await user_service.get_user(1, session)
+        await user_service.update_user(1, UserUpdateModel(
+            username='testuser_updated',
+            email='testuser@example.com',
+            first_name='Test',
+            last_name='User',
+        ), session)
+        await user_service.get_user(1, session)
+
+        self.assertEqual(mock_repository.get_by_id.call_count, 2)
+
+    async def test_bulk_delete_walks_filter_in_chunks(self):
+        mock_repository = AsyncMock()
+        mock_repository.bulk_delete.side_effect = [[1, 2], [3, 4], [5]]
+        on_change = MagicMock()
+        user_service = UserService(on_change=on_change)
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        result = await user_service.bulk_delete_users(None, {'email_domain': 'old.com'}, False, session,
+                                                      chunk_size=2)
+
+        self.assertEqual(result, {'dry_run': False, 'affected': 5, 'ids': [1, 2, 3, 4, 5], 'error': None})
+        self.assertEqual([call.kwargs['after_id'] for call in mock_repository.bulk_delete.call_args_list],
+                         [None, 2, 4])
+        self.assertEqual(on_change.call_count, 3)
+
+    async def test_bulk_update_stops_at_conflict(self):
+        mock_repository = AsyncMock()
+        mock_repository.bulk_update.side_effect = [
+            [1, 2], IntegrityError('UPDATE', {}, Exception('UNIQUE constraint failed: users.email'))]
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncMock(spec=AsyncSession)
+
+        result = await user_service.bulk_update_users({'email_domain': 'new.com'}, [5, 1, 2, 3], None, False,
+                                                      session, chunk_size=2)
+
+        self.assertEqual(result, {'dry_run': False, 'affected': 2, 'ids': [1, 2], 'error': 'Email already exists'})
+        self.assertEqual([call.kwargs['ids'] for call in mock_repository.bulk_update.call_args_list],
+                         [[1, 2], [3, 5]])
+        session.rollback.assert_awaited_once()
+
+    async def test_bulk_dry_run_only_counts(self):
+        mock_repository = AsyncMock()
+        mock_repository.count_matching.return_value = 3
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        result = await user_service.bulk_delete_users(None, {'username_prefix': 'test'}, True, session)
+
+        self.assertEqual(result, {'dry_run': True, 'affected': 3, 'ids': [], 'error': None})
+        mock_repository.bulk_delete.assert_not_called()
+
+    async def test_get_stats_uses_estimate_for_large_tables(self):
+        mock_repository = AsyncMock()
+        mock_repository.estimate_count.return_value = 2_000_000
+        mock_repository.count.return_value = 2_000_123
+        mock_repository.count_created_per_day.return_value = [MagicMock(date='2024-07-14', count=3)]
+        mock_repository.count_updated_since.return_value = 5
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        stats = await user_service.get_stats(7, 24, False, session)
+        await user_service.get_stats(7, 24, False, session)
+
+        self.assertEqual((stats['total'], stats['total_is_estimate']), (2_000_000, True))
+        self.assertEqual(stats['created_per_day'], [{'date': '2024-07-14', 'count': 3}])
+        self.assertEqual(stats['updated_recently'], 5)
+        mock_repository.count.assert_not_called()
+        # Served from the stats cache the second time
+        mock_repository.count_updated_since.assert_called_once()
+
+        stats = await user_service.get_stats(7, 24, True, session)
+        self.assertEqual((stats['total'], stats['total_is_estimate']), (2_000_123, False))
+        mock_repository.estimate_count.assert_called_once()
+
+    async def test_get_stats_counts_small_tables_exactly(self):
+        mock_repository = AsyncMock()
+        mock_repository.estimate_count.return_value = None
+        mock_repository.count.return_value = 42
+        mock_repository.count_created_per_day.return_value = []
+        mock_repository.count_updated_since.return_value = 0
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+
+        stats = await user_service.get_stats(30, 24, False, AsyncSession())
+
+        self.assertEqual((stats['total'], stats['total_is_estimate']), (42, False))
+
+    async def test_writes_notify_change_feed(self):
+        mock_repository = AsyncMock()
+        on_change = MagicMock()
+        user_service = UserService(on_change=on_change)
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        await user_service.delete_user(1, session)
+        on_change.assert_called_once_with()
+
+        mock_repository.delete.side_effect = HTTPException(status_code=404, detail='User not found')
+        with self.assertRaises(HTTPException):
+            await user_service.delete_user(1, session)
+        on_change.assert_called_once_with()
+
+    async def test_get_users_by_ids(self):
+        def make_user(user_id):
+            return UserModel(
+                id=user_id,
+                username=f'testuser{user_id}',
+                email=f'testuser{user_id}@example.com',
+                first_name='Test',
+                last_name='User',
+                date_created='2024-07-14T12:00:00Z',
+                date_updated='2024-07-14T12:00:00Z',
+            )
+
+        mock_repository = AsyncMock()
+        mock_repository.get_by_id.return_value = make_user(2)
+        mock_repository.get_many.return_value = [make_user(3), make_user(1)]
+
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+        await user_service.get_user(2, session)
+
+        users, missing = await user_service.get_users_by_ids([3, 2, 9, 1, 3], session)
+
+        # Cached user 2 is not fetched again; duplicates are collapsed
+        mock_repository.get_many.assert_called_once_with(session, [3, 9, 1])
+        self.assertEqual([user.id for user in users], [3, 2, 1])
+        self.assertEqual(missing, [9])
+
+    async def test_import_users_in_chunks(self):
+        async def items():
+            yield {'username': 'a', 'email': 'a@example.com', 'first_name': 'A', 'last_name': 'User'}
+            yield {'username': 'b', 'first_name': 'B', 'last_name': 'User'}
+            yield {'username': 'c', 'email': 'c@example.com', 'first_name': 'C', 'last_name': 'User'}
+            yield {'username': 'd', 'email': 'd@example.com', 'first_name': 'D', 'last_name': 'User'}
+
+        async def bulk_upsert(session, rows, update_existing):
+            return [{'username': row['username'], 'id': i, 'status': 'updated', 'reason': None}
+                    for i, row in enumerate(rows, start=1)]
+
+        mock_repository = AsyncMock()
+        mock_repository.bulk_upsert.side_effect = bulk_upsert
+
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        user_service.cache = AsyncMock()
+        session = AsyncSession()
+
+        results = await user_service.import_users(items(), True, session, chunk_size=2)
+
+        self.assertEqual(mock_repository.bulk_upsert.call_count, 2)
+        self.assertEqual([result['index'] for result in results], [0, 1, 2, 3])
+        self.assertEqual(results[1]['status'], 'invalid')
+        self.assertEqual(results[1]['reason'], 'email: Field required')
+        self.assertEqual(user_service.cache.invalidate.call_count, 3)
+
+    async def test_patch_user_writes_only_set_fields(self):
+        patched_user = MagicMock(id=1, date_updated=datetime(2024, 7, 14, tzinfo=timezone.utc))
+        mock_repository = AsyncMock()
+        mock_repository.patch.return_value = patched_user
+
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        result = await user_service.patch_user(1, UserPatchModel(email='new@example.com'), None, session)
+
+        self.assertIs(result, patched_user)
+        mock_repository.patch.assert_called_once_with(session, 1, {'email': 'new@example.com'}, None)
+        mock_repository.get_by_id.assert_not_called()
+
+    async def test_patch_user_without_changes_skips_write(self):
+        current_user = MagicMock(id=1, date_updated=datetime(2024, 7, 14, tzinfo=timezone.utc))
+        mock_repository = AsyncMock()
+        mock_repository.get_by_id.return_value = current_user
+
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        result = await user_service.patch_user(1, UserPatchModel(), None, session)
+
+        self.assertIs(result, current_user)
+        mock_repository.patch.assert_not_called()
+
+    async def test_patch_user_if_match(self):
+        date_updated = datetime(2024, 7, 14, tzinfo=timezone.utc)
+        mock_repository = AsyncMock()
+        mock_repository.patch.return_value = MagicMock(id=1)
+
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        await user_service.patch_user(1, UserPatchModel(first_name='New'), make_etag(1, date_updated), session)
+
+        mock_repository.patch.assert_called_once_with(session, 1, {'first_name': 'New'}, [date_updated])
+
+    async def test_patch_user_precondition_failed(self):
+        current_user = MagicMock(id=1, date_updated=datetime(2024, 7, 15, tzinfo=timezone.utc))
+        mock_repository = AsyncMock()
+        mock_repository.patch.return_value = None
+        mock_repository.get_by_id.return_value = current_user
+
+        user_service = UserService()
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+        stale_etag = make_etag(1, datetime(2024, 7, 14, tzinfo=timezone.utc))
+
+        with self.assertRaises(HTTPException) as context:
+            await user_service.patch_user(1, UserPatchModel(first_name='New'), stale_etag, session)
+
+        self.assertEqual(context.exception.status_code, 412)
+
     # @patch('services.user_service.UserService.get_user')
     # async def test_update_user(self, mock_get_user):
     #     mock_repository = AsyncMock()
-        
+
     #     # Mock the repository to return an existing user when queried by ID
     #     mock_get_user.return_value = UserModel(
     #         id=1,
@@ -106,7 +552,7 @@ class TestUserServices(unittest.IsolatedAsyncioTestCase):
     #         date_created='2024-07-14T12:00:00Z',  # Example date
     #         date_updated='2024-07-14T12:00:00Z',  # Example date
     #     )
-        
+
     #     user_service = UserService()
     #     user_service.user_repository = mock_repository
 
@@ -130,7 +576,7 @@ class TestUserServices(unittest.IsolatedAsyncioTestCase):
     @patch('services.user_service.UserService.get_user')
     async def test_delete_user(self, mock_get_user):
         mock_repository = AsyncMock()
-        
+
         # Mock the repository to return an existing user when queried by ID
         mock_get_user.return_value = UserModel(
             id=1,
@@ -141,7 +587,7 @@ class TestUserServices(unittest.IsolatedAsyncioTestCase):
             date_created='2024-07-14T12:00:00Z',  # Example date
             date_updated='2024-07-14T12:00:00Z',  # Example date
         )
-        
+
         user_service = UserService()
         user_service.user_repository = mock_repository
         session = AsyncSession()
@@ -151,7 +597,350 @@ class TestUserServices(unittest.IsolatedAsyncioTestCase):
 
         # Assert that the delete method was called on the repository
         mock_repository.delete.assert_called_once_with(session, 1)
+        self.assertIsNone(result)
+
+
+class TestReadThroughCache(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_misses_share_one_load(self):
+        cache = ReadThroughCache(LRUTTLCache())
+        calls = 0
+
+        async def loader():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return 'value'
+
+        results = await asyncio.gather(*(cache.get_or_load('key', loader) for _ in range(10)))
+
+        self.assertEqual(results, ['value'] * 10)
+        self.assertEqual(calls, 1)
+
+    async def test_load_error_propagates_to_all_waiters(self):
+        cache = ReadThroughCache(LRUTTLCache())
+
+        async def loader():
+            await asyncio.sleep(0.01)
+            raise LookupError('User not found')
+
+        results = await asyncio.gather(
+            *(cache.get_or_load('key', loader) for _ in range(3)), return_exceptions=True)
+
+        self.assertTrue(all(isinstance(result, LookupError) for result in results))
+        self.assertIsNone(await cache.backend.get('key'))
+
+    async def test_invalidate_during_load_is_not_cached(self):
+        cache = ReadThroughCache(LRUTTLCache())
+        loading = asyncio.Event()
+
+        async def loader():
+            loading.set()
+            await asyncio.sleep(0.01)
+            return 'stale'
+
+        task = asyncio.create_task(cache.get_or_load('key', loader))
+        await loading.wait()
+        await cache.invalidate('key')
+
+        self.assertEqual(await task, 'stale')
+        self.assertIsNone(await cache.backend.get('key'))
+
+    async def test_lru_ttl_evictions(self):
+        now = [0.0]
+        backend = LRUTTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+
+        await backend.set('a', 1)
+        await backend.set('b', 2)
+        await backend.get('a')
+        await backend.set('c', 3)
+
+        # 'b' was least recently used
+        self.assertIsNone(await backend.get('b'))
+        self.assertEqual(await backend.get('a'), 1)
+
+        now[0] = 11
+        self.assertIsNone(await backend.get('a'))
+        self.assertEqual(backend.evictions, 2)
+
+    async def test_redis_backend_round_trip(self):
+        backend = RedisCache(InMemoryRedis(), ttl=5, prefix='users:',
+                             dumps=lambda user: user.model_dump_json(),
+                             loads=UserModel.model_validate_json)
+        user = UserModel(
+            id=1,
+            username='testuser',
+            email='testuser@example.com',
+            first_name='Test',
+            last_name='User',
+            date_created='2024-07-14T12:00:00Z',
+            date_updated='2024-07-14T12:00:00Z',
+        )
+
+        await backend.set(1, user)
+        self.assertEqual(await backend.client.get('users:1'), user.model_dump_json().encode())
+        self.assertEqual(await backend.get(1), user)
+
+        await backend.delete(1)
+        self.assertIsNone(await backend.get(1))
+
+    async def test_redis_backend_clear_keeps_other_keys(self):
+        client = InMemoryRedis()
+        backend = RedisCache(client, ttl=5, prefix='users:')
+        await client.set('sessions:1', b'other')
+        for key in range(1200):
+            await backend.set(key, {'id': key})
+
+        await backend.clear()
+
+        self.assertIsNone(await backend.get(0))
+        self.assertIsNone(await backend.get(1199))
+        self.assertEqual(await client.get('sessions:1'), b'other')
+
+    async def test_user_service_redis_cache_round_trips_users(self):
+        user = UserModel(
+            id=1,
+            username='testuser',
+            email='testuser@example.com',
+            first_name='Test',
+            last_name='User',
+            date_created='2024-07-14T12:00:00Z',
+            date_updated='2024-07-14T12:00:00Z',
+        )
+        mock_repository = AsyncMock()
+        mock_repository.get_by_id.return_value = user
+        client = InMemoryRedis()
+
+        user_service = UserService(redis_client=client)
+        user_service.user_repository = mock_repository
+        session = AsyncSession()
+
+        self.assertEqual(await user_service.get_user(1, session), user)
+        self.assertEqual(await client.get('users:1'), user.model_dump_json().encode())
+        self.assertEqual(await user_service.get_user(1, session), user)
+        mock_repository.get_by_id.assert_called_once()
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+
+    async def test_waiter_times_out(self):
+        single_flight = SingleFlight(timeout=0.01)
+        release = asyncio.Event()
+
+        async def load():
+            await release.wait()
+            return 'value'
+
+        leader = asyncio.create_task(single_flight.do('key', load))
+        await asyncio.sleep(0)
+        with self.assertRaises(CoalescedWaitTimeout):
+            await single_flight.do('key', load)
+
+        # The leader is unaffected by the waiter giving up
+        release.set()
+        self.assertEqual(await leader, 'value')
+        self.assertEqual(single_flight.get_stats(), {'executed': 1, 'coalesced': 1, 'timeouts': 1})
+
+    async def test_waiter_takes_over_cancelled_load(self):
+        single_flight = SingleFlight()
+        calls = 0
+
+        async def load():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return calls
+
+        leader = asyncio.create_task(single_flight.do('key', load))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(single_flight.do('key', load))
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        self.assertEqual(await waiter, 2)
+        self.assertTrue(leader.cancelled())
+
+    async def test_forget_starts_a_new_load(self):
+        single_flight = SingleFlight()
+
+        async def load(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        first = asyncio.create_task(single_flight.do('key', lambda: load('stale')))
+        await asyncio.sleep(0)
+        single_flight.forget('key')
+        second = await single_flight.do('key', lambda: load('fresh'))
+
+        self.assertEqual(await first, 'stale')
+        self.assertEqual(second, 'fresh')
+        self.assertEqual(single_flight.coalesced, 0)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_bucket_refills(self):
+        now = [0.0]
+        limiter = RateLimiter(rate=2.0, burst=2)
+        with patch('services.admission.time.monotonic', side_effect=lambda: now[0]):
+            limiter.acquire('client')
+            limiter.acquire('client')
+            with self.assertRaises(RateLimitExceeded) as raised:
+                limiter.acquire('client')
+            self.assertEqual(raised.exception.retry_after, 0.5)
+            # Other clients have their own buckets
+            limiter.acquire('other')
+            now[0] = 0.5
+            limiter.acquire('client')
+        self.assertEqual(limiter.limited, 1)
+
+    def test_zero_rate_disables_limiting(self):
+        limiter = RateLimiter(rate=0, burst=1)
+        for _ in range(5):
+            limiter.acquire('client')
+        self.assertEqual(limiter.get_stats(), {'limited': 0, 'clients': 0})
+
+
+class TestAdmissionController(unittest.IsolatedAsyncioTestCase):
+
+    async def test_high_priority_is_admitted_first(self):
+        admission = AdmissionController(limit=1, max_wait=1.0)
+        await admission.acquire(Priority.HIGH)
+        low = asyncio.create_task(admission.acquire(Priority.LOW))
+        await asyncio.sleep(0)
+        high = asyncio.create_task(admission.acquire(Priority.HIGH))
+        await asyncio.sleep(0)
+
+        admission.release()
+        await high
+        self.assertFalse(low.done())
+        admission.release()
+        await low
+        self.assertEqual(admission.active, 1)
+        self.assertEqual(admission.admitted, 3)
+
+    async def test_reserved_slots_are_kept_for_high_priority(self):
+        admission = AdmissionController(limit=2, max_wait=0.01, reserved=1)
+        await admission.acquire(Priority.LOW)
+        with self.assertRaises(Overloaded):
+            await admission.acquire(Priority.LOW)
+        self.assertEqual(await admission.acquire(Priority.HIGH), 0.0)
+        self.assertEqual(admission.timeouts, 1)
+        self.assertEqual(admission.get_stats()['waiting'], {'high': 0, 'low': 0})
+
+    async def test_sheds_when_expected_wait_exceeds_budget(self):
+        admission = AdmissionController(limit=1, max_wait=0.5)
+        await admission.acquire(Priority.HIGH)
+        admission.release(held_seconds=1.0)
+        await admission.acquire(Priority.HIGH)
+
+        with self.assertRaises(Overloaded) as raised:
+            await admission.acquire(Priority.HIGH)
+        self.assertEqual(raised.exception.retry_after, 1.0)
+        self.assertEqual(admission.shed, 1)
+
+    async def test_cancelled_waiter_gives_up_its_place(self):
+        admission = AdmissionController(limit=1, max_wait=1.0)
+        await admission.acquire(Priority.HIGH)
+        first = asyncio.create_task(admission.acquire(Priority.HIGH))
+        second = asyncio.create_task(admission.acquire(Priority.HIGH))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+
+        admission.release()
+        await second
+        self.assertTrue(first.cancelled())
+        self.assertEqual(admission.active, 1)
+
+
+class TestChangeFeed(unittest.IsolatedAsyncioTestCase):
+    def make_feed(self, batches, **kwargs):
+        session = AsyncMock()
+        session_factory = MagicMock(return_value=MagicMock(
+            __aenter__=AsyncMock(return_value=session), __aexit__=AsyncMock(return_value=False)))
+        feed = ChangeFeed(session_factory, **kwargs)
+        feed.user_repository = AsyncMock()
+        feed.user_repository.get_event_id_range.return_value = (None, None)
+        feed.user_repository.get_events.side_effect = batches
+        return feed
+
+    async def test_relay_publishes_in_order(self):
+        events = [MagicMock(id=1), MagicMock(id=2)]
+        feed = self.make_feed([events])
+        subscription = feed.subscribe()
+
+        self.assertEqual(await feed.relay_once(), 2)
+        self.assertEqual([await subscription.get(), await subscription.get()], events)
+        self.assertEqual(feed.last_id, 2)
+
+    async def test_relay_passes_events_to_on_event(self):
+        events = [MagicMock(id=1, user_id=7), MagicMock(id=2, user_id=8)]
+        feed = self.make_feed([events])
+        feed.on_event = AsyncMock()
+
+        await feed.relay_once()
+
+        self.assertEqual([call.args[0] for call in feed.on_event.await_args_list], events)
+
+    async def test_relayed_event_invalidates_cached_user(self):
+        # Another worker updated user 1; this worker learns of it from the outbox
+        user_service = UserService()
+        feed = self.make_feed([[MagicMock(id=1, user_id=1, type='updated')]])
+        feed.on_event = user_service.apply_event
+        await user_service.cache.backend.set(1, MagicMock())
+
+        await feed.relay_once()
+
+        self.assertIsNone(await user_service.cache.peek(1))
+
+    async def test_relay_waits_for_gap(self):
+        now = [0.0]
+        events = [MagicMock(id=1), MagicMock(id=3)]
+        feed = self.make_feed([events, events[1:], events[1:]], gap_timeout=2.0)
+
+        with patch('services.change_feed.time.monotonic', side_effect=lambda: now[0]):
+            # id 2 may still be committing
+            self.assertEqual(await feed.relay_once(), 1)
+            self.assertEqual(await feed.relay_once(), 0)
+            now[0] = 3.0
+            self.assertEqual(await feed.relay_once(), 1)
+        self.assertEqual(feed.last_id, 3)
+
+    async def test_slow_subscriber_is_dropped(self):
+        feed = self.make_feed([[MagicMock(id=1), MagicMock(id=2)]], queue_size=1)
+        subscription = feed.subscribe()
+
+        await feed.relay_once()
+
+        self.assertIsNone(await subscription.get())
+        self.assertEqual(feed.get_stats()['subscribers'], 0)
+        self.assertEqual(feed.dropped_subscribers, 1)
+
+    async def test_close_ends_every_subscription(self):
+        feed = self.make_feed([[MagicMock(id=1)]])
+        subscriptions = [feed.subscribe(), feed.subscribe()]
+        await feed.relay_once()
+
+        feed.close()
+
+        for subscription in subscriptions:
+            self.assertIsNone(await subscription.get())
+        self.assertEqual(feed.get_stats()['subscribers'], 0)
+
+    async def test_is_retained(self):
+        feed = self.make_feed([])
+        feed.user_repository.get_event_id_range.return_value = (5, 9)
+
+        self.assertTrue(await feed.is_retained(4))
+        self.assertTrue(await feed.is_retained(9))
+        self.assertFalse(await feed.is_retained(3))
+
+    async def test_is_retained_false_when_outbox_empty(self):
+        # Every event may have been pruned since the cursor was issued
+        feed = self.make_feed([])
 
+        self.assertFalse(await feed.is_retained(3))
 
 
 if __name__ == '__main__':
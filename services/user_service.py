@@ -1,12 +1,74 @@
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Optional
+from pydantic import ValidationError
+from sqlalchemy import Row
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from schemas import UserCreateModel, UserUpdateModel
+from fastapi import HTTPException, status
+from etags import make_etag, parse_etag, split_etags
+from fieldsets import with_fields
+from schemas import UserModel, UserCreateModel, UserUpdateModel, UserPatchModel
 from models import User
 from repositories.user_repository import UserRepository
+from services.cache import LRUTTLCache, ReadThroughCache, RedisCache
+from services.coalescing import SingleFlight
+
+
+# Set on read sessions by dependencies.get_read_session. Clients that just
+# wrote read the primary and must not be answered from the cache or an
+# in-flight load that may predate their write; snapshots from a lagging
+# replica are cached for at most replica_cache_ttl seconds.
+def _reads_own_writes(session: AsyncSession) -> bool:
+    return session.info.get("read_your_writes", False)
+
+
+def _is_replica(session: AsyncSession) -> bool:
+    return session.info.get("replica", False)
 
 
 class UserService:
-    def __init__(self):
+    def __init__(self, cache: Optional[ReadThroughCache] = None, max_batch_size: int = 1000,
+                 on_change: Optional[Callable[[], None]] = None, coalesce_timeout: Optional[float] = 5.0,
+                 cache_maxsize: int = 10_000, cache_ttl: float = 30.0, redis_client=None,
+                 replica_cache_ttl: float = 5.0):
         self.user_repository = UserRepository()
+        # Concurrent reads of the same user share one query, even with caching
+        # disabled (cache_maxsize=0)
+        self.single_flight = SingleFlight(timeout=coalesce_timeout)
+        if cache is None:
+            if redis_client is not None:
+                # Shared between workers, so users are stored as their JSON documents
+                backend = RedisCache(redis_client, cache_ttl, prefix="users:", dumps=UserModel.model_dump_json,
+                                     loads=UserModel.model_validate_json)
+            else:
+                backend = LRUTTLCache(cache_maxsize, cache_ttl)
+            cache = ReadThroughCache(backend, single_flight=self.single_flight)
+        self.cache = cache
+        # A replica read can predate a write whose invalidation has already run,
+        # so it is cached no longer than replicas are allowed to lag
+        self.replica_cache_ttl = min(replica_cache_ttl, cache_ttl)
+        self.max_batch_size = max_batch_size
+        # Called after each committed write, e.g. to wake the change feed relay
+        self.on_change = on_change
+        # Dashboards poll stats; a few seconds of staleness saves the aggregates
+        self.stats_cache = ReadThroughCache(LRUTTLCache(maxsize=64, ttl=10.0))
+        # Below this many rows an exact count is cheap and the estimate unreliable
+        self.exact_count_threshold = 10_000
+
+    async def _invalidate(self, user_id: int) -> None:
+        # Readers arriving after a write must not join a load that started before it
+        self.single_flight.forget(user_id)
+        self.single_flight.forget(("version", user_id))
+        await self.cache.invalidate(user_id)
+
+    async def apply_event(self, event) -> None:
+        # Relayed from the user_events outbox, so writes made by other worker
+        # processes also evict this worker's cached copy
+        await self._invalidate(event.user_id)
+
+    def _changed(self) -> None:
+        if self.on_change is not None:
+            self.on_change()
 
     async def create_user(self, user_data: UserCreateModel, session: AsyncSession) -> User:
         new_user = User(
@@ -15,16 +77,246 @@ class UserService:
             first_name=user_data.first_name,
             last_name=user_data.last_name
         )
-        return await self.user_repository.add(session, new_user)
+        user = await self.user_repository.add(session, new_user)
+        self._changed()
+        return user
+
+    async def import_users(self, items: AsyncIterable[Any], update_existing: bool, session: AsyncSession,
+                           chunk_size: int = 1000) -> list[dict]:
+        results = []
+        chunk = []
+        index = 0
+        async for item in items:
+            try:
+                user_data = UserCreateModel.model_validate(item)
+            except ValidationError as e:
+                error = e.errors()[0]
+                reason = ": ".join(filter(None, [".".join(map(str, error["loc"])), error["msg"]]))
+                results.append({"index": index, "username": None, "id": None,
+                                "status": "invalid", "reason": reason})
+            else:
+                chunk.append((index, user_data.model_dump()))
+            index += 1
+            if len(chunk) >= chunk_size:
+                results.extend(await self._import_chunk(chunk, update_existing, session))
+                chunk = []
+        if chunk:
+            results.extend(await self._import_chunk(chunk, update_existing, session))
+        results.sort(key=lambda result: result["index"])
+        return results
+
+    async def _import_chunk(self, chunk: list[tuple[int, dict]], update_existing: bool,
+                            session: AsyncSession) -> list[dict]:
+        results = await self.user_repository.bulk_upsert(session, [row for _, row in chunk], update_existing)
+        for (index, _), result in zip(chunk, results):
+            result["index"] = index
+            if result["status"] == "updated":
+                await self._invalidate(result["id"])
+        if any(result["status"] in ("inserted", "updated") for result in results):
+            self._changed()
+        return results
+
+    async def get_user(self, user_id: int, session: AsyncSession) -> UserModel:
+        if _reads_own_writes(session):
+            return await self._load_user(user_id, session)
+        return await self.cache.get_or_load(user_id, lambda: self._load_user(user_id, session),
+                                            self._cache_ttl(session))
+
+    async def get_user_version(self, user_id: int, session: AsyncSession) -> Optional[datetime]:
+        # Answers conditional requests from the cache or a single-column lookup
+        if _reads_own_writes(session):
+            return await self.user_repository.get_version(session, user_id)
+        cached = await self.cache.peek(user_id)
+        if cached is not None:
+            return cached.date_updated
+        return await self.single_flight.do(
+            ("version", user_id), lambda: self.user_repository.get_version(session, user_id))
+
+    def _cache_ttl(self, session: AsyncSession) -> Optional[float]:
+        return self.replica_cache_ttl if _is_replica(session) else None
+
+    async def get_users_version(self, session: AsyncSession) -> Optional[int]:
+        return await self.user_repository.get_collection_version(session)
+
+    async def _load_user(self, user_id: int, session: AsyncSession) -> UserModel:
+        # Cache detached snapshots rather than ORM instances bound to a session
+        user = await self.user_repository.get_by_id(session, user_id)
+        return UserModel.model_validate(user)
+
+    async def get_users_by_ids(self, user_ids: list[int], session: AsyncSession) -> tuple[list[UserModel], list[int]]:
+        # Cached users are served directly, the rest are fetched in a single query
+        user_ids = list(dict.fromkeys(user_ids))
+        if _reads_own_writes(session):
+            found = await self._load_users(user_ids, session)
+        else:
+            found = await self.cache.get_many_or_load(user_ids, lambda missing: self._load_users(missing, session),
+                                                      self._cache_ttl(session))
+        users = [found[user_id] for user_id in user_ids if user_id in found]
+        missing = [user_id for user_id in user_ids if user_id not in found]
+        return users, missing
 
-    async def get_user(self, user_id: int, session: AsyncSession) -> User:
-        return await self.user_repository.get_by_id(session, user_id)
+    async def _load_users(self, user_ids: list[int], session: AsyncSession) -> dict[int, UserModel]:
+        users = await self.user_repository.get_many(session, user_ids)
+        return {user.id: UserModel.model_validate(user) for user in users}
 
-    async def get_users(self, session: AsyncSession) -> list[User]:
-        return await self.user_repository.get_all(session)
+    async def get_users(self, session: AsyncSession, fields: Optional[tuple[str, ...]] = None) -> list[Row]:
+        return await self.user_repository.get_all(session, fields)
+
+    async def get_users_updated_since(self, since: datetime, limit: int, after_id: Optional[int], session: AsyncSession,
+                                      fields: Optional[tuple[str, ...]] = None
+                                      ) -> tuple[list[Row], Optional[tuple[datetime, int]]]:
+        if fields is not None:
+            # The next cursor is the last row's date_updated and id
+            fields = with_fields(fields, "id", "date_updated")
+        users = await self.user_repository.get_updated_since(session, since, limit + 1, after_id, fields)
+        if len(users) > limit:
+            last = users[limit - 1]
+            return users[:limit], (last.date_updated, last.id)
+        return users, None
+
+    async def get_users_page(self, limit: int, after_id: Optional[int], session: AsyncSession,
+                             fields: Optional[tuple[str, ...]] = None) -> tuple[list[User], Optional[int]]:
+        # Fetch one extra row to learn whether another page exists
+        users = await self.user_repository.get_page(session, limit + 1, after_id, self._page_fields(fields))
+        return self._split_page(users, limit)
+
+    async def search_users(self, filters: dict, limit: int, after_id: Optional[int], session: AsyncSession,
+                           fields: Optional[tuple[str, ...]] = None) -> tuple[list[User], Optional[int]]:
+        users = await self.user_repository.search(session, limit + 1, after_id, **filters,
+                                                  fields=self._page_fields(fields))
+        return self._split_page(users, limit)
+
+    def _page_fields(self, fields: Optional[tuple[str, ...]]) -> Optional[tuple[str, ...]]:
+        # The next cursor is the last row's id
+        return with_fields(fields, "id") if fields is not None else None
+
+    async def get_stats(self, days: int, hours: int, exact: bool, session: AsyncSession) -> dict:
+        if exact:
+            return await self._load_stats(days, hours, exact, session)
+        return await self.stats_cache.get_or_load(
+            (days, hours), lambda: self._load_stats(days, hours, exact, session))
+
+    async def _load_stats(self, days: int, hours: int, exact: bool, session: AsyncSession) -> dict:
+        total = None if exact else await self.user_repository.estimate_count(session)
+        is_estimate = total is not None and total >= self.exact_count_threshold
+        if not is_estimate:
+            total = await self.user_repository.count(session)
+        now = datetime.now(timezone.utc)
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        created = await self.user_repository.count_created_per_day(session, today - timedelta(days=days - 1))
+        return {
+            "total": total,
+            "total_is_estimate": is_estimate,
+            "days": days,
+            "created_per_day": [{"date": row.date, "count": row.count} for row in created],
+            "hours": hours,
+            "updated_recently": await self.user_repository.count_updated_since(session, now - timedelta(hours=hours)),
+        }
+
+    def _split_page(self, users: list[User], limit: int) -> tuple[list[User], Optional[int]]:
+        if len(users) > limit:
+            return users[:limit], users[limit - 1].id
+        return users, None
+
+    async def stream_users(self, session: AsyncSession) -> AsyncIterator[Row]:
+        async for user in self.user_repository.stream_all(session):
+            yield user
 
     async def update_user(self, user_id: int, user_data: UserUpdateModel, session: AsyncSession) -> User:
-        return await self.user_repository.update(session, user_id, user_data.model_dump())
+        user = await self.user_repository.update(session, user_id, user_data.model_dump())
+        await self._invalidate(user_id)
+        self._changed()
+        return user
+
+    async def patch_user(self, user_id: int, user_data: UserPatchModel, if_match: Optional[str],
+                         session: AsyncSession) -> User:
+        changes = user_data.model_dump(exclude_unset=True, exclude_none=True)
+        etags = split_etags(if_match) if if_match is not None and if_match.strip() != "*" else None
+        if changes:
+            expected = None
+            if etags is not None:
+                expected = []
+                for etag in etags:
+                    version = parse_etag(etag)
+                    if version is not None and version[0] == user_id:
+                        expected.append(version[1])
+            user = await self.user_repository.patch(session, user_id, changes, expected)
+            if user is not None:
+                await self._invalidate(user_id)
+                self._changed()
+                return user
+
+        # Nothing was written: the user is missing, unchanged, or was modified since
+        user = await self.user_repository.get_by_id(session, user_id)
+        if etags is not None and make_etag(user.id, user.date_updated) not in etags:
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED,
+                                detail="User was modified")
+        return user
+
+    async def bulk_update_users(self, changes: dict, ids: Optional[list[int]], filters: Optional[dict],
+                                dry_run: bool, session: AsyncSession, chunk_size: int = 1000) -> dict:
+        if dry_run:
+            return await self._bulk_count(ids, filters, session, chunk_size, changes)
+        return await self._bulk_write(
+            lambda **selection: self.user_repository.bulk_update(session, changes, **selection),
+            ids, filters, session, chunk_size)
+
+    async def bulk_delete_users(self, ids: Optional[list[int]], filters: Optional[dict], dry_run: bool,
+                                session: AsyncSession, chunk_size: int = 1000) -> dict:
+        if dry_run:
+            return await self._bulk_count(ids, filters, session, chunk_size)
+        return await self._bulk_write(
+            lambda **selection: self.user_repository.bulk_delete(session, **selection),
+            ids, filters, session, chunk_size)
+
+    async def _bulk_count(self, ids: Optional[list[int]], filters: Optional[dict], session: AsyncSession,
+                          chunk_size: int, changes: Optional[dict] = None) -> dict:
+        if ids is None:
+            affected = await self.user_repository.count_matching(session, filters=filters, changes=changes)
+        else:
+            ids = sorted(set(ids))
+            affected = 0
+            for start in range(0, len(ids), chunk_size):
+                affected += await self.user_repository.count_matching(
+                    session, ids=ids[start:start + chunk_size], changes=changes)
+        return {"dry_run": True, "affected": affected, "ids": [], "error": None}
+
+    async def _bulk_write(self, write: Callable[..., Awaitable[list[int]]], ids: Optional[list[int]],
+                          filters: Optional[dict], session: AsyncSession, chunk_size: int) -> dict:
+        # Id lists are split into chunks up front; filters are walked in
+        # primary key order, resuming after the last id written
+        result = {"dry_run": False, "affected": 0, "ids": [], "error": None}
+        ids = sorted(set(ids)) if ids is not None else None
+        start = 0
+        after_id = None
+        while True:
+            if ids is not None:
+                if start >= len(ids):
+                    break
+                selection = {"ids": ids[start:start + chunk_size], "limit": chunk_size}
+                start += chunk_size
+            else:
+                selection = {"filters": filters, "after_id": after_id, "limit": chunk_size}
+            try:
+                written = await write(**selection)
+            except IntegrityError as e:
+                # Earlier chunks stay committed; report how far the job got
+                await session.rollback()
+                result["error"] = "Email already exists" if "email" in str(e.orig) else "Unique constraint violation"
+                break
+            for user_id in written:
+                await self._invalidate(user_id)
+            if written:
+                result["affected"] += len(written)
+                result["ids"].extend(sorted(written))
+                self._changed()
+            if ids is None:
+                if len(written) < chunk_size:
+                    break
+                after_id = max(written)
+        return result
 
     async def delete_user(self, user_id: int, session: AsyncSession) -> None:
-        return await self.user_repository.delete(session, user_id)
+        await self.user_repository.delete(session, user_id)
+        await self._invalidate(user_id)
+        self._changed()
@@ -0,0 +1,87 @@
+from functools import lru_cache
+from typing import Literal, Optional
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    database_url: str
+
+    # Engine and connection pool; pool sizing applies per worker process
+    db_echo: bool = False
+    db_pool_size: int = 10
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30.0
+    db_pool_pre_ping: bool = True
+    db_pool_recycle: int = 1800
+    # Compiled SQL cached per engine, and asyncpg prepared statements per connection
+    db_query_cache_size: int = 500
+    db_statement_cache_size: int = 100
+    # Connections each pool opens at startup, capped at db_pool_size
+    db_pool_prewarm: int = 0
+
+    # Comma separated URLs of read replicas; GET handlers are routed to them
+    db_read_replica_urls: str = ""
+    db_replica_retry_after: float = 5.0
+    db_replica_health_check_interval: float = 5.0
+    # Keep a client on the primary for this long after it writes
+    db_read_your_writes_seconds: float = 5.0
+
+    # Per-worker user cache; a maxsize of 0 disables caching but keeps
+    # concurrent reads of the same user coalesced into one query
+    user_cache_maxsize: int = 10_000
+    user_cache_ttl: float = 30.0
+    # Most ids accepted by one POST /users/batch-get
+    user_batch_max_size: int = 1000
+    # Seconds a coalesced read waits for the shared query before giving up
+    user_coalesce_timeout: float = 5.0
+
+    # Admission control for DB-backed handlers; unset caps concurrency at the
+    # pool capacity (db_pool_size + db_max_overflow) and 0 disables it. Queued
+    # requests are shed with 503 once their expected wait exceeds the budget.
+    admission_max_concurrency: Optional[int] = None
+    admission_max_wait: float = 1.0
+    # Slots only cheap (high priority) requests may take
+    admission_reserved: int = 2
+    # Per-client token bucket (client address, or X-Client-ID from trusted hosts); a rate of 0 disables it
+    rate_limit_per_second: float = 0.0
+    rate_limit_burst: int = 50
+
+    # Change feed relay (GET /users/changes)
+    change_feed_poll_interval: float = 1.0
+    change_feed_retention_hours: int = 168
+
+    # Response compression; bodies from compression_thread_min_size bytes are
+    # compressed in a worker thread so the event loop keeps serving requests
+    compression_min_size: int = 1024
+    compression_thread_min_size: int = 64 * 1024
+    compression_gzip_level: int = 6
+    compression_zstd_level: int = 3
+
+    # Production server (python server.py); 0 workers means one per available CPU
+    server_host: str = "0.0.0.0"
+    server_port: int = 8001
+    server_workers: int = 0
+    server_loop: Literal["auto", "asyncio", "uvloop"] = "auto"
+    server_http: Literal["auto", "h11", "httptools"] = "auto"
+    server_keep_alive: int = 5
+    server_backlog: int = 2048
+    server_graceful_timeout: int = 30
+    server_forwarded_allow_ips: str = "127.0.0.1"
+    server_access_log: bool = False
+
+    @property
+    def admission_limit(self) -> int:
+        if self.admission_max_concurrency is None:
+            return self.db_pool_size + self.db_max_overflow
+        return self.admission_max_concurrency
+
+    @property
+    def read_replica_urls(self) -> list[str]:
+        return [url.strip() for url in self.db_read_replica_urls.split(",") if url.strip()]
+
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+
+
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()